@@ -0,0 +1,193 @@
+# ================================================================================
+# FILE: annotate_video.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Offline annotation of recorded race videos with the frame classifier, for
+# diagnosing where the agent leaves the track and for auditing the classifier.
+#
+# A decoder thread reads the video with OpenCV, preprocesses every frame exactly
+# like RLAgent.frame_to_state (frame_processing.preprocess_frame) and fills
+# preallocated uint8 batches. The main thread classifies full batches through a
+# traced tf.function while the next batch is being decoded. OpenCV decoding and
+# TensorFlow both release the GIL, so decode and inference overlap.
+#
+# The timeline is written as a compressed .npz with one entry per frame:
+#   - frame:      frame number in the video (int32)
+#   - timestamp:  seconds from the start of the video (float32)
+#   - label:      index into `classes` (uint8)
+#   - confidence: softmax probability of that class (float16)
+#   - classes:    class names
+# load it with numpy.load(path). Intervals spent in the off_* and wall_* classes
+# are listed at the end.
+#
+# Usage:
+#   python CNN/annotate_video.py <video.mp4> [--output timeline.npz]
+#                                [--classifier FILE] [--batch-size N] [--stride N]
+#
+# ================================================================================
+# Function: decode_batches( path , batch_size , stride , free , ready )
+# ================================================================================
+#
+# Input:
+#   - path:       video file
+#   - batch_size: frames per batch
+#   - stride:     annotate every stride-th frame
+#   - free:       queue of empty batch buffers to fill
+#   - ready:      queue filled batches are put on as (buffer, count, frames, timestamps);
+#                 None marks the end of the video, and is preceded by the exception
+#                 if decoding failed
+#
+# ================================================================================
+# Function: incident_intervals( timestamps , labels , classes , min_duration )
+# ================================================================================
+#
+# Output:
+#   - list of (class name, start, end) for runs of off_* / wall_* frames lasting at
+#     least min_duration seconds
+#
+# ================================================================================
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frame_processing import CLASSIFIER_IMAGE_SIZE, FRAME_CLASSES, preprocess_frame
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ================================================================================
+# decode_batches
+# ================================================================================
+def decode_batches(path, batch_size, stride, free, ready):
+
+    # === Necessary Imports === #
+    import cv2
+
+    vidcap = cv2.VideoCapture(path)
+    try:
+        fps = vidcap.get(cv2.CAP_PROP_FPS) or 30.0
+        frame_number = 0
+        buffer, count = free.get(), 0
+        numbers = np.empty(batch_size, dtype=np.int32)
+
+        # === Stream the Video into Batches === #
+        while vidcap.grab():
+            if frame_number % stride == 0:
+                success, image = vidcap.retrieve()
+                if not success:
+                    break
+                buffer[count, :, :, 0] = preprocess_frame(image)
+                numbers[count] = frame_number
+                count += 1
+                if count == batch_size:
+                    ready.put((buffer, count, numbers.copy(), numbers / fps))
+                    buffer, count = free.get(), 0
+            frame_number += 1
+
+        if count > 0:
+            ready.put((buffer, count, numbers[:count].copy(), numbers[:count] / fps))
+    except Exception as error:
+        ready.put(error) # Re-raised by the main loop, which would otherwise wait forever
+    finally:
+        vidcap.release()
+        ready.put(None)
+
+
+# ================================================================================
+# incident_intervals
+# ================================================================================
+def incident_intervals(timestamps, labels, classes, min_duration=0.25):
+    intervals = list()
+    start = 0
+    for i in range(1, len(labels) + 1):
+        if i == len(labels) or labels[i] != labels[start]:
+            name = classes[labels[start]]
+            if name.startswith(('off_', 'wall_')) and timestamps[i - 1] - timestamps[start] >= min_duration:
+                intervals.append((name, float(timestamps[start]), float(timestamps[i - 1])))
+            start = i
+    return intervals
+
+
+# ================================================================================
+# main
+# ================================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Classify every frame of a race video into a timeline')
+    parser.add_argument('video', help='recorded race video')
+    parser.add_argument('--output', default=None, help='timeline .npz (default: <video>.timeline.npz)')
+    parser.add_argument('--classifier', default=os.path.join(REPO_ROOT, 'classifier_v4.h5'))
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=1, help='annotate every N-th frame')
+    args = parser.parse_args()
+
+    # === Necessary Imports === #
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(args.classifier, compile=False)
+    predict = tf.function(model, reduce_retracing=True)
+    width, height = CLASSIFIER_IMAGE_SIZE
+
+    # === Three Buffers: One Being Decoded, One Queued, One Being Classified === #
+    free, ready = queue.Queue(), queue.Queue(maxsize=2)
+    for _ in range(3):
+        free.put(np.empty((args.batch_size, height, width, 1), dtype=np.float32))
+    decoder = threading.Thread(target=decode_batches, daemon=True,
+                               args=(args.video, args.batch_size, args.stride, free, ready))
+
+    frames, timestamps, labels, confidence = list(), list(), list(), list()
+    start = time.perf_counter()
+    decoder.start()
+
+    # === Classify Batches as They Arrive === #
+    while True:
+        item = ready.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        buffer, count, numbers, times = item
+        probs = predict(buffer, training=False).numpy()[:count]
+        free.put(buffer)
+
+        best = np.argmax(probs, axis=1)
+        frames.append(numbers)
+        timestamps.append(times.astype(np.float32))
+        labels.append(best.astype(np.uint8))
+        confidence.append(probs[np.arange(count), best].astype(np.float16))
+
+    elapsed = time.perf_counter() - start
+    decoder.join()
+    if not frames:
+        print('No frames decoded from {}'.format(args.video))
+        return
+
+    frames, timestamps = np.concatenate(frames), np.concatenate(timestamps)
+    labels, confidence = np.concatenate(labels), np.concatenate(confidence)
+    classes = np.array([FRAME_CLASSES[i] for i in range(len(FRAME_CLASSES))])
+
+    # === Write the Timeline === #
+    output = args.output if args.output is not None else os.path.splitext(args.video)[0] + '.timeline.npz'
+    np.savez_compressed(output, frame=frames, timestamp=timestamps, label=labels,
+                        confidence=confidence, classes=classes)
+
+    # === Report === #
+    video_seconds = float(timestamps[-1]) if len(timestamps) > 1 else 0.0
+    print('{} frames in {:.1f}s: {:.0f} frames/s ({:.1f}x real time). Saved {}'.format(
+        len(frames), elapsed, len(frames) / elapsed, video_seconds / elapsed if elapsed > 0 else 0.0, output))
+    for i, name in enumerate(classes):
+        in_class = labels == i
+        if in_class.any():
+            print('  {:<13} {:>6.1%}  mean confidence {:.3f}'.format(name, in_class.mean(), confidence[in_class].astype(np.float32).mean()))
+    for name, begin, end in incident_intervals(timestamps, labels, classes):
+        print('  {:>8.2f}s - {:>8.2f}s  {}'.format(begin, end, name))
+
+
+if __name__ == '__main__':
+    main()
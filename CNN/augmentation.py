@@ -0,0 +1,92 @@
+# ================================================================================
+# FILE: augmentation.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# On-the-fly augmentation of uint8 frame batches for train_classifier.py. The
+# classes come in mirror pairs, so a horizontally flipped near_left frame is a
+# near_right frame (and center stays center). Flipping half of every batch and
+# swapping the paired labels means each side of the track only needs to be
+# recorded once. Cheap brightness and shift jitter is applied on top.
+#
+# Everything is vectorized over the batch and runs inside the training
+# pipeline's generator, which tf.data prefetches on a background thread, so it
+# stays off the critical path of training.
+#
+# Note that flipping also mirrors the HUD (lap counter, item box), which the
+# classifier should learn to ignore anyway.
+#
+# ================================================================================
+# CONSTANTS
+# ================================================================================
+#
+#   - MIRROR_LABELS:
+#        * numpy array mapping each class index to the index of its mirror image
+#
+# ================================================================================
+# Function: augment_batch( frames , labels , rng , flip_prob , brightness , max_shift )
+# ================================================================================
+#
+# Input:
+#   - frames:      uint8 array (B, H, W) of preprocessed frames
+#   - labels:      class indices of the frames
+#   - rng:         numpy RandomState drawing the augmentations
+#   - flip_prob:   probability of mirroring each frame (and swapping its label)
+#   - brightness:  maximum absolute brightness offset added to each frame
+#   - max_shift:   maximum shift in pixels, drawn per frame and axis (edges are
+#                  replicated)
+#
+# Output:
+#   - (frames, labels) as new uint8 arrays; the inputs are not modified
+#
+# ================================================================================
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frame_processing import CLASS_INDICES, FRAME_CLASSES
+
+
+# ================================================================================
+# Build the Mirror Table from the Class Names
+# ================================================================================
+def _mirror_name(name):
+    if name.endswith('_left'):
+        return name[:-len('_left')] + '_right'
+    if name.endswith('_right'):
+        return name[:-len('_right')] + '_left'
+    return name
+
+MIRROR_LABELS = np.array([CLASS_INDICES[_mirror_name(FRAME_CLASSES[i])] for i in range(len(FRAME_CLASSES))],
+                         dtype=np.uint8)
+
+
+# ================================================================================
+# augment_batch
+# ================================================================================
+def augment_batch(frames, labels, rng, flip_prob=0.5, brightness=20, max_shift=2):
+    n, height, width = frames.shape
+    labels = np.array(labels, dtype=np.uint8)
+
+    # === Mirror Frames and Swap Their Paired Labels === #
+    flip = rng.rand(n) < flip_prob
+    frames = np.where(flip[:, None, None], frames[:, :, ::-1], frames)
+    labels[flip] = MIRROR_LABELS[labels[flip]]
+
+    # === Per-Frame Shift via Clipped Index Arrays === #
+    if max_shift > 0:
+        dy = rng.randint(-max_shift, max_shift + 1, size=n)
+        dx = rng.randint(-max_shift, max_shift + 1, size=n)
+        rows = np.clip(np.arange(height)[None, :] - dy[:, None], 0, height - 1)
+        cols = np.clip(np.arange(width)[None, :] - dx[:, None], 0, width - 1)
+        frames = np.take_along_axis(frames, np.broadcast_to(rows[:, :, None], frames.shape), axis=1)
+        frames = np.take_along_axis(frames, np.broadcast_to(cols[:, None, :], frames.shape), axis=2)
+
+    # === Per-Frame Brightness Offset === #
+    if brightness > 0:
+        offset = rng.randint(-brightness, brightness + 1, size=n).astype(np.int16)
+        frames = np.clip(frames.astype(np.int16) + offset[:, None, None], 0, 255).astype(np.uint8)
+
+    return frames, labels
@@ -0,0 +1,205 @@
+# ================================================================================
+# FILE: benchmark_models.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Benchmarks every classifier artifact shipped with the repository (by default
+# classifier*.h5 in the repository root and CNN/*.h5) so the production model
+# can be picked on data instead of guesswork. Each model is measured in a fresh
+# process, so load time and memory are not skewed by models loaded before it:
+#
+#   - load time of tf.keras.models.load_model
+#   - resident memory after loading, and the increase caused by the model itself
+#   - median CPU latency for batches of 1, 8, 32 and 128 frames through a traced
+#     tf.function (the way RLAgent calls the model), and the resulting throughput
+#   - accuracy on a common labeled frame set from a frame store (optional)
+#
+# The older 5 and 7 class models only know the first classes of FRAME_CLASSES,
+# so their accuracy is computed over the frames of the classes they cover, and
+# the coverage is reported alongside it.
+#
+# Memory is read with psutil when it is installed, otherwise from /proc (Linux
+# only). Elsewhere the memory columns are left empty.
+#
+# A model that cannot be loaded or run (e.g. a legacy .h5 the installed Keras no
+# longer reads) does not stop the run: its row holds the error instead.
+#
+# Usage:
+#   python CNN/benchmark_models.py [models ...] [--store DIR] [--manifest FILE]
+#                                  [--limit N] [--batch-sizes 1 8 32 128]
+#                                  [--iterations N] [--threads N] [--csv FILE]
+#
+# ================================================================================
+# Function: resident_memory( )
+# ================================================================================
+#
+# Output:
+#   - resident memory of the current process in MB, or None if unavailable
+#
+# ================================================================================
+# Function: benchmark_model( path , store_dir , indices , batch_sizes , iterations , threads )
+# ================================================================================
+#
+# Output:
+#   - dictionary of measurements for one model. Runs inside a child process.
+#
+# ================================================================================
+import os
+import csv
+import glob
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ================================================================================
+# resident_memory
+# ================================================================================
+def resident_memory():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm', 'r') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20 # Resident pages, not the peak
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# ================================================================================
+# benchmark_model
+# ================================================================================
+def benchmark_model(path, store_dir, indices, batch_sizes, iterations, threads):
+
+    # === Necessary Imports (Done in the Child Process) === #
+    import tensorflow as tf
+    tf.config.set_visible_devices([], 'GPU') # CPU latency, even on a GPU rig
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    result = {'model': os.path.relpath(path, REPO_ROOT)}
+
+    # === Load Time and Memory === #
+    memory_before = resident_memory()
+    start = time.perf_counter()
+    model = tf.keras.models.load_model(path, compile=False)
+    result['load_s'] = time.perf_counter() - start
+    memory_after = resident_memory()
+    result['rss_mb'] = memory_after
+    result['model_mb'] = memory_after - memory_before if memory_after is not None and memory_before is not None else None
+    result['params'] = model.count_params()
+    result['classes'] = model.output_shape[-1]
+    _, height, width, channels = model.input_shape
+
+    # === Latency and Throughput per Batch Size === #
+    predict = tf.function(model, reduce_retracing=True)
+    for batch_size in batch_sizes:
+        batch = np.random.RandomState(0).randint(0, 256, (batch_size, height, width, channels)).astype(np.float32)
+        for _ in range(5):
+            predict(batch, training=False).numpy()
+        timings = list()
+        runs = max(5, iterations // batch_size)
+        for _ in range(runs):
+            start = time.perf_counter()
+            predict(batch, training=False).numpy()
+            timings.append(time.perf_counter() - start)
+        latency = float(np.median(timings))
+        result['latency_ms_{}'.format(batch_size)] = latency * 1000
+        result['fps_{}'.format(batch_size)] = batch_size / latency
+
+    # === Accuracy on the Common Labeled Set === #
+    if store_dir is not None:
+        from frame_store import FrameStore
+        from PIL import Image
+        store = FrameStore(store_dir)
+        covered = indices[store.labels[indices] < result['classes']]
+        correct = 0
+        for start in range(0, len(covered), 256):
+            batch = covered[start:start + 256]
+            frames = store.get_frames(batch)
+            if frames.shape[1:] != (height, width):
+                frames = np.stack([np.asarray(Image.fromarray(f).resize((width, height))) for f in frames])
+            probs = model.predict_on_batch(frames[..., np.newaxis].astype(np.float32))
+            correct += int(np.sum(np.argmax(probs, axis=1) == store.labels[batch]))
+        result['accuracy'] = correct / max(1, len(covered))
+        result['coverage'] = len(covered) / max(1, len(indices))
+
+    return result
+
+
+# ================================================================================
+# main
+# ================================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every classifier artifact')
+    parser.add_argument('models', nargs='*', help='model files (default: classifier*.h5 and CNN/*.h5)')
+    parser.add_argument('--store', default=None, help='frame store for the accuracy column')
+    parser.add_argument('--manifest', default=None, help='only use the validation rows of this dedup_dataset.py manifest')
+    parser.add_argument('--limit', type=int, default=5000, help='maximum labeled frames to evaluate (seeded sample)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--iterations', type=int, default=512, help='frames timed per batch size')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--csv', default=None, help='also write the table to this CSV file')
+    args = parser.parse_args()
+
+    models = args.models or sorted(glob.glob(os.path.join(REPO_ROOT, 'classifier*.h5'))) + \
+                            sorted(glob.glob(os.path.join(REPO_ROOT, 'CNN', '*.h5')))
+
+    # === Common Labeled Frame Set === #
+    indices = None
+    if args.store is not None:
+        from frame_store import FrameStore
+        from train_classifier import manifest_indices
+        if args.manifest is not None:
+            indices = manifest_indices(args.manifest)[1]
+        else:
+            indices = np.arange(len(FrameStore(args.store)))
+        if len(indices) > args.limit:
+            indices = np.sort(np.random.RandomState(0).choice(indices, args.limit, replace=False))
+
+    # === Measure Each Model in a Fresh Process === #
+    results = list()
+    context = multiprocessing.get_context('spawn')
+    for path in models:
+        try:
+            with context.Pool(1) as pool:
+                result = pool.apply(benchmark_model, (path, args.store, indices, args.batch_sizes, args.iterations, args.threads))
+            print('Measured {}'.format(result['model']))
+        except Exception as error:
+            result = {'model': os.path.relpath(path, REPO_ROOT), 'error': '{}: {}'.format(type(error).__name__, error).splitlines()[0]}
+            print('Could not measure {}: {}'.format(result['model'], result['error']))
+        results.append(result)
+
+    # === Comparison Table === #
+    columns = ['model', 'params', 'classes', 'load_s', 'rss_mb', 'model_mb']
+    columns += ['latency_ms_{}'.format(b) for b in args.batch_sizes] + ['fps_{}'.format(b) for b in args.batch_sizes]
+    if args.store is not None:
+        columns += ['accuracy', 'coverage']
+    if any('error' in r for r in results):
+        columns += ['error']
+
+    def cell(value):
+        if value is None:
+            return '-'
+        return '{:.3f}'.format(value) if isinstance(value, float) else str(value)
+
+    rows = [[cell(r.get(c)) for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print()
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# ================================================================================
+# FILE: build_dataset.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Command line replacement for video_to_image_data.ipynb. Every clip in a
+# directory of class-named .mp4 files is decoded in a process pool, each kept
+# frame is preprocessed once exactly like RLAgent.frame_to_state (grayscale,
+# 80x64) and the results are written as sharded uint8 .npy arrays plus label
+# arrays that frame_store.FrameStore memory-maps. A full ~60,000 frame dataset
+# takes ~300MB instead of gigabytes of full resolution JPEGs.
+#
+# The class of a clip is the name of the directory it is in, if that is a class
+# name, otherwise the longest class name its file name starts with
+# (e.g. clips/center.mp4, clips/near_left_gamecube.mp4, clips/wall_left/lap2.mp4).
+#
+# Clips that have not changed since the last build keep their shards, so
+# rebuilding after adding a clip only decodes the new clip.
+#
+# With --crops the store holds the horizontal bands of LOOKAHEAD_CROPS instead
+# of whole frames, cut by preprocess_crops exactly as RLAgent does with
+# `python main.py --lookahead`, so train_classifier.py can train the classifier
+# that mode needs. Every kept frame gives one sample per band, labelled with the
+# clip's class, and each shard also records the band of every sample
+# (shard_*_region.npy). The clip's class must therefore describe every band
+# that is kept: choose the bands with --crops near mid far (all by default),
+# e.g. only near for clips labelled by what is just ahead of the kart.
+#
+# Usage:
+#   python CNN/build_dataset.py <clip_dir> <store_dir> [--stride N] [--workers N]
+#                               [--shard-size N] [--force] [--crops [BAND ...]]
+#
+# ================================================================================
+# Function: clip_class( path )
+# ================================================================================
+#
+# Output:
+#   - the class name of the clip at path, or None if it does not name a class
+#
+# ================================================================================
+# Function: process_clip( path , label , clip_id , out_dir , stride , shard_size , regions )
+# ================================================================================
+#
+# Input:
+#   - path:       .mp4 file to decode
+#   - label:      class index of every frame in the clip
+#   - clip_id:    number identifying the clip within the store
+#   - out_dir:    store directory
+#   - stride:     keep every stride-th frame
+#   - shard_size: maximum number of frames per shard
+#   - regions:    None for whole frames, or the LOOKAHEAD_CROPS bands to store
+#
+# Output:
+#   - list of manifest entries for the shards written
+#
+# Task:
+#   - decode the clip, skipping (grab without retrieve) frames between strides
+#   - preprocess kept frames into a preallocated shard buffer
+#   - save the buffer, labels and source frame numbers whenever it fills up
+#
+# ================================================================================
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# === The Shared Preprocessing Lives in the Repository Root === #
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frame_processing import CLASSIFIER_IMAGE_SIZE, CLASS_INDICES, FRAME_CLASSES, LOOKAHEAD_CROPS, preprocess_crops, preprocess_frame
+
+
+# ================================================================================
+# clip_class
+# ================================================================================
+def clip_class(path):
+
+    # === Directory Named After the Class === #
+    parent = os.path.basename(os.path.dirname(path))
+    if parent in CLASS_INDICES:
+        return parent
+
+    # === File Named After the Class === #
+    stem = os.path.splitext(os.path.basename(path))[0]
+    matches = [name for name in CLASS_INDICES if stem.startswith(name)]
+    return max(matches, key=len) if matches else None
+
+
+# ================================================================================
+# process_clip
+# ================================================================================
+def process_clip(path, label, clip_id, out_dir, stride, shard_size, regions=None):
+
+    # === Necessary Imports (Done in the Worker Process) === #
+    import cv2
+
+    width, height = CLASSIFIER_IMAGE_SIZE
+    per_frame = 1 if regions is None else len(regions)
+    shard_size = max(shard_size - shard_size % per_frame, per_frame) # Whole frames per shard
+    frames = np.empty((shard_size, height, width), dtype=np.uint8)
+    index = np.empty(shard_size, dtype=np.int32)
+    entries = list()
+    if regions is not None:
+        crops = np.empty((per_frame, height, width, 1), dtype=np.uint8)
+        bands = np.array([[name for name, _, _ in LOOKAHEAD_CROPS].index(name) for name, _, _ in regions], dtype=np.uint8)
+
+    # === Save the Filled Part of the Buffer as a Shard === #
+    def flush(count):
+        prefix = 'shard_{:04d}_{:03d}'.format(clip_id, len(entries))
+        np.save(os.path.join(out_dir, prefix + '_frames.npy'), frames[:count])
+        np.save(os.path.join(out_dir, prefix + '_labels.npy'), np.full(count, label, dtype=np.uint8))
+        np.save(os.path.join(out_dir, prefix + '_index.npy'), index[:count])
+        entries.append({'frames': prefix + '_frames.npy',
+                        'labels': prefix + '_labels.npy',
+                        'index': prefix + '_index.npy',
+                        'count': int(count),
+                        'clip_id': clip_id,
+                        'label': int(label)})
+        if regions is not None:
+            np.save(os.path.join(out_dir, prefix + '_region.npy'), np.tile(bands, count // per_frame))
+            entries[-1]['region'] = prefix + '_region.npy'
+
+    # === Stream the Clip === #
+    vidcap = cv2.VideoCapture(path)
+    frame_number, count = 0, 0
+    while vidcap.grab():
+        if frame_number % stride == 0:
+            success, image = vidcap.retrieve()
+            if not success:
+                break
+            if regions is None:
+                frames[count] = preprocess_frame(image)
+            else:
+                frames[count:count + per_frame] = preprocess_crops(image, regions, crops)[:, :, :, 0]
+            index[count:count + per_frame] = frame_number
+            count += per_frame
+            if count == shard_size:
+                flush(count)
+                count = 0
+        frame_number += 1
+    vidcap.release()
+
+    if count > 0:
+        flush(count)
+
+    return entries
+
+
+# ================================================================================
+# main
+# ================================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Build a memory-mappable frame store from class-named clips')
+    parser.add_argument('clip_dir', help='directory containing <class>.mp4 clips (searched recursively)')
+    parser.add_argument('store_dir', help='directory the store is written to')
+    parser.add_argument('--stride', type=int, default=1, help='keep every N-th frame of each clip')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of decoding processes')
+    parser.add_argument('--shard-size', type=int, default=4096, help='maximum frames per shard')
+    parser.add_argument('--force', action='store_true', help='re-decode every clip even if it is unchanged')
+    parser.add_argument('--crops', nargs='*', default=None, metavar='BAND',
+                        choices=[name for name, _, _ in LOOKAHEAD_CROPS],
+                        help='store these LOOKAHEAD_CROPS bands of each frame (all if none given) for a --lookahead classifier')
+    args = parser.parse_args()
+    regions = None
+    if args.crops is not None:
+        regions = [crop for crop in LOOKAHEAD_CROPS if not args.crops or crop[0] in args.crops]
+
+    os.makedirs(args.store_dir, exist_ok=True)
+    manifest_path = os.path.join(args.store_dir, 'manifest.json')
+
+    # === Collect the Clips === #
+    clips = list()
+    for root, _, files in os.walk(args.clip_dir):
+        for name in sorted(files):
+            if name.lower().endswith('.mp4'):
+                path = os.path.join(root, name)
+                class_name = clip_class(path)
+                if class_name is None:
+                    print('Skipping {} (not named after a class)'.format(path))
+                    continue
+                clips.append((path, class_name))
+    clips.sort()
+
+    # === Reuse Shards of Unchanged Clips from the Previous Build === #
+    previous = dict()
+    if os.path.exists(manifest_path) and not args.force:
+        with open(manifest_path, 'r') as infile:
+            old = json.load(infile)
+        if old.get('stride') == args.stride and old.get('crops') == (None if regions is None else [list(r) for r in regions]):
+            for clip in old['clips']:
+                previous[clip['path']] = clip
+
+    manifest = {'image_shape': [CLASSIFIER_IMAGE_SIZE[1], CLASSIFIER_IMAGE_SIZE[0]],
+                'classes': {str(k): v for k, v in FRAME_CLASSES.items()},
+                'stride': args.stride,
+                'crops': None if regions is None else [list(r) for r in regions],
+                'clips': list(),
+                'shards': list()}
+
+    # === Decode Changed Clips in Parallel === #
+    start = time.time()
+    jobs = dict()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for clip_id, (path, class_name) in enumerate(clips):
+            stat = os.stat(path)
+            clip = {'path': path, 'class': class_name, 'clip_id': clip_id,
+                    'size': stat.st_size, 'mtime': stat.st_mtime}
+            manifest['clips'].append(clip)
+
+            old = previous.get(path)
+            if old is not None and old['size'] == clip['size'] and old['mtime'] == clip['mtime'] and old['clip_id'] == clip_id:
+                clip['shards'] = old['shards']
+                continue
+
+            future = pool.submit(process_clip, path, CLASS_INDICES[class_name], clip_id,
+                                 args.store_dir, args.stride, args.shard_size, regions)
+            jobs[future] = clip
+
+        for future in as_completed(jobs):
+            clip = jobs[future]
+            clip['shards'] = future.result()
+            print('{}: {} samples ({})'.format(clip['path'], sum(s['count'] for s in clip['shards']), clip['class']))
+
+    # === Write the Manifest Last so a Failed Build Never Looks Complete === #
+    for clip in manifest['clips']:
+        manifest['shards'] += clip['shards']
+    with open(manifest_path, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1)
+
+    total = sum(s['count'] for s in manifest['shards'])
+    print('Done: {} samples from {} clips ({} decoded) in {:.1f}s'.format(
+        total, len(clips), len(jobs), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+# ================================================================================
+# FILE: dedup_dataset.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Thins out the near-duplicate frames that come from extracting every frame of
+# a lap clip, and splits what is left into train/validation sets without
+# putting neighbouring frames on both sides of the split.
+#
+# Works on either the JPEG dataset (dataset/<class>/frame<number>.jpg) or a
+# frame store written by build_dataset.py. Every frame gets a 72-bit difference
+# hash (dHash) of its preprocessed 80x64 image, computed in a process pool.
+# Frames are then walked in order within each clip; a frame whose hash is within
+# --threshold bits of one of the last --window cluster representatives joins
+# that cluster, otherwise it starts a new one. Only representatives are kept.
+#
+# For the split, each clip is cut into blocks of --block consecutive frames and
+# whole blocks are assigned to validation per class until --val-fraction of the
+# class is reached. Training frames within --gap frames of a validation block
+# are dropped as well. The JPEG dataset has one frame sequence per class
+# directory, so each class directory is treated as one clip.
+#
+# The thinned manifest is a CSV with one row per kept frame:
+#   source, label, clip, frame, cluster_size, split
+# where source is the store index (or JPEG path). train_classifier.py --manifest
+# trains on the rows of a store manifest.
+#
+# Usage:
+#   python CNN/dedup_dataset.py <dataset_or_store_dir> <manifest.csv>
+#                               [--threshold N] [--window N] [--block N] [--gap N]
+#                               [--val-fraction F] [--seed N] [--workers N]
+#
+# ================================================================================
+# Function: dhash( frames )
+# ================================================================================
+#
+# Input:
+#   - frames: uint8 array (N, 64, 80) of preprocessed frames
+#
+# Output:
+#   - uint8 array (N, 9) of packed 72-bit hashes. The frames are averaged over
+#     8x8 blocks to an 8x10 grid and each bit records whether a cell is brighter
+#     than its right-hand neighbour.
+#
+# ================================================================================
+# Function: hamming( hash , hashes )
+# ================================================================================
+#
+# Output:
+#   - number of differing bits between one packed hash and each of an array of them
+#
+# ================================================================================
+# Function: cluster_sequence( hashes , threshold , window )
+# ================================================================================
+#
+# Input:
+#   - hashes:    packed hashes of one clip's frames, in frame order
+#   - threshold: maximum Hamming distance to count as a near-duplicate
+#   - window:    number of recent cluster representatives to compare against
+#
+# Output:
+#   - (representatives, cluster_sizes): positions of the kept frames and how many
+#     frames each one stands for
+#
+# ================================================================================
+# Function: split_blocks( labels , clips , frames , block , gap , val_fraction , seed )
+# ================================================================================
+#
+# Output:
+#   - array of 'train' / 'val' / '' (dropped at a block boundary) per frame
+#
+# ================================================================================
+import os
+import sys
+import csv
+import re
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frame_processing import CLASS_INDICES, FRAME_CLASSES, preprocess_frame
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# ================================================================================
+# dhash
+# ================================================================================
+def dhash(frames):
+    n, height, width = frames.shape
+    cells = frames.reshape(n, height // 8, 8, width // 8, 8).mean(axis=(2, 4))
+    bits = cells[:, :, 1:] < cells[:, :, :-1]
+    return np.packbits(bits.reshape(n, -1), axis=1)
+
+
+# ================================================================================
+# hamming
+# ================================================================================
+def hamming(hash, hashes):
+    return POPCOUNT[np.bitwise_xor(hashes, hash)].sum(axis=1)
+
+
+# ================================================================================
+# Hashing Workers
+# ================================================================================
+def hash_jpegs(paths):
+    from PIL import Image
+    frames = np.stack([preprocess_frame(Image.open(p)) for p in paths])
+    return dhash(frames)
+
+def hash_store(store_dir, start, stop):
+    from frame_store import FrameStore
+    store = FrameStore(store_dir)
+    return dhash(store.get_frames(np.arange(start, stop)))
+
+
+# ================================================================================
+# cluster_sequence
+# ================================================================================
+def cluster_sequence(hashes, threshold, window):
+    representatives, sizes = [0], [1]
+    for i in range(1, len(hashes)):
+        recent = representatives[-window:]
+        distances = hamming(hashes[i], hashes[recent])
+        best = int(np.argmin(distances))
+        if distances[best] <= threshold:
+            sizes[len(representatives) - len(recent) + best] += 1
+        else:
+            representatives.append(i)
+            sizes.append(1)
+    return np.array(representatives), np.array(sizes)
+
+
+# ================================================================================
+# split_blocks
+# ================================================================================
+def split_blocks(labels, clips, frames, block, gap, val_fraction, seed):
+    rng = np.random.RandomState(seed)
+    split = np.full(len(labels), 'train', dtype=object)
+    blocks = frames // block
+
+    for label in np.unique(labels):
+        in_class = labels == label
+
+        # === Pick Whole Blocks for Validation Until the Fraction is Reached === #
+        groups = sorted(set(zip(clips[in_class], blocks[in_class])))
+        target = val_fraction * in_class.sum()
+        chosen = 0
+        for g in rng.permutation(len(groups))[:len(groups) - 1]:  # always leave a block for training
+            if chosen >= target:
+                break
+            clip, blk = groups[g]
+            members = in_class & (clips == clip) & (blocks == blk)
+            split[members] = 'val'
+            chosen += members.sum()
+
+    # === Drop Training Frames Adjacent to a Validation Block === #
+    for clip in np.unique(clips):
+        in_clip = clips == clip
+        val_frames = frames[in_clip & (split == 'val')]
+        if len(val_frames) == 0 or gap <= 0:
+            continue
+        train_pos = np.nonzero(in_clip & (split == 'train'))[0]
+        val_sorted = np.sort(val_frames)
+        nearest = np.searchsorted(val_sorted, frames[train_pos])
+        lower = np.abs(frames[train_pos] - val_sorted[np.clip(nearest - 1, 0, len(val_sorted) - 1)])
+        upper = np.abs(frames[train_pos] - val_sorted[np.clip(nearest, 0, len(val_sorted) - 1)])
+        split[train_pos[np.minimum(lower, upper) <= gap]] = ''
+
+    return split
+
+
+# ================================================================================
+# main
+# ================================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Remove near-duplicate frames and split by clip blocks')
+    parser.add_argument('source', help='dataset/ directory of <class>/frame<n>.jpg, or a frame store directory')
+    parser.add_argument('manifest', help='CSV manifest to write')
+    parser.add_argument('--threshold', type=int, default=4, help='maximum differing hash bits for a near-duplicate')
+    parser.add_argument('--window', type=int, default=8, help='recent clusters each frame is compared against')
+    parser.add_argument('--block', type=int, default=300, help='frames per split block')
+    parser.add_argument('--gap', type=int, default=15, help='training frames this close to a validation block are dropped')
+    parser.add_argument('--val-fraction', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk', type=int, default=2048, help='frames hashed per task')
+    args = parser.parse_args()
+
+    start = time.time()
+    is_store = os.path.exists(os.path.join(args.source, 'manifest.json'))
+
+    # === Collect Per-Frame Metadata === #
+    if is_store:
+        from frame_store import FrameStore
+        store = FrameStore(args.source)
+        sources = np.arange(len(store))
+        labels, clips, frames = store.labels.astype(np.int64), store.clip_ids.astype(np.int64), store.frame_index.astype(np.int64)
+    else:
+        sources, labels, clips, frames = [], [], [], []
+        for class_name in sorted(os.listdir(args.source)):
+            if class_name not in CLASS_INDICES:
+                continue
+            directory = os.path.join(args.source, class_name)
+            for name in os.listdir(directory):
+                match = re.match(r'frame(\d+)\.jpg$', name)
+                if match:
+                    sources.append(os.path.join(directory, name))
+                    labels.append(CLASS_INDICES[class_name])
+                    clips.append(CLASS_INDICES[class_name])
+                    frames.append(int(match.group(1)))
+        sources, labels, clips, frames = np.array(sources), np.array(labels), np.array(clips), np.array(frames)
+
+    # === Hash Every Frame in Parallel === #
+    chunks = range(0, len(sources), args.chunk)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        if is_store:
+            futures = [pool.submit(hash_store, args.source, s, min(s + args.chunk, len(sources))) for s in chunks]
+        else:
+            futures = [pool.submit(hash_jpegs, list(sources[s:s + args.chunk])) for s in chunks]
+        hashes = np.concatenate([f.result() for f in futures])
+    print('Hashed {} frames in {:.1f}s'.format(len(hashes), time.time() - start))
+
+    # === Cluster Near-Duplicates Within Each Clip, in Frame Order === #
+    kept, cluster_size = [], []
+    for clip in np.unique(clips):
+        positions = np.nonzero(clips == clip)[0]
+        positions = positions[np.argsort(frames[positions], kind='stable')]
+        reps, sizes = cluster_sequence(hashes[positions], args.threshold, args.window)
+        kept.append(positions[reps])
+        cluster_size.append(sizes)
+    kept, cluster_size = np.concatenate(kept), np.concatenate(cluster_size)
+
+    # === Split the Kept Frames by Clip Blocks === #
+    split = split_blocks(labels[kept], clips[kept], frames[kept], args.block, args.gap, args.val_fraction, args.seed)
+
+    # === Write the Thinned Manifest === #
+    with open(args.manifest, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['source', 'label', 'clip', 'frame', 'cluster_size', 'split'])
+        for i, pos in enumerate(kept):
+            if split[i]:
+                writer.writerow([sources[pos], FRAME_CLASSES[int(labels[pos])], clips[pos], frames[pos],
+                                 cluster_size[i], split[i]])
+
+    # === Report === #
+    n_train, n_val = int((split == 'train').sum()), int((split == 'val').sum())
+    print('Kept {} of {} frames ({:.1%}); train {}, val {}, dropped at block boundaries {}'.format(
+        len(kept), len(sources), len(kept) / max(1, len(sources)), n_train, n_val, len(kept) - n_train - n_val))
+    for label in np.unique(labels):
+        print('  {:<13} {:>6} -> {:>6}'.format(FRAME_CLASSES[int(label)], int((labels == label).sum()),
+                                              int((labels[kept] == label).sum())))
+    print('Done in {:.1f}s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+# ================================================================================
+# FILE: distill_classifier.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Knowledge distillation of the frame classifier into smaller students for CPU
+# inference. The teacher (classifier_v4.h5 by default) is run once over the
+# frame store and its softened outputs become the targets of each student, mixed
+# with the true labels:
+#
+#   loss = alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * CE(labels, student)
+#
+# where X_T is the softmax at temperature T. A student is described by
+# "f1,f2,scale": two conv blocks of f1 and f2 3x3 filters (each followed by 2x2
+# max pooling) after an average pooling of the 80x64 input by `scale`. The
+# downscale is a layer of the model, so every student still takes the same
+# 80x64 frames as classifier_v4.h5 and RLAgent needs no other preprocessing.
+#
+# After training, every model (teacher included) is measured on the validation
+# frames for accuracy, agreement with the teacher and median single-frame CPU
+# latency through a traced tf.function (the way RLAgent calls it). The table
+# marks the accuracy/latency Pareto front, and each student is saved as
+# classifier_student_<f1>x<f2>_s<scale>.h5 in the repository root, ready for
+# `python main.py --classifier <file>`.
+#
+# Usage:
+#   python CNN/distill_classifier.py <store_dir> [--teacher FILE]
+#                                    [--students "8,16,1" "4,8,2" ...]
+#                                    [--temperature T] [--alpha A] [--epochs N]
+#                                    [--manifest FILE] [--threads N]
+#
+# ================================================================================
+# Function: build_student( input_shape , n_classes , f1 , f2 , scale , temperature )
+# ================================================================================
+#
+# Output:
+#   - (train_model, deploy_model). Both share their layers. train_model outputs
+#     the softened and the regular softmax of the student's logits; deploy_model
+#     only the regular softmax and is what gets saved.
+#
+# ================================================================================
+# Function: teacher_targets( teacher , store , indices , temperature , batch_size )
+# ================================================================================
+#
+# Output:
+#   - float32 array (len(indices), n_classes) of the teacher's outputs softened to
+#     the given temperature (p^(1/T), renormalized, which equals softmax(z/T))
+#
+# ================================================================================
+# Function: predict_labels( model , store , indices , batch_size )
+# ================================================================================
+#
+# Output:
+#   - predicted class index of every frame, computed in uint8 -> float32 batches
+#     so the validation set is never held in memory as floats
+#
+# ================================================================================
+# Function: measure( model , store , indices , teacher_pred , iterations )
+# ================================================================================
+#
+# Output:
+#   - (accuracy, teacher agreement, predictions, median single-frame latency in ms)
+#
+# ================================================================================
+# Function: pareto_front( points )
+# ================================================================================
+#
+# Input:
+#   - points: list of (latency, accuracy)
+#
+# Output:
+#   - set of indices of the points no other point is both faster and more accurate than
+#
+# ================================================================================
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from frame_store import FrameStore
+from train_classifier import REPO_ROOT, split_indices, manifest_indices
+
+
+# ================================================================================
+# build_student
+# ================================================================================
+def build_student(input_shape, n_classes, f1, f2, scale, temperature):
+
+    # === Necessary Imports === #
+    from tensorflow import keras
+
+    inputs = keras.Input(input_shape, name='conv_input')
+    x = inputs
+    if scale > 1:
+        x = keras.layers.AveragePooling2D(pool_size=(scale, scale), name='downscale')(x)
+    x = keras.layers.Rescaling(1.0 / 255, name='rescale')(x)
+    x = keras.layers.Conv2D(f1, kernel_size=(3, 3), activation='relu', name='conv_layer_1')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2), name='maxpool_1')(x)
+    x = keras.layers.Conv2D(f2, kernel_size=(3, 3), activation='relu', name='conv_layer_2')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2), name='maxpool_2')(x)
+    x = keras.layers.Flatten()(x)
+    logits = keras.layers.Dense(n_classes, name='logits')(x)
+
+    # === Regular and Softened Outputs of the Same Logits === #
+    probs = keras.layers.Activation('softmax', name='probs')(logits)
+    soft = keras.layers.Activation('softmax', name='soft')(keras.layers.Rescaling(1.0 / temperature)(logits))
+
+    train_model = keras.Model(inputs, [soft, probs])
+    deploy_model = keras.Model(inputs, probs)
+    return train_model, deploy_model
+
+
+# ================================================================================
+# teacher_targets
+# ================================================================================
+def teacher_targets(teacher, store, indices, temperature, batch_size=512):
+    out = np.empty((len(indices), teacher.output_shape[-1]), dtype=np.float32)
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start:start + batch_size]
+        frames = store.get_frames(batch)[..., np.newaxis].astype(np.float32)
+        out[start:start + len(batch)] = teacher.predict_on_batch(frames)
+
+    # === Soften: softmax(z / T) == p^(1/T) / sum(p^(1/T)) === #
+    soft = np.power(np.clip(out, 1e-12, 1.0), 1.0 / temperature)
+    return soft / soft.sum(axis=1, keepdims=True)
+
+
+# ================================================================================
+# predict_labels
+# ================================================================================
+def predict_labels(model, store, indices, batch_size=512):
+    preds = np.empty(len(indices), dtype=np.int64)
+    for start in range(0, len(indices), batch_size):
+        frames = store.get_frames(indices[start:start + batch_size])[..., np.newaxis].astype(np.float32)
+        preds[start:start + len(frames)] = np.argmax(model.predict_on_batch(frames), axis=1)
+    return preds
+
+
+# ================================================================================
+# measure
+# ================================================================================
+def measure(model, store, indices, teacher_pred, iterations=200):
+
+    # === Necessary Imports === #
+    import tensorflow as tf
+
+    # === Accuracy and Agreement in Large Batches === #
+    preds = predict_labels(model, store, indices)
+    accuracy = float(np.mean(preds == store.labels[indices]))
+    agreement = float(np.mean(preds == teacher_pred)) if teacher_pred is not None else 1.0
+
+    # === Single-Frame CPU Latency the Way RLAgent Calls the Model (Pinned to the CPU on GPU Rigs) === #
+    predict = tf.function(model, reduce_retracing=True)
+    frame = store.get_frames(indices[:1])[..., np.newaxis].astype(np.float32)
+    timings = list()
+    with tf.device('/CPU:0'):
+        for _ in range(10):
+            predict(frame, training=False).numpy()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            predict(frame, training=False).numpy()
+            timings.append(time.perf_counter() - start)
+
+    return accuracy, agreement, preds, float(np.median(timings)) * 1000
+
+
+# ================================================================================
+# pareto_front
+# ================================================================================
+def pareto_front(points):
+    front = set()
+    for i, (latency, accuracy) in enumerate(points):
+        dominated = any(l <= latency and a >= accuracy and (l, a) != (latency, accuracy) for l, a in points)
+        if not dominated:
+            front.add(i)
+    return front
+
+
+# ================================================================================
+# main
+# ================================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Distill the frame classifier into smaller CPU students')
+    parser.add_argument('store_dir', help='frame store written by build_dataset.py')
+    parser.add_argument('--teacher', default=os.path.join(REPO_ROOT, 'classifier_v4.h5'))
+    parser.add_argument('--students', nargs='+', default=['16,32,1', '8,16,1', '8,16,2', '4,8,2'],
+                        help='student configurations as "f1,f2,scale"')
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.7, help='weight of the teacher loss against the label loss')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--patience', type=int, default=3)
+    parser.add_argument('--val-fraction', type=float, default=0.25)
+    parser.add_argument('--manifest', default=None, help='train/val split CSV from dedup_dataset.py')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # === Necessary Imports === #
+    import tensorflow as tf
+
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+
+    # === Data and Teacher Targets (Computed Once) === #
+    store = FrameStore(args.store_dir)
+    if args.manifest is not None:
+        train_idx, val_idx = manifest_indices(args.manifest)
+    else:
+        train_idx, val_idx = split_indices(len(store), args.val_fraction, args.seed)
+    teacher = tf.keras.models.load_model(args.teacher)
+    soft_targets = teacher_targets(teacher, store, train_idx, args.temperature)
+    print('Teacher targets computed for {} frames'.format(len(train_idx)))
+
+    height, width = store.image_shape
+    rng = np.random.RandomState(args.seed)
+
+    # === Training Batches: Frames, (Soft Targets, Hard Labels) === #
+    def batches():
+        order = rng.permutation(len(train_idx))
+        for start in range(0, len(order), args.batch_size):
+            pos = np.sort(order[start:start + args.batch_size])
+            batch = train_idx[pos]
+            yield store.get_frames(batch), (soft_targets[pos], store.labels[batch])
+
+    def to_float(frames, targets):
+        return tf.cast(frames, tf.float32)[..., tf.newaxis], targets
+
+    train = tf.data.Dataset.from_generator(
+        batches, output_signature=(tf.TensorSpec((None, height, width), tf.uint8),
+                                   (tf.TensorSpec((None, soft_targets.shape[1]), tf.float32),
+                                    tf.TensorSpec((None,), tf.uint8))))
+    train = train.map(to_float, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+    # === Measure the Teacher as the Reference Point === #
+    results = list()
+    accuracy, _, teacher_pred, latency = measure(teacher, store, val_idx, None)
+    results.append((os.path.basename(args.teacher), teacher.count_params(), accuracy, 1.0, latency))
+
+    # === Train and Measure Each Student === #
+    for config in args.students:
+        f1, f2, scale = [int(v) for v in config.split(',')]
+        train_model, deploy_model = build_student((height, width, 1), len(store.frame_classes), f1, f2, scale, args.temperature)
+        train_model.compile(optimizer='adam',
+                            loss=[tf.keras.losses.KLDivergence(), tf.keras.losses.SparseCategoricalCrossentropy()],
+                            loss_weights=[args.alpha * args.temperature ** 2, 1.0 - args.alpha])
+
+        # === Early Stopping on Accuracy Against the True Labels === #
+        best = {'accuracy': -1.0, 'weights': None, 'wait': 0}
+        for epoch in range(args.epochs):
+            train_model.fit(train, epochs=1, verbose=0)
+            val_accuracy = float(np.mean(predict_labels(deploy_model, store, val_idx) == store.labels[val_idx]))
+            print('{} epoch {}: val_accuracy {:.4f}'.format(config, epoch + 1, val_accuracy))
+            if val_accuracy > best['accuracy']:
+                best = {'accuracy': val_accuracy, 'weights': deploy_model.get_weights(), 'wait': 0}
+            else:
+                best['wait'] += 1
+                if best['wait'] >= args.patience:
+                    break
+        deploy_model.set_weights(best['weights'])
+
+        # === Save and Measure === #
+        name = 'classifier_student_{}x{}_s{}.h5'.format(f1, f2, scale)
+        deploy_model.save(os.path.join(REPO_ROOT, name))
+        accuracy, agreement, _, latency = measure(deploy_model, store, val_idx, teacher_pred)
+        results.append((name, deploy_model.count_params(), accuracy, agreement, latency))
+
+    # === Report the Accuracy/Latency Pareto Front === #
+    front = pareto_front([(r[4], r[2]) for r in results])
+    print('\n{:<34} {:>9} {:>9} {:>10} {:>11}  {}'.format('model', 'params', 'accuracy', 'agreement', 'latency ms', 'pareto'))
+    for i in sorted(range(len(results)), key=lambda i: results[i][4]):
+        name, params, accuracy, agreement, latency = results[i]
+        print('{:<34} {:>9} {:>9.4f} {:>10.4f} {:>11.3f}  {}'.format(
+            name, params, accuracy, agreement, latency, '*' if i in front else ''))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# ================================================================================
+# FILE: frame_store.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Reader for the preprocessed frame store written by build_dataset.py. The store
+# is a directory holding a manifest.json and, for every shard, three .npy files:
+#
+#   - shard_<n>_frames.npy:  uint8 (count, 64, 80) grayscale frames, preprocessed
+#                            exactly like RLAgent.frame_to_state
+#   - shard_<n>_labels.npy:  uint8 (count,) class indices (see FRAME_CLASSES)
+#   - shard_<n>_index.npy:   int32 (count,) frame number within the source clip
+#
+# Frames are memory-mapped, so opening even a ~60,000 frame store costs almost
+# nothing and only the batches actually read are paged in.
+#
+# ================================================================================
+# CLASS: FrameStore
+# ================================================================================
+# ATTRIBUTES:
+# ================================================================================
+#
+#   - path:
+#        * directory of the store
+#
+#   - manifest:
+#        * parsed manifest.json
+#
+#   - image_shape:
+#        * (height, width) of every frame
+#
+#   - frame_classes:
+#        * dictionary mapping label indices to class names
+#
+#   - shards:
+#        * list of memory-mapped frame arrays, one per shard
+#
+#   - labels / clip_ids / frame_index:
+#        * per-frame arrays for the whole store (small, held in memory)
+#
+#   - offsets:
+#        * index of the first frame of each shard within the store
+#
+# ================================================================================
+# MEMBER FUNCTION: FrameStore.get_frames( indices )
+# ================================================================================
+#
+# Input:
+#   - indices:
+#        * array of frame indices within the whole store
+#
+# Output:
+#   - uint8 array of shape (len(indices), height, width)
+#
+# Task:
+#   - gather the frames from the shards they live in. Indices are visited in
+#     sorted order within each shard so reads from the memory map stay sequential.
+#
+# ================================================================================
+import os
+import json
+import numpy as np
+
+
+class FrameStore:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), 'r') as infile:
+            self.manifest = json.load(infile)
+
+        self.image_shape = tuple(self.manifest['image_shape'])
+        self.frame_classes = {int(k): v for k, v in self.manifest['classes'].items()}
+
+        # === Memory-Map Frames, Load the Small Per-Frame Arrays === #
+        self.shards = list()
+        labels, clip_ids, frame_index = list(), list(), list()
+        for shard in self.manifest['shards']:
+            self.shards.append(np.load(os.path.join(path, shard['frames']), mmap_mode='r'))
+            labels.append(np.load(os.path.join(path, shard['labels'])))
+            frame_index.append(np.load(os.path.join(path, shard['index'])))
+            clip_ids.append(np.full(shard['count'], shard['clip_id'], dtype=np.int32))
+
+        self.labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.uint8)
+        self.clip_ids = np.concatenate(clip_ids) if clip_ids else np.zeros(0, dtype=np.int32)
+        self.frame_index = np.concatenate(frame_index) if frame_index else np.zeros(0, dtype=np.int32)
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+        return
+
+    # ============================================================================
+    # FrameStore.__len__
+    # ============================================================================
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    # ============================================================================
+    # FrameStore.get_frames( indices )
+    # ============================================================================
+    def get_frames(self, indices):
+        indices = np.asarray(indices)
+        out = np.empty((len(indices),) + self.image_shape, dtype=np.uint8)
+
+        # === Gather Shard by Shard === #
+        shard_of = np.searchsorted(self.offsets, indices, side='right') - 1
+        for shard in np.unique(shard_of):
+            positions = np.nonzero(shard_of == shard)[0]
+            local = indices[positions] - self.offsets[shard]
+            order = np.argsort(local)
+            out[positions[order]] = self.shards[shard][local[order]]
+
+        return out
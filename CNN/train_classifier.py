@@ -0,0 +1,241 @@
+# ================================================================================
+# FILE: train_classifier.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Reproducible command line trainer for the frame classifier, replacing the
+# load-everything-into-RAM cells of construct_frame_classifier.ipynb. Frames are
+# streamed from the memory-mapped store written by build_dataset.py through a
+# shuffled, batched, prefetching tf.data pipeline. They stay uint8 on disk and
+# in the pipeline and are converted to float only on the way into the model.
+#
+# The network is the same as the notebook's (two 3x3 conv + 2x2 maxpool blocks,
+# flatten, 9-way softmax) and, like the notebook, it is fed raw 0-255 pixel
+# values, so the result is a drop-in replacement for classifier_v4.h5. Training
+# stops early once validation accuracy stops improving and the best weights are
+# saved as the next free classifier_vN.h5 in the repository root, which
+# RLAgent(classifier_file=...) or `python main.py --classifier` can load.
+#
+# Usage:
+#   python CNN/train_classifier.py <store_dir> [--epochs N] [--batch-size N]
+#                                  [--patience N] [--threads N] [--seed N]
+#                                  [--augment] [--flip-prob P] [--brightness N]
+#                                  [--max-shift N] [--output FILE]
+#
+# --augment mirrors frames with their paired labels and adds brightness/shift
+# jitter to the training batches (see augmentation.py).
+#
+# --manifest trains on the deduplicated, clip-block split written by
+# dedup_dataset.py instead of a random split of every frame.
+#
+# A store built with build_dataset.py --crops holds lookahead bands instead of
+# whole frames, and trains the classifier for `python main.py --lookahead
+# --classifier FILE`. Use a --manifest split with it, because the bands of one
+# frame would otherwise land on both sides of a random split.
+#
+# ================================================================================
+# Function: build_model( input_shape , n_classes )
+# ================================================================================
+#
+# Output:
+#   - compiled keras model with the notebook's architecture
+#
+# ================================================================================
+# Function: split_indices( n_frames , val_fraction , seed )
+# ================================================================================
+#
+# Output:
+#   - (train_indices, val_indices) of a seeded random split
+#
+# ================================================================================
+# Function: manifest_indices( path )
+# ================================================================================
+#
+# Output:
+#   - (train_indices, val_indices) listed in a store manifest from dedup_dataset.py
+#
+# ================================================================================
+# Function: make_dataset( store , indices , batch_size , shuffle , seed , augment )
+# ================================================================================
+#
+# Input:
+#   - store:      FrameStore to read from
+#   - indices:    frame indices making up the dataset
+#   - batch_size: frames per batch
+#   - shuffle:    reshuffle the indices every epoch
+#   - seed:       seed of the shuffle (and of the augmentation)
+#   - augment:    None, or a function (frames, labels, rng) -> (frames, labels)
+#                 applied to every uint8 batch
+#
+# Output:
+#   - tf.data.Dataset of (float32 frames (B, H, W, 1), labels) batches
+#
+# Task:
+#   - a Python generator gathers uint8 batches from the memory map
+#   - the uint8 -> float32 conversion runs as a parallel map inside tf.data
+#   - batches are prefetched so reading overlaps with training
+#
+# ================================================================================
+# Function: next_classifier_file( directory )
+# ================================================================================
+#
+# Output:
+#   - path of the first classifier_vN.h5 in directory that does not exist yet
+#
+# ================================================================================
+import os
+import re
+import sys
+import csv
+import time
+import argparse
+import numpy as np
+
+from frame_store import FrameStore
+from augmentation import augment_batch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ================================================================================
+# build_model
+# ================================================================================
+def build_model(input_shape, n_classes):
+
+    # === Necessary Imports === #
+    from tensorflow import keras
+
+    model = keras.Sequential(layers=[
+        keras.Input(input_shape, name='conv_input'),
+        keras.layers.Conv2D(32, kernel_size=(3, 3), activation='relu', name='conv_layer_1'),
+        keras.layers.MaxPooling2D(pool_size=(2, 2), name='maxpool_1'),
+        keras.layers.Conv2D(64, kernel_size=(3, 3), activation='relu', name='conv_layer_2'),
+        keras.layers.MaxPooling2D(pool_size=(2, 2), name='maxpool_2'),
+        keras.layers.Flatten(),
+        keras.layers.Dense(n_classes, activation='softmax')
+    ])
+    model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
+    return model
+
+
+# ================================================================================
+# split_indices
+# ================================================================================
+def split_indices(n_frames, val_fraction, seed):
+    order = np.random.RandomState(seed).permutation(n_frames)
+    n_val = int(round(n_frames * val_fraction))
+    return np.sort(order[n_val:]), np.sort(order[:n_val])
+
+
+# ================================================================================
+# manifest_indices
+# ================================================================================
+def manifest_indices(path):
+    train, val = list(), list()
+    with open(path, 'r', newline='') as infile:
+        for row in csv.DictReader(infile):
+            (train if row['split'] == 'train' else val).append(int(row['source']))
+    return np.array(train, dtype=np.int64), np.array(val, dtype=np.int64)
+
+
+# ================================================================================
+# make_dataset
+# ================================================================================
+def make_dataset(store, indices, batch_size, shuffle, seed, augment=None):
+
+    # === Necessary Imports === #
+    import tensorflow as tf
+
+    height, width = store.image_shape
+    rng = np.random.RandomState(seed)
+
+    # === Gather uint8 Batches from the Memory Map === #
+    def batches():
+        order = rng.permutation(indices) if shuffle else indices
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            frames, labels = store.get_frames(batch), store.labels[batch]
+            if augment is not None:
+                frames, labels = augment(frames, labels, rng)
+            yield frames, labels
+
+    dataset = tf.data.Dataset.from_generator(
+        batches,
+        output_signature=(tf.TensorSpec((None, height, width), tf.uint8),
+                          tf.TensorSpec((None,), tf.uint8)))
+
+    # === Convert to Float On the Fly (Raw 0-255 Values, as in the Notebook) === #
+    def to_float(frames, labels):
+        return tf.cast(frames, tf.float32)[..., tf.newaxis], labels
+
+    return dataset.map(to_float, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+# ================================================================================
+# next_classifier_file
+# ================================================================================
+def next_classifier_file(directory):
+    versions = [int(m.group(1)) for m in (re.match(r'classifier_v(\d+)\.h5$', f) for f in os.listdir(directory)) if m]
+    version = max(versions + [1]) + 1
+    return os.path.join(directory, 'classifier_v{}.h5'.format(version))
+
+
+# ================================================================================
+# main
+# ================================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Train the frame classifier from a frame store')
+    parser.add_argument('store_dir', help='frame store written by build_dataset.py')
+    parser.add_argument('--epochs', type=int, default=100, help='maximum number of epochs')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--val-fraction', type=float, default=0.25, help='fraction of frames held out for validation')
+    parser.add_argument('--patience', type=int, default=5, help='epochs without val_accuracy improvement before stopping')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='CPU threads for training ops')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--manifest', default=None, help='train/val split CSV from dedup_dataset.py (run on the same store)')
+    parser.add_argument('--augment', action='store_true', help='mirror/jitter training batches on the fly')
+    parser.add_argument('--flip-prob', type=float, default=0.5, help='with --augment, chance of mirroring a frame')
+    parser.add_argument('--brightness', type=int, default=20, help='with --augment, maximum brightness offset')
+    parser.add_argument('--max-shift', type=int, default=2, help='with --augment, maximum shift in pixels')
+    parser.add_argument('--output', default=None, help='output .h5 (default: next free classifier_vN.h5 in the repository root)')
+    args = parser.parse_args()
+
+    # === Necessary Imports === #
+    import tensorflow as tf
+
+    # === Reproducibility and Multi-Core CPU Training === #
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(max(2, args.threads // 2))
+
+    # === Datasets === #
+    store = FrameStore(args.store_dir)
+    if args.manifest is not None:
+        train_idx, val_idx = manifest_indices(args.manifest)
+    else:
+        train_idx, val_idx = split_indices(len(store), args.val_fraction, args.seed)
+    augment = None
+    if args.augment:
+        augment = lambda frames, labels, rng: augment_batch(frames, labels, rng, args.flip_prob,
+                                                            args.brightness, args.max_shift)
+    train = make_dataset(store, train_idx, args.batch_size, True, args.seed, augment)
+    val = make_dataset(store, val_idx, args.batch_size, False, args.seed)
+    print('Training on {} frames, validating on {}'.format(len(train_idx), len(val_idx)))
+
+    # === Train with Early Stopping === #
+    model = build_model(store.image_shape + (1,), len(store.frame_classes))
+    early_stop = tf.keras.callbacks.EarlyStopping(monitor='val_accuracy', patience=args.patience,
+                                                  restore_best_weights=True)
+    start = time.time()
+    history = model.fit(train, validation_data=val, epochs=args.epochs, callbacks=[early_stop], verbose=2)
+
+    # === Save the Best Weights as the Next Classifier Version === #
+    output = args.output if args.output is not None else next_classifier_file(REPO_ROOT)
+    model.save(output)
+    print('Best val_accuracy {:.4f} after {} epochs ({:.0f}s). Saved {}'.format(
+        max(history.history['val_accuracy']), len(history.history['val_accuracy']), time.time() - start, output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
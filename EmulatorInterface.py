@@ -1,3 +1,5 @@
+import os
+import json
 import time
 import keyboard
 
@@ -8,10 +10,25 @@ class EmulatorInterface:
             This is a string that represents the name
             of the emulator that you're going to be simulating
             the key presses for. It is not case sensitive
+
+        :param keyMapping:
+            Optional dictionary of input names to keys that overrides
+            the default mapping for this emulator and game. When several
+            emulator instances run side by side, each instance is bound
+            to its own keys so that presses are routed to the right one.
+
+        :param holdFile:
+            JSON file of calibrated hold times (see KeyCalibration.py).
+            Keys without a calibrated hold are held for defaultHoldTime.
     '''
-    def __init__(self, emulator, game):
+    defaultHoldTime = 0.15 # The hold Mupen 64 was tuned with by hand
+
+    def __init__(self, emulator, game, keyMapping = None, holdFile = "key_holds.json"):
         emulator = emulator.lower() # Converts the string to all lower case
         game = game.lower() # Converts the string to all lower case
+        self.emulator = emulator
+        self.game = game
+        self.holdFile = holdFile
         '''
             This is the input mapping dictionary. The first
             parameter is the name of the emulator you're using.
@@ -53,7 +70,10 @@ class EmulatorInterface:
                     }
                 }
             }
-        self.currentEmulatorMapping = self.inputMapping[emulator][game] # Here we keep track of the emulator inputs we need for a game
+        self.currentEmulatorMapping = dict(self.inputMapping[emulator][game]) # Here we keep track of the emulator inputs we need for a game
+        if keyMapping is not None:
+            self.currentEmulatorMapping.update(keyMapping) # Per-instance keys replace the defaults
+        self.holdTimes = self.loadHoldTimes() # Calibrated hold of each key, in seconds
 
     '''
         :desc:
@@ -68,7 +88,7 @@ class EmulatorInterface:
     def emulatePress(self, input):
         if input in self.currentEmulatorMapping: # Checks to see if the input mapping exists
             inputMapping = self.currentEmulatorMapping[input] # Grabs the mapping
-            self.holdKey(inputMapping, 0.15)
+            self.holdKey(inputMapping, self.getHoldTime(inputMapping))
         else: # If there was no input mapping
             print("Not a valid input mapping") # Alert the user before quitting
             exit(-1) # Quits the program
@@ -121,11 +141,12 @@ class EmulatorInterface:
 
         '''
             Loops through the current mapped inputs and holds
-            them down for 0.15 seconds (the minimum amount of time that
-            the emulator will need in order for a key to be registered.)
+            them down for the minimum amount of time that the
+            emulator needs in order for each key to be registered
+            (calibrated, or 0.15 seconds by default.)
         '''
         for key in mappedInputs:
-            self.holdKey(key, 0.15) # Holds the current key
+            self.holdKey(key, self.getHoldTime(key)) # Holds the current key
 
     '''
         :desc:
@@ -174,4 +195,60 @@ class EmulatorInterface:
         if mappings: # If the user wants the mappings then return them
             return self.currentEmulatorMapping
         else: # Else, just give us the list of values the emulator can accept as inputs for presses
-            return [x[0] for x in self.currentEmulatorMapping.items()]
\ No newline at end of file
+            return [x[0] for x in self.currentEmulatorMapping.items()]
+
+    '''
+        :desc:
+            Reads the calibrated hold times of this emulator
+            and game from the hold file. The file is nested like
+            inputMapping and keyed by the bound key:
+
+                {"mupen 64": {"mario kart": {"x": 0.04, "l": 0.035}}}
+
+        :returns:
+            A dictionary of keys to hold times in seconds
+            (empty if nothing was calibrated yet)
+    '''
+    def loadHoldTimes(self):
+        if self.holdFile is None or not os.path.exists(self.holdFile):
+            return {}
+        with open(self.holdFile, "r") as infile:
+            return dict(json.load(infile).get(self.emulator, {}).get(self.game, {}))
+
+    '''
+        :desc:
+            Returns how long a key is held down for, in seconds.
+
+        :param key:
+            The bound key (not the input name)
+    '''
+    def getHoldTime(self, key):
+        return self.holdTimes.get(key, self.defaultHoldTime)
+
+    '''
+        :desc:
+            Sets the hold time of an input's key, e.g.
+            after it has been calibrated.
+
+        :param input:
+            The input name, such as "throttle"
+
+        :param holdTime:
+            The new hold time in seconds
+    '''
+    def setHoldTime(self, input, holdTime):
+        self.holdTimes[self.currentEmulatorMapping[input]] = holdTime
+
+    '''
+        :desc:
+            Writes the current hold times into the hold file,
+            keeping the entries of other emulators, games and keys.
+    '''
+    def saveHoldTimes(self):
+        allHolds = {}
+        if os.path.exists(self.holdFile):
+            with open(self.holdFile, "r") as infile:
+                allHolds = json.load(infile)
+        allHolds.setdefault(self.emulator, {}).setdefault(self.game, {}).update(self.holdTimes)
+        with open(self.holdFile, "w") as outfile:
+            json.dump(allHolds, outfile, indent=4, sort_keys=True)
\ No newline at end of file
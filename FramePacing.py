@@ -0,0 +1,294 @@
+# ================================================================================
+# FILE: FramePacing.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Pacing of the control loop. Window drives the loop with a QTimer firing every
+# 1000 / fps ms. When a tick takes longer than that, Qt does not queue the
+# missed timeouts: the next tick simply starts late, so the loop silently runs
+# slower than asked. A FramePacer times every tick and the interval between
+# tick starts, and counts each deadline that passed without a tick as a drop.
+# Fractions of a period carry over between ticks, so a loop that is steadily
+# a little late accumulates its drops.
+#
+# With adapt=True it also adjusts the rate every `window` ticks towards the
+# highest sustainable one. That rate lets the 95th percentile tick use at most
+# `utilization` of the period, capped at max_fps. After a window with drops,
+# the rate backs off by 20% at once. Otherwise it climbs by `step` fps per
+# window. The worst-case age of a game frame when the agent acts on it is
+# about one period plus one tick. When that exceeds latency_budget even at the
+# adapted rate, the pacer reports it as over budget.
+#
+# FrameScheduler ties decisions to the frames the emulator actually produces
+# rather than to the capture timer. The screen is polled faster than the game
+# draws. A cheap signature of each capture (every step-th pixel, checksummed)
+# tells whether the game has produced a new frame since the last capture.
+# Unchanged captures are skipped. On a new frame the agent decides, or, with
+# repeat=K, it decides on every K-th new frame and repeats its last action on
+# the ones in between.
+#
+# ================================================================================
+# CLASS: FramePacer
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - max_fps (optional):
+#        * Default = 30, the rate asked for (and the ceiling when adapting)
+#   - min_fps (optional):
+#        * Default = 5, the floor when adapting
+#   - adapt (optional):
+#        * Default = False (measure only)
+#   - utilization (optional):
+#        * Default = 0.8, share of the period the 95th percentile tick may use
+#   - latency_budget (optional):
+#        * Default = 0.1 seconds, see over_budget in metrics()
+#   - window (optional):
+#        * Default = 30, ticks per measurement (and adaptation) window
+#   - step (optional):
+#        * Default = 1.0 fps, increase per window without drops
+#
+# ================================================================================
+# MEMBER FUNCTION: FramePacer.tick_start( ) / FramePacer.tick_end( )
+# ================================================================================
+#
+# Task:
+#   - called around every tick of the loop; tick_start counts the deadlines
+#     missed since the previous tick
+#   - tick_end returns True when the rate was adapted, i.e. the timer's interval
+#     must be set to interval_ms
+#
+# ================================================================================
+# MEMBER FUNCTION: FramePacer.metrics( ) / FramePacer.status( )
+# ================================================================================
+#
+# Output:
+#   - dictionary of the target and achieved fps, jitter (standard deviation of
+#     the interval between ticks), mean and 95th percentile tick time, drops,
+#     ticks, estimated decision latency and whether it is over budget
+#   - one-line summary of them for the status bar
+#
+# ================================================================================
+# CLASS: FrameScheduler
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - repeat (optional):
+#        * Default = 1 (decide on every new frame)
+#        * K: decide on every K-th new frame, repeat the action on the others
+#   - step (optional):
+#        * Default = 8, keep every step-th pixel for the signature
+#   - threshold (optional):
+#        * Default = 0 (any change of the sampled pixels is a new frame)
+#        * otherwise the mean absolute difference of the sampled pixels (0-255)
+#          above which a capture counts as a new frame
+#
+# ================================================================================
+# MEMBER FUNCTION: FrameScheduler.act( agent , frame )
+# ================================================================================
+#
+# Output:
+#   - None if the capture shows the same game frame as the last one, else the
+#     agent's action (decided now, or repeated from the last decision)
+#
+# ================================================================================
+# MEMBER FUNCTION: FrameScheduler.rates( ) / FrameScheduler.status( )
+# ================================================================================
+#
+# Output:
+#   - captures, new frames, decisions and repeated actions per second since the
+#     first capture
+#   - one-line summary of them for the status bar
+#
+# ================================================================================
+import time
+import zlib
+from collections import deque
+import numpy as np
+
+
+class FramePacer:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, max_fps=30, min_fps=5, adapt=False, utilization=0.8, latency_budget=0.1, window=30, step=1.0):
+        self.max_fps = max_fps
+        self.min_fps = min_fps
+        self.fps = max_fps
+        self.adapt = adapt
+        self.utilization = utilization
+        self.latency_budget = latency_budget
+        self.window = window
+        self.step = step
+        self.durations = deque(maxlen=window)
+        self.intervals = deque(maxlen=window)
+        self.last_start = None
+        self.ticks = 0
+        self.drops = 0
+        self.window_drops = 0
+        self.debt = 0.0
+        self.adaptations = 0
+        return
+
+    # ============================================================================
+    # FramePacer.interval_ms -- timer interval of the current rate
+    # ============================================================================
+    @property
+    def interval_ms(self):
+        return max(1, int(round(1000 / self.fps)))
+
+    # ============================================================================
+    # FramePacer.tick_start( )
+    # ============================================================================
+    def tick_start(self):
+        now = time.perf_counter()
+        if self.last_start is not None:
+            interval = now - self.last_start
+            self.intervals.append(interval)
+
+            # === Periods Elapsed Beyond the One Expected are Missed Deadlines === #
+            self.debt = max(-1.0, self.debt + interval * 1000 / self.interval_ms - 1)
+            missed = int(self.debt) if self.debt >= 1 else 0
+            self.debt -= missed
+            self.drops += missed
+            self.window_drops += missed
+        self.last_start = now
+        return
+
+    # ============================================================================
+    # FramePacer.tick_end( )
+    # ============================================================================
+    def tick_end(self):
+        self.durations.append(time.perf_counter() - self.last_start)
+        self.ticks += 1
+        if self.adapt and self.ticks % self.window == 0:
+            return self.adapt_rate()
+        return False
+
+    # ============================================================================
+    # FramePacer.adapt_rate( ) -- back off on drops, otherwise climb
+    # ============================================================================
+    def adapt_rate(self):
+        interval = self.interval_ms
+        sustainable = min(self.max_fps, self.utilization / max(np.percentile(self.durations, 95), 1e-4))
+        if self.window_drops > 0:
+            self.fps = max(self.min_fps, min(self.fps * 0.8, sustainable))
+        else:
+            self.fps = max(self.min_fps, min(self.fps + self.step, sustainable))
+        self.window_drops = 0
+        if self.interval_ms != interval:
+            self.adaptations += 1
+            return True
+        return False
+
+    # ============================================================================
+    # FramePacer.metrics( )
+    # ============================================================================
+    def metrics(self):
+        intervals = np.array(self.intervals) if self.intervals else np.zeros(1)
+        durations = np.array(self.durations) if self.durations else np.zeros(1)
+        latency = 1 / self.fps + np.percentile(durations, 95)
+        return {
+            'target_fps': 1000 / self.interval_ms,
+            'achieved_fps': float(len(self.intervals) / intervals.sum()) if intervals.sum() > 0 else 0.0,
+            'jitter_ms': float(intervals.std() * 1000),
+            'tick_ms': float(durations.mean() * 1000),
+            'tick_p95_ms': float(np.percentile(durations, 95) * 1000),
+            'drops': self.drops,
+            'ticks': self.ticks,
+            'adaptations': self.adaptations,
+            'latency_ms': float(latency * 1000),
+            'over_budget': bool(latency > self.latency_budget)
+        }
+
+    # ============================================================================
+    # FramePacer.status( )
+    # ============================================================================
+    def status(self):
+        m = self.metrics()
+        return 'Rate: {:.1f}/{:.0f} fps  Jitter: {:.1f} ms  Drops: {}{}'.format(
+            m['achieved_fps'], m['target_fps'], m['jitter_ms'], m['drops'], '  OVER LATENCY BUDGET' if m['over_budget'] else '')
+
+
+class FrameScheduler:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, repeat=1, step=8, threshold=0.0):
+        self.repeat = repeat
+        self.step = step
+        self.threshold = threshold
+        self.previous = None
+        self.action = None
+        self.counts = {'captures': 0, 'new_frames': 0, 'decisions': 0, 'repeats': 0}
+        self.started = None
+        return
+
+    # ============================================================================
+    # FrameScheduler.sample( frame ) -- every step-th pixel of the capture
+    # ============================================================================
+    def sample(self, frame):
+        if isinstance(frame, np.ndarray):
+            if frame.ndim == 2:
+                return np.ascontiguousarray(frame[::self.step, ::self.step]) # Grayscale ring frames
+            return np.ascontiguousarray(frame[::self.step, ::self.step, 1]) # Green channel of BGR(A)
+
+        # === PIL Captures: a Nearest-Neighbour Resize Samples the Same Way === #
+        from PIL import Image
+        size = (max(1, frame.width // self.step), max(1, frame.height // self.step))
+        return np.asarray(frame.resize(size, Image.NEAREST).getchannel(1))
+
+    # ============================================================================
+    # FrameScheduler.is_new_frame( frame )
+    # ============================================================================
+    def is_new_frame(self, frame):
+        sample = self.sample(frame)
+        if self.threshold > 0:
+            signature = sample.astype(np.int16)
+            new = self.previous is None or np.abs(signature - self.previous).mean() > self.threshold
+        else:
+            signature = zlib.crc32(sample)
+            new = signature != self.previous
+        if new:
+            self.previous = signature
+        return new
+
+    # ============================================================================
+    # FrameScheduler.act( agent , frame )
+    # ============================================================================
+    def act(self, agent, frame):
+        if self.started is None:
+            self.started = time.perf_counter()
+        self.counts['captures'] += 1
+        if not self.is_new_frame(frame):
+            return None
+
+        # === Decide on Every repeat-th New Frame, Repeat the Action Otherwise === #
+        self.counts['new_frames'] += 1
+        if self.action is None or (self.counts['new_frames'] - 1) % self.repeat == 0:
+            self.action = agent.act(frame)
+            self.counts['decisions'] += 1
+        else:
+            self.counts['repeats'] += 1
+        return self.action
+
+    # ============================================================================
+    # FrameScheduler.rates( )
+    # ============================================================================
+    def rates(self):
+        elapsed = max(1e-9, time.perf_counter() - self.started) if self.started is not None else 1.0
+        return {name + '_per_s': count / elapsed for name, count in self.counts.items()}
+
+    # ============================================================================
+    # FrameScheduler.status( )
+    # ============================================================================
+    def status(self):
+        rates = self.rates()
+        return 'Captures: {:.1f}/s  New frames: {:.1f}/s  Decisions: {:.1f}/s'.format(
+            rates['captures_per_s'], rates['new_frames_per_s'], rates['decisions_per_s'])
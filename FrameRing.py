@@ -0,0 +1,230 @@
+# ================================================================================
+# FILE: FrameRing.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# A ring of preallocated frame slots in multiprocessing.shared_memory, used to
+# move screen capture into its own process. The capture process writes each
+# frame into the next slot together with a sequence number and a timestamp; the
+# agent process reads the newest slot as a numpy view of the shared block, so
+# frames are never copied or pickled between the processes.
+#
+# Timestamps come from time.perf_counter(), which is a system-wide clock on both
+# Windows (QueryPerformanceCounter) and Linux (CLOCK_MONOTONIC), so the age of a
+# frame can be computed in the reading process.
+#
+# ================================================================================
+# SHARED BLOCK LAYOUT
+# ================================================================================
+#
+#   - int64 latest:               sequence number of the newest complete frame
+#                                 (-1 before the first write)
+#   - int64 slot_seq[n_slots]:    sequence number held by each slot (-1 = being written)
+#   - float64 slot_time[n_slots]: capture timestamp of each slot
+#   - uint8 slots[n_slots, *frame_shape]
+#
+# ================================================================================
+# CLASS: FrameRing
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - frame_shape:
+#        * shape of a single frame, e.g. (64, 80) for preprocessed frames or
+#          (683, 900, 4) for full-resolution BGRA captures
+#   - n_slots (optional):
+#        * Default = 8
+#        * number of frames the ring holds. A frame read by the agent stays valid
+#          until the capture process has written n_slots more frames.
+#   - name (optional):
+#        * Default = None
+#        * if None, a new shared block is created (the owning side)
+#        * otherwise, the existing block with that name is attached to
+#
+# ================================================================================
+# MEMBER FUNCTION: FrameRing.write( frame , timestamp )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * numpy array of frame_shape (uint8)
+#   - timestamp (optional):
+#        * Default = time.perf_counter() at the time of the call
+#
+# Output:
+#   - the sequence number assigned to the frame
+#
+# Task:
+#   - mark the next slot as being written, copy the frame in, then publish its
+#     sequence number and timestamp
+#
+# ================================================================================
+# MEMBER FUNCTION: FrameRing.read_latest( )
+# ================================================================================
+#
+# Output:
+#   - (frame, seq, timestamp) for the newest complete frame, where frame is a view
+#     into the shared block
+#   - (None, -1, 0.0) if nothing has been written yet
+#
+# ================================================================================
+# MEMBER FUNCTION: FrameRing.is_valid( seq )
+# ================================================================================
+#
+# Output:
+#   - True if the slot that held frame seq has not been overwritten since it was read
+#
+# ================================================================================
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class FrameRing:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, frame_shape, n_slots=8, name=None):
+        self.frame_shape = tuple(frame_shape)
+        self.n_slots = n_slots
+        self.is_owner = name is None
+
+        # === Compute the Layout of the Shared Block === #
+        header_size = 8 + 8 * n_slots + 8 * n_slots
+        frame_size = int(np.prod(self.frame_shape))
+        total_size = header_size + frame_size * n_slots
+
+        # === Create or Attach to the Shared Block === #
+        if self.is_owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=total_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        # === Numpy Views over the Block === #
+        buf = self.shm.buf
+        self.latest = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=0)
+        self.slot_seq = np.ndarray((n_slots,), dtype=np.int64, buffer=buf, offset=8)
+        self.slot_time = np.ndarray((n_slots,), dtype=np.float64, buffer=buf, offset=8 + 8 * n_slots)
+        self.slots = np.ndarray((n_slots,) + self.frame_shape, dtype=np.uint8, buffer=buf, offset=header_size)
+
+        # === A New Ring Starts Empty === #
+        if self.is_owner:
+            self.latest[0] = -1
+            self.slot_seq[:] = -1
+        self.next_seq = 0
+
+        return
+
+    # ============================================================================
+    # FrameRing.write( frame , timestamp=None )
+    # ============================================================================
+    def write(self, frame, timestamp=None):
+        seq = self.next_seq
+        slot = seq % self.n_slots
+
+        # === Invalidate, Fill, then Publish the Slot === #
+        self.slot_seq[slot] = -1
+        self.slots[slot] = frame
+        self.slot_time[slot] = time.perf_counter() if timestamp is None else timestamp
+        self.slot_seq[slot] = seq
+        self.latest[0] = seq
+
+        self.next_seq += 1
+        return seq
+
+    # ============================================================================
+    # FrameRing.read_latest( )
+    # ============================================================================
+    def read_latest(self):
+        seq = int(self.latest[0])
+        if seq < 0:
+            return None, -1, 0.0
+
+        slot = seq % self.n_slots
+        timestamp = float(self.slot_time[slot])
+
+        # === The Writer Lapped the Ring Between the Two Reads === #
+        if self.slot_seq[slot] != seq:
+            return self.read_latest()
+
+        return self.slots[slot], seq, timestamp
+
+    # ============================================================================
+    # FrameRing.is_valid( seq )
+    # ============================================================================
+    def is_valid(self, seq):
+        return seq >= 0 and self.slot_seq[seq % self.n_slots] == seq
+
+    # ============================================================================
+    # FrameRing.close( )
+    # ============================================================================
+    def close(self):
+
+        # === Drop the Views Before Releasing the Buffer === #
+        del self.latest, self.slot_seq, self.slot_time, self.slots
+        self.shm.close()
+        if self.is_owner:
+            self.shm.unlink()
+        return
+
+
+# ================================================================================
+# Function: capture_process( ring_name , frame_shape , n_slots , viewport , rate , stop_event )
+# ================================================================================
+#
+# Input:
+#   - ring_name:
+#        * name of the FrameRing shared block created by the agent process
+#   - frame_shape:
+#        * shape of the ring's slots. A 2D shape means frames are preprocessed with
+#          frame_processing.preprocess_frame (grayscale, 80x64) before being written;
+#          otherwise the raw BGRA capture is written at full resolution
+#   - n_slots:
+#        * number of slots in the ring
+#   - viewport:
+#        * mss viewport dictionary of the region to capture
+#   - rate:
+#        * captures per second
+#   - stop_event:
+#        * multiprocessing.Event that ends the loop when set
+#
+# Task:
+#   - Run as the target of a multiprocessing.Process. Grab, optionally preprocess
+#     and publish a frame every 1/rate seconds until told to stop.
+#
+# ================================================================================
+def capture_process(ring_name, frame_shape, n_slots, viewport, rate, stop_event):
+
+    # === Necessary Imports (Done in the Child Process) === #
+    from mss import mss
+    from frame_processing import preprocess_frame
+
+    ring = FrameRing(frame_shape, n_slots, name=ring_name)
+    recorder = mss()
+    interval = 1.0 / rate
+    preprocess = len(frame_shape) == 2
+
+    # === Capture Loop === #
+    next_tick = time.perf_counter()
+    while not stop_event.is_set():
+        timestamp = time.perf_counter()
+        grab = recorder.grab(viewport)
+        pixels = np.frombuffer(grab.raw, dtype=np.uint8).reshape(grab.height, grab.width, 4)
+        if preprocess:
+            pixels = preprocess_frame(pixels, (frame_shape[1], frame_shape[0]))
+        ring.write(pixels, timestamp)
+
+        # === Sleep Until the Next Capture === #
+        next_tick += interval
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_tick = time.perf_counter()
+
+    ring.close()
+    return
@@ -245,6 +245,42 @@
 #            2. Doing this is again reliant on whether we use states at all
 #
 # ================================================================================
+# CLASS: LateralOffsetFeature
+# ================================================================================
+#
+# State-feature provider turning the kart's hitbox into a discretized lateral
+# offset, a finer position signal than the classifier's near_left/center/...
+# classes. The template match runs on a strided grayscale copy of the frame
+# downscaled by `scale` (see frame_array_to_state.gray_downscale), restricted to
+# the band of rows the kart is drawn in, which brings it to a fraction of a
+# millisecond per frame.
+#
+# Input (constructor):
+#   - template_file (optional):
+#        * Default = 'template.png'
+#   - n_bins (optional):
+#        * Default = 5
+#        * number of offset bins. Bin n_bins//2 is the frame center, lower bins are
+#          left of center and higher bins right of it
+#   - max_offset (optional):
+#        * Default = 0.2
+#        * offset (as a fraction of half the frame width) at which the outermost
+#          bins start
+#   - scale (optional):
+#        * Default = 4
+#        * downscale factor of both the frame and the template
+#   - band (optional):
+#        * Default = (0.45, 1.0)
+#        * (top, bottom) fractions of the frame height searched for the kart
+#
+# Calling the provider with a full frame (BGR/BGRA numpy array or PIL image)
+# returns the bin index, an int in range(n_bins). RLAgent(state_features=[...])
+# appends it to the classifier's class in the state key, e.g. ('center', 3).
+#
+# Method offset( frame ) returns the continuous offset of the hitbox center from
+# the frame center, as a fraction of half the frame width (negative = left).
+#
+# ================================================================================
 import cv2
 import numpy as np
 import Graphics as gfx # Imports the custom drawing module I created
@@ -357,4 +393,50 @@ class HitboxFinder:
                         onto the current frame as it's passed through
                         our rendering pipeline.
                 '''
-                gfx.addRect(frame, x, y, w, h, 255, 0, 0) # If the rect it found was in bounds, draw it
\ No newline at end of file
+                gfx.addRect(frame, x, y, w, h, 255, 0, 0) # If the rect it found was in bounds, draw it
+
+
+# ================================================================================
+# LateralOffsetFeature
+# ================================================================================
+class LateralOffsetFeature:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, template_file='template.png', n_bins=5, max_offset=0.2, scale=4, band=(0.45, 1.0)):
+        from frame_array_to_state import gray_downscale
+        self.gray_downscale = gray_downscale
+        self.n_bins = n_bins
+        self.max_offset = max_offset
+        self.scale = scale
+        self.band = band
+
+        # === Downscaled Grayscale Template (Area Average, Matching the Strided Frame's Scale) === #
+        template = cv2.imread(template_file, cv2.IMREAD_GRAYSCALE)
+        height, width = template.shape
+        self.template = cv2.resize(template, (max(1, width // scale), max(1, height // scale)), interpolation=cv2.INTER_AREA)
+        return
+
+    # ============================================================================
+    # LateralOffsetFeature.offset( frame )
+    # ============================================================================
+    def offset(self, frame):
+
+        # === Search Only the Band of Rows the Kart is Drawn In === #
+        small = self.gray_downscale(frame, self.scale)
+        top, bottom = int(small.shape[0] * self.band[0]), int(small.shape[0] * self.band[1])
+        match_heatmap = cv2.matchTemplate(small[top:bottom], self.template, cv2.TM_SQDIFF)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(match_heatmap)
+
+        # === Hitbox Center Relative to the Frame Center === #
+        center_x = min_loc[0] + self.template.shape[1] / 2
+        half_width = small.shape[1] / 2
+        return (center_x - half_width) / half_width
+
+    # ============================================================================
+    # LateralOffsetFeature.__call__( frame ) -> offset bin
+    # ============================================================================
+    def __call__(self, frame):
+        scaled = min(1.0, max(-1.0, self.offset(frame) / self.max_offset))
+        return int(round((scaled + 1) / 2 * (self.n_bins - 1)))
@@ -0,0 +1,233 @@
+# ================================================================================
+# FILE: KeyCalibration.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Calibration of how long each key must be held for the emulator to register it.
+# EmulatorInterface used to hold every key for 0.15 s, a value tuned once for
+# Mupen64, and every decision pays that hold. KeyCalibrator binary-searches the
+# shortest hold that the game reacts to, for each input of an emulator's
+# mapping, by pressing the key and comparing the captured frames before and
+# after the press.
+#
+# Calibration needs a screen that stays still unless a key is pressed and that
+# reacts to every calibrated input, such as a menu (the cursor moves) or the
+# pause screen. The capture noise is measured first from pairs of captures with
+# no key pressed. A press registers when the mean absolute difference between
+# the frames before and after it is well above that noise. A hold only counts
+# as registered when every one of `trials` presses registered.
+#
+# The game reads its inputs once per frame, so a hold shorter than a frame only
+# registers when it happens to span an input poll, and a few lucky trials can
+# pass. The hold the search ends on is therefore confirmed with
+# boundary_trials more presses (and lengthened by `tolerance` until it passes
+# them all), and the result is never shorter than one game frame. The frame
+# interval is measured with a FrameScheduler while the game runs (call
+# measure_frame_interval during a race, or pass frame_interval), and is
+# otherwise assumed to be 1/30 s. The calibrated hold is that result times
+# `margin`, capped at the old 0.15 s default. Inputs that do not register
+# even at `high` keep the default.
+#
+# The holds are saved to key_holds.json, nested like
+# EmulatorInterface.inputMapping (emulator, then game) and keyed by the bound
+# key, so every instance's key binding gets its own holds. EmulatorInterface
+# loads them when it is created.
+#
+# ================================================================================
+# CLASS: KeyCalibrator
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - emulator:
+#        * the EmulatorInterface whose keys are calibrated
+#   - grab:
+#        * function returning a capture of the emulator's viewport (a numpy
+#          array or a PIL image)
+#   - low (optional):
+#        * Default = 0.005 seconds, shortest hold tried
+#   - high (optional):
+#        * Default = 0.3 seconds, longest hold tried
+#   - tolerance (optional):
+#        * Default = 0.005 seconds, the search stops when the bracket is this narrow
+#   - trials (optional):
+#        * Default = 3, presses per tried hold
+#   - boundary_trials (optional):
+#        * Default = 10, presses confirming the hold the search ends on
+#   - frame_interval (optional):
+#        * Default = None (measured by measure_frame_interval, else 1/30 s),
+#          the shortest hold the calibration may return before the margin
+#   - margin (optional):
+#        * Default = 1.25, safety factor applied to the shortest registered hold
+#   - response_time (optional):
+#        * Default = 0.25 seconds, wait after the release before capturing
+#   - noise_factor (optional):
+#        * Default = 4, a press registers above noise_factor times the capture
+#          noise (and at least min_difference)
+#   - min_difference (optional):
+#        * Default = 1.0, mean absolute difference of the sampled pixels (0-255)
+#   - step (optional):
+#        * Default = 4, keep every step-th pixel of the captures
+#
+# ================================================================================
+# MEMBER FUNCTION: KeyCalibrator.registers( input , hold )
+# ================================================================================
+#
+# Output:
+#   - True if every one of the trials of holding the input's key for `hold`
+#     seconds changed the screen
+#
+# ================================================================================
+# MEMBER FUNCTION: KeyCalibrator.measure_frame_interval( seconds )
+# ================================================================================
+#
+# Output:
+#   - median time between new game frames over `seconds` of captures, also kept
+#     as frame_interval. The screen must be animated (e.g. during a race); on a
+#     screen changing fewer than min_frame_rate times a second the interval is
+#     left unchanged and None is returned.
+#
+# ================================================================================
+# MEMBER FUNCTION: KeyCalibrator.calibrate( inputs )
+# ================================================================================
+#
+# Input:
+#   - inputs (optional):
+#        * Default = None (every input of the emulator's mapping)
+#
+# Output:
+#   - dictionary of input names to calibrated hold times in seconds. The
+#     emulator uses them at once; EmulatorInterface.saveHoldTimes persists them.
+#
+# ================================================================================
+import time
+import numpy as np
+from FramePacing import FrameScheduler
+
+
+class KeyCalibrator:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, emulator, grab, low=0.005, high=0.3, tolerance=0.005, trials=3, margin=1.25,
+                 response_time=0.25, noise_factor=4, min_difference=1.0, step=4, boundary_trials=10,
+                 frame_interval=None):
+        self.emulator = emulator
+        self.grab = grab
+        self.low = low
+        self.high = high
+        self.tolerance = tolerance
+        self.trials = trials
+        self.boundary_trials = boundary_trials
+        self.frame_interval = frame_interval
+        self.margin = margin
+        self.response_time = response_time
+        self.noise_factor = noise_factor
+        self.min_difference = min_difference
+        self.sampler = FrameScheduler(step=step)
+        self.threshold = None
+        self.presses = 0
+        return
+
+    # ============================================================================
+    # KeyCalibrator.signature( ) -- sampled pixels of a fresh capture
+    # ============================================================================
+    def signature(self):
+        return self.sampler.sample(self.grab()).astype(np.int16)
+
+    # ============================================================================
+    # KeyCalibrator.measure_noise( pairs ) -- difference of unchanged captures
+    # ============================================================================
+    def measure_noise(self, pairs=10):
+        differences = list()
+        for _ in range(pairs):
+            before = self.signature()
+            time.sleep(self.response_time / 2)
+            differences.append(np.abs(self.signature() - before).mean())
+        self.threshold = max(self.min_difference, self.noise_factor * max(differences))
+        return max(differences)
+
+    # ============================================================================
+    # KeyCalibrator.measure_frame_interval( seconds , min_frame_rate )
+    # ============================================================================
+    def measure_frame_interval(self, seconds=2.0, min_frame_rate=10):
+        scheduler = FrameScheduler(step=self.sampler.step)
+        arrivals = list()
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            if scheduler.is_new_frame(self.grab()):
+                arrivals.append(time.perf_counter())
+        if len(arrivals) < max(3, min_frame_rate * seconds):
+            return None # A still screen says nothing about the frame rate
+        self.frame_interval = float(np.median(np.diff(arrivals)))
+        return self.frame_interval
+
+    # ============================================================================
+    # KeyCalibrator.press_changes_screen( input , hold )
+    # ============================================================================
+    def press_changes_screen(self, input, hold):
+        before = self.signature()
+        self.emulator.holdKey(self.emulator.currentEmulatorMapping[input], hold)
+        self.emulator.emulateReleasePresses([input])
+        self.presses += 1
+        time.sleep(self.response_time) # Let the game draw its response
+        return np.abs(self.signature() - before).mean() > self.threshold
+
+    # ============================================================================
+    # KeyCalibrator.registers( input , hold )
+    # ============================================================================
+    def registers(self, input, hold, trials=None):
+        for _ in range(self.trials if trials is None else trials):
+            if not self.press_changes_screen(input, hold):
+                return False
+        return True
+
+    # ============================================================================
+    # KeyCalibrator.calibrate_input( input ) -- binary search of one input's hold
+    # ============================================================================
+    def calibrate_input(self, input):
+        if not self.registers(input, self.high):
+            return None
+        low, high = self.low, self.high
+        if self.registers(input, low):
+            high = low
+
+        # === Invariant: low does not register, high does === #
+        while high - low > self.tolerance:
+            middle = (low + high) / 2
+            if self.registers(input, middle):
+                high = middle
+            else:
+                low = middle
+
+        # === Sub-Frame Holds Pass by Luck: Confirm the Boundary With More Presses === #
+        while high < self.high and not self.registers(input, high, self.boundary_trials):
+            high = min(self.high, high + self.tolerance)
+        return high
+
+    # ============================================================================
+    # KeyCalibrator.calibrate( inputs=None )
+    # ============================================================================
+    def calibrate(self, inputs=None):
+        if inputs is None:
+            inputs = self.emulator.getPossibleKeyEmulations()
+        if self.threshold is None:
+            self.measure_noise()
+
+        holds = dict()
+        for input in inputs:
+            shortest = self.calibrate_input(input)
+            if shortest is None:
+                print('{}: no response to a {:.0f} ms hold, keeping {:.0f} ms'.format(
+                    input, self.high * 1000, self.emulator.defaultHoldTime * 1000))
+                continue
+            frame = self.frame_interval if self.frame_interval is not None else 1 / 30
+            holds[input] = min(self.emulator.defaultHoldTime, max(shortest, frame) * self.margin) # Never below one game frame
+            print('{}: registers from {:.0f} ms, holding {:.0f} ms'.format(input, shortest * 1000, holds[input] * 1000))
+
+        for input, hold in holds.items():
+            self.emulator.setHoldTime(input, hold)
+        return holds
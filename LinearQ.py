@@ -0,0 +1,223 @@
+# ================================================================================
+# FILE: LinearQ.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Linear Q-function over the classifier's own features, as an alternative to the
+# Q-Table keyed by the argmax class. The classifier is extended with a second
+# output, the global average of its last convolutional block (maxpool_2, 64
+# values), so the class and the features come out of the same inference call.
+# The flattened 16,128-value layer in front of the softmax would work as well,
+# but averaging it over the image keeps updates in the microseconds and a
+# checkpoint at a couple of kilobytes.
+#
+# Each action has a weight vector over the features plus a bias, learned with
+# normalized LMS (SGD whose step does not depend on the scale of the features)
+# or recursive least squares (RLS).
+#
+# LinearQ has the parts of the dictionary interface RLAgent uses for q_table, so
+# select_action, apply_reward and propagate_reward work unchanged. Its states are
+# the agent's usual state with the feature vector appended as the last element,
+# e.g. ('center', array([...])); rewards still come from the class.
+#
+# ================================================================================
+# Function: embedding_model( classifier_model , layer_name )
+# ================================================================================
+#
+# Input:
+#   - classifier_model:
+#        * the keras frame classifier
+#   - layer_name (optional):
+#        * Default = None (the last layer with a 4D output, maxpool_2 for the
+#          shipped classifiers)
+#
+# Output:
+#   - keras model with the same input and two outputs: the class probabilities
+#     and the global average of the chosen layer's activations
+#
+# ================================================================================
+# CLASS: LinearQ
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - n_features:
+#        * length of the feature vector
+#   - n_actions:
+#        * number of actions in the agent's action space
+#   - method (optional):
+#        * Default = 'rls'
+#        * 'rls' for recursive least squares, 'sgd' for normalized LMS
+#   - learning_rate (optional):
+#        * Default = 0.1, step size of 'sgd'
+#   - forgetting (optional):
+#        * Default = 1.0, forgetting factor of 'rls' (< 1 tracks a changing policy)
+#   - initial_variance (optional):
+#        * Default = 100.0, initial diagonal of the RLS inverse covariance
+#
+# ================================================================================
+# MEMBER FUNCTION: LinearQ.get( state , default )
+# ================================================================================
+#
+# Output:
+#   - list of (value, count) pairs per action, where value is the linear estimate
+#     for the state's features and count the number of updates of that action
+#
+# ================================================================================
+# MEMBER FUNCTION: LinearQ.__setitem__( state , q_value )
+# ================================================================================
+#
+# Task:
+#   - apply_reward writes back the incremental average (V*N + reward) / (N + 1)
+#     of the value it read, so the reward is recovered from the pair as
+#     V_new*N_new - V_old*N_old and every action whose count changed is updated
+#     towards it
+#
+# ================================================================================
+# MEMBER FUNCTION: LinearQ.update( features , action , target )
+# ================================================================================
+#
+# Task:
+#   - one NLMS or RLS step of the action's weights towards the target value
+#
+# ================================================================================
+# MEMBER FUNCTION: LinearQ.save( fileName ) / LinearQ.load( fileName , ... )
+# ================================================================================
+#
+# Task:
+#   - save the weights and counts with numpy.savez_compressed (the RLS covariance
+#     is not saved and restarts from initial_variance when loaded)
+#   - load them back; load returns a new LinearQ (an untrained one if the file
+#     cannot be read, or raises the error with strict=True)
+#
+# ================================================================================
+import numpy as np
+
+
+# ================================================================================
+# embedding_model
+# ================================================================================
+def embedding_model(classifier_model, layer_name=None):
+
+    # === Necessary Imports === #
+    from RLAgent import load_tensorflow
+    tf = load_tensorflow()
+
+    if layer_name is None:
+        layer = [l for l in classifier_model.layers if len(l.output.shape) == 4][-1] # Keras 3 layers have no output_shape
+    else:
+        layer = classifier_model.get_layer(layer_name)
+    features = tf.keras.layers.GlobalAveragePooling2D(name='embedding')(layer.output)
+    return tf.keras.Model(classifier_model.inputs, list(classifier_model.outputs) + [features])
+
+
+class LinearQ:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, n_features, n_actions, method='rls', learning_rate=0.1, forgetting=1.0, initial_variance=100.0):
+        self.n_features = n_features
+        self.n_actions = n_actions
+        self.method = method
+        self.learning_rate = learning_rate
+        self.forgetting = forgetting
+        self.initial_variance = initial_variance
+
+        # === One Weight Vector (Features + Bias) per Action === #
+        self.weights = np.zeros((n_actions, n_features + 1), dtype=np.float64)
+        self.counts = np.zeros(n_actions, dtype=np.int64)
+        if method == 'rls':
+            self.P = np.tile(np.eye(n_features + 1) * initial_variance, (n_actions, 1, 1))
+        return
+
+    # ============================================================================
+    # LinearQ.features( state ) -- feature vector with the bias term appended
+    # ============================================================================
+    def features(self, state):
+        x = np.empty(self.n_features + 1, dtype=np.float64)
+        x[:-1] = state[-1]
+        x[-1] = 1.0
+        return x
+
+    # ============================================================================
+    # LinearQ.get( state , default=None )
+    # ============================================================================
+    def get(self, state, default=None):
+        values = self.weights @ self.features(state)
+        return [(float(V), int(N)) for V, N in zip(values, self.counts)]
+
+    def __getitem__(self, state):
+        return self.get(state)
+
+    # ============================================================================
+    # LinearQ[state] = q_value
+    # ============================================================================
+    def __setitem__(self, state, q_value):
+        x = self.features(state)
+        values = self.weights @ x
+        for action, (V, N) in enumerate(q_value):
+            if N != self.counts[action]:
+                target = V * N - values[action] * self.counts[action]
+                self.update(x, action, target)
+                self.counts[action] = N
+        return
+
+    # ============================================================================
+    # LinearQ.update( features , action , target )
+    # ============================================================================
+    def update(self, x, action, target):
+        error = target - self.weights[action] @ x
+
+        # === Normalized LMS === #
+        if self.method == 'sgd':
+            self.weights[action] += self.learning_rate * error * x / (x @ x)
+
+        # === Recursive Least Squares === #
+        else:
+            Px = self.P[action] @ x
+            gain = Px / (self.forgetting + x @ Px)
+            self.weights[action] += gain * error
+            self.P[action] = (self.P[action] - np.outer(gain, Px)) / self.forgetting
+        return
+
+    def __contains__(self, state):
+        return True
+
+    def __len__(self):
+        return self.n_actions
+
+    # ============================================================================
+    # LinearQ.items( ) -- per-action summary, for display
+    # ============================================================================
+    def items(self):
+        for action in range(self.n_actions):
+            yield ('action', action), [(float(np.linalg.norm(self.weights[action, :-1])), int(self.counts[action]))]
+
+    # ============================================================================
+    # LinearQ.save( fileName )
+    # ============================================================================
+    def save(self, fileName):
+        with open(fileName, 'wb') as outfile:
+            np.savez_compressed(outfile, weights=self.weights, counts=self.counts)
+        return
+
+    # ============================================================================
+    # LinearQ.load( fileName , n_features , n_actions , method , strict )
+    # ============================================================================
+    @staticmethod
+    def load(fileName, n_features, n_actions, method='rls', strict=False):
+        learner = LinearQ(n_features, n_actions, method)
+        try:
+            with np.load(fileName) as data:
+                if data['weights'].shape != learner.weights.shape:
+                    raise ValueError('{} holds weights of shape {}'.format(fileName, data['weights'].shape))
+                learner.weights[:] = data['weights']
+                learner.counts[:] = data['counts']
+        except (OSError, ValueError, KeyError) as error:
+            if strict:
+                raise
+            print('Starting an untrained linear Q-function: {}'.format(error))
+        return learner
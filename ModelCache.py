@@ -0,0 +1,267 @@
+# ================================================================================
+# FILE: ModelCache.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# On-disk cache of converted classifier artifacts, so restarts skip parsing the
+# .h5 file and building the keras graph. An entry is addressed by the SHA-256 of
+# the classifier file, the backend (e.g. 'tflite', 'tflite+embedding') and the
+# versions of the cache format and of TensorFlow that wrote it, so editing or
+# replacing the classifier, or upgrading TensorFlow, never reuses a stale entry.
+#
+# The only backend so far is TensorFlow Lite. A hit loads in about a millisecond,
+# and the interpreter comes from ai_edge_litert or tflite_runtime when one of them
+# is installed, in which case TensorFlow itself is never imported. On a miss the
+# classifier is loaded with keras, converted, stored, and then used from the cache.
+#
+# Entries are evicted least recently used first (by modification time, which is
+# refreshed on every hit) once the directory grows past max_bytes.
+#
+# ================================================================================
+# CLASS: ModelCache
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - directory (optional):
+#        * Default = DEFAULT_CACHE_DIR (~/.cache/mariokart_models)
+#   - max_bytes (optional):
+#        * Default = 256 MB, size cap of the whole cache directory
+#
+# ================================================================================
+# MEMBER FUNCTION: ModelCache.key( model_file , backend )
+# ================================================================================
+#
+# Output:
+#   - name of the cache entry for the model file and backend
+#
+# ================================================================================
+# MEMBER FUNCTION: ModelCache.load( model_file , backend , num_threads )
+# ================================================================================
+#
+# Input:
+#   - model_file: classifier .h5 file
+#   - backend:    'tflite' (class probabilities) or 'tflite+embedding' (class
+#                 probabilities and the pooled features of LinearQ.embedding_model)
+#
+# Output:
+#   - TFLiteClassifier for the cached artifact, built and stored first on a miss
+#
+# ================================================================================
+# MEMBER FUNCTION: ModelCache.report( )
+# ================================================================================
+#
+# Output:
+#   - string with the hits, misses and size of the cache
+#
+# ================================================================================
+# CLASS: TFLiteClassifier
+# ================================================================================
+#
+# Callable stand-in for the tf.function RLAgent calls its classifier through:
+# classifier(inputs, training=False) returns the class probabilities (and, for
+# the embedding backend, the features as a second output) as numpy arrays. The
+# interpreter is resized whenever the batch size changes.
+#
+# ================================================================================
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mariokart_models')
+CACHE_FORMAT = 1
+
+
+# ================================================================================
+# Function: make_interpreter( model_path , num_threads )
+# ================================================================================
+#
+# Output:
+#   - a TensorFlow Lite interpreter for the file, from the lightest package installed
+#
+# ================================================================================
+def make_interpreter(model_path, num_threads=None):
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from RLAgent import load_tensorflow
+            Interpreter = load_tensorflow().lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads)
+
+
+class TFLiteClassifier:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, model_path, output_order, num_threads=None):
+        self.interpreter = make_interpreter(model_path, num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        details = self.interpreter.get_output_details()
+        self.output_indices = [details[i]['index'] for i in output_order]
+        self.batch_size = None
+        return
+
+    # ============================================================================
+    # TFLiteClassifier( inputs , training=False )
+    # ============================================================================
+    def __call__(self, inputs, training=False):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if inputs.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, inputs.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = inputs.shape[0]
+
+        self.interpreter.set_tensor(self.input_index, inputs)
+        self.interpreter.invoke()
+        outputs = [self.interpreter.get_tensor(index) for index in self.output_indices]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+class ModelCache:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=256 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        return
+
+    # ============================================================================
+    # ModelCache.key( model_file , backend )
+    # ============================================================================
+    def key(self, model_file, backend):
+        digest = hashlib.sha256()
+        with open(model_file, 'rb') as infile:
+            for block in iter(lambda: infile.read(2 ** 20), b''):
+                digest.update(block)
+        return '{}-{}-v{}-tf{}'.format(digest.hexdigest(), backend, CACHE_FORMAT, self.tensorflow_version())
+
+    # ============================================================================
+    # ModelCache.tensorflow_version( ) -- without importing TensorFlow
+    # ============================================================================
+    def tensorflow_version(self):
+        try:
+            from importlib.metadata import version
+            return version('tensorflow')
+        except Exception:
+            return 'none'
+
+    # ============================================================================
+    # ModelCache.load( model_file , backend='tflite' , num_threads=None )
+    # ============================================================================
+    def load(self, model_file, backend='tflite', num_threads=None):
+        entry = os.path.join(self.directory, self.key(model_file, backend))
+        model_path = os.path.join(entry, 'model.tflite')
+        meta_path = os.path.join(entry, 'meta.json')
+
+        # === Hit: Refresh the Entry's LRU Time === #
+        if os.path.exists(meta_path):
+            self.hits += 1
+            os.utime(entry)
+            os.utime(meta_path)
+
+        # === Miss: Convert and Store (Then Evict Down to the Size Cap Either Way) === #
+        else:
+            self.misses += 1
+            start = time.perf_counter()
+            os.makedirs(entry, exist_ok=True)
+            try:
+                output_order = self.convert(model_file, backend, model_path)
+                with open(meta_path, 'w') as outfile:
+                    json.dump({'model_file': os.path.abspath(model_file), 'backend': backend, 'output_order': output_order,
+                               'convert_s': time.perf_counter() - start}, outfile)
+            except BaseException:
+                shutil.rmtree(entry, ignore_errors=True) # No half-written entry (model.tflite without meta.json)
+                raise
+        self.evict(keep=entry)
+
+        with open(meta_path, 'r') as infile:
+            meta = json.load(infile)
+        return TFLiteClassifier(model_path, meta['output_order'], num_threads)
+
+    # ============================================================================
+    # ModelCache.convert( model_file , backend , model_path )
+    # ============================================================================
+    def convert(self, model_file, backend, model_path):
+
+        # === Necessary Imports === #
+        from LinearQ import embedding_model
+        from RLAgent import load_tensorflow
+        tf = load_tensorflow() # Enables GPU memory growth before the first model is loaded
+
+        model = tf.keras.models.load_model(model_file, compile=False)
+        if backend == 'tflite+embedding':
+            model = embedding_model(model)
+        elif backend != 'tflite':
+            raise ValueError('Unknown classifier backend: {}'.format(backend))
+
+        with open(model_path, 'wb') as outfile:
+            outfile.write(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+
+        # === Match the Interpreter's Outputs to the Keras Outputs === #
+        probe = np.random.RandomState(0).randint(0, 256, (1,) + tuple(model.input_shape[1:])).astype(np.float32)
+        expected = model(probe, training=False)
+        expected = [np.asarray(e) for e in (expected if isinstance(expected, (list, tuple)) else [expected])]
+        interpreter = make_interpreter(model_path)
+        interpreter.allocate_tensors()
+        interpreter.set_tensor(interpreter.get_input_details()[0]['index'], probe)
+        interpreter.invoke()
+        details = interpreter.get_output_details()
+        outputs = [interpreter.get_tensor(d['index']) for d in details]
+        output_order = [next((i for i, o in enumerate(outputs) if o.shape == e.shape and np.allclose(o, e, rtol=1e-3, atol=1e-3)), None)
+                        for e in expected]
+        if None in output_order:
+            raise ValueError('The {} conversion of {} does not reproduce keras output {} of {}'.format(
+                backend, model_file, output_order.index(None), len(expected)))
+        return output_order
+
+    # ============================================================================
+    # ModelCache.entries( ) -- (last use, size, path) of every entry
+    # ============================================================================
+    def entries(self):
+        entries = list()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+        return entries
+
+    # ============================================================================
+    # ModelCache.evict( keep )
+    # ============================================================================
+    def evict(self, keep=None):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for f in os.listdir(path):
+                os.remove(os.path.join(path, f))
+            os.rmdir(path)
+            total -= size
+        return
+
+    # ============================================================================
+    # ModelCache.report( )
+    # ============================================================================
+    def report(self):
+        entries = self.entries()
+        return 'Model cache {}: {} hit(s), {} miss(es), {} entries, {:.1f} of {:.0f} MB'.format(
+            self.directory, self.hits, self.misses, len(entries),
+            sum(size for _, size, _ in entries) / 2 ** 20, self.max_bytes / 2 ** 20)
@@ -17,18 +17,57 @@
 # ================================================================================
 #
 #   * tensorflow: used for the CNN classifier used in state space VFA from image 
-#                 frames
+#                 frames. It is imported on first use by load_tensorflow(), so
+#                 importing this module is cheap and the (slow) TensorFlow import
+#                 can happen on a background thread while the GUI comes up
 #
-#   * gpus: used for extracting the physical gpus
+#   * gpus: used for extracting the physical gpus (none on CPU-only machines)
 #
 #   * experimental memory growth = True: tensorflow was finding errors with 
-#                  "finding the convolution algorithm" otherwise. It is untested
-#                  whether or not this works on machines without a GPU
+#                  "finding the convolution algorithm" otherwise. It is set on
+#                  every GPU found and skipped when there are none
+#
+#   * numpy: used for the classifier input buffer and the frozen policy array
+#
+#   * frame_processing: shared grayscale/resize preprocessing and class names
+#
+#   * ShadowMode: fused primary + candidate classifier for shadow A/B runs
 #
 # ================================================================================
-import tensorflow as tf
-gpus= tf.config.experimental.list_physical_devices('GPU')
-tf.config.experimental.set_memory_growth(gpus[0], True)
+import time
+import numpy as np
+from frame_array_to_state import EdgeCascade
+from frame_processing import CLASS_INDICES, CLASSIFIER_IMAGE_SIZE, FRAME_CLASSES, preprocess_crops, preprocess_frame
+from LinearQ import LinearQ, embedding_model
+from ShadowMode import ShadowStats, fused_model
+from StateEncoder import HashedQTable
+
+_tensorflow = None
+
+
+# ================================================================================
+# Function: load_tensorflow( )
+# ================================================================================
+#
+# Output:
+#   - the tensorflow module
+#
+# Task:
+#   - import tensorflow on the first call and enable memory growth on every GPU
+#     it finds (if any); later calls return the already configured module
+#
+# ================================================================================
+def load_tensorflow():
+    global _tensorflow
+    if _tensorflow is None:
+        import tensorflow as tf
+        for gpu in tf.config.experimental.list_physical_devices('GPU'):
+            try:
+                tf.config.experimental.set_memory_growth(gpu, True)
+            except RuntimeError: # GPUs were already initialized
+                pass
+        _tensorflow = tf
+    return _tensorflow
 
 
 
@@ -54,6 +93,11 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #        * keras model resulting from loading the classifier file. Used for interpreting
 #          the input frame as a state.
 #
+#   - classifier_predict
+#        * tf.function wrapping classifier_model. A traced call costs a fraction of
+#          keras' predict() for a single frame. With a model_cache it is a
+#          ModelCache.TFLiteClassifier instead and classifier_model is None.
+#
 #   - classifier_image_shape
 #        * dimensions needed for the image that the classifier expects
 #
@@ -108,6 +152,76 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #   - propagate_interval:
 #        * maximum length of a training episode
 #
+#   - policy_file:
+#        * String containing the name of the file the frozen policy is exported to
+#          and loaded from
+#
+#   - frozen_policy:
+#        * None, or a numpy array mapping each index of frame_classes to the index
+#          of the action to take. When set and not training, act() skips the Q-Table
+#          entirely (see RLAgent.act_frozen). With crop_regions it has one axis per
+#          crop and is indexed by the tuple of class indices.
+#
+#   - crop_regions
+#        * None, or a list of (name, top, bottom) regions of the frame (see
+#          frame_processing.LOOKAHEAD_CROPS). When set, every crop is classified
+#          in one batched call and the state is the tuple of class names, e.g.
+#          ('center', 'center', 'wall_left'), which serves as the Q-Table key.
+#
+#   - edge_cascade
+#        * None, or a frame_array_to_state.EdgeCascade answering easy frames from
+#          their Canny edge tuple so the CNN only runs on ambiguous ones (single
+#          frame classification only, not with crop_regions)
+#
+#   - state_features
+#        * list of state-feature providers (e.g. HitboxFinder.LateralOffsetFeature),
+#          each a callable frame -> int in range(provider.n_bins). Their values are
+#          appended to the class(es) in the state key, e.g. ('center', 3), and add
+#          one axis each to the frozen policy.
+#
+#   - state_encoder
+#        * None, or a StateEncoder.StateEncoder. When set, q_table is a fixed-size
+#          StateEncoder.HashedQTable (saved to model_hashed.npz) instead of a
+#          dictionary, so its memory and lookup cost stay constant however many
+#          feature tuples the states are made of.
+#
+#   - linear_q
+#        * None, 'rls' or 'sgd'. When set, q_table is a LinearQ.LinearQ over the
+#          classifier's pooled conv features, which classifier_predict returns
+#          together with the class (see LinearQ.embedding_model). The features
+#          are appended to the state as its last element and the Q-function is
+#          saved to model_linear.npz.
+#
+#   - embedding
+#        * feature vector of the last classified frame (with linear_q)
+#
+#   - model_cache
+#        * None, or the ModelCache.ModelCache the classifier was loaded from
+#
+#   - pending_swaps
+#        * list of attribute dictionaries of hot swaps that have finished loading
+#          and are waiting to be applied between two frames
+#
+#   - seed / rng
+#        * seed of rng, the agent's own numpy RandomState used for exploration, so
+#          a run can be replayed exactly (see SessionReplay)
+#
+#   - session_recorder
+#        * None, or a SessionReplay.SessionRecorder that act() hands every frame
+#          to, to be downscaled, recorded and acted on
+#
+#   - telemetry
+#        * None, or a TelemetryRecorder.TelemetryRecorder that act() writes one
+#          record per tick to (not the frozen-policy path). last_probs holds the
+#          class probabilities of the last classifier call (None when the edge
+#          cascade answered) and explored whether the last action was random.
+#
+#   - shadow
+#        * None, or the ShadowMode.ShadowStats of a candidate classifier run in
+#          shadow mode. classifier_predict is then the fused primary + candidate
+#          model, primary_predict the primary alone (used to time it), and
+#          shadow_probs holds the candidate's probabilities for the last frame.
+#
 # ================================================================================
 # CONSTRUCTOR:
 # ================================================================================
@@ -125,12 +239,77 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #   - max_episodes (optional):
 #        * Default = 10000
 #        * Number of training episodes before switching to demo mode
+#   - classifier_file (optional):
+#        * Default = 'classifier_v4.h5'
+#        * path to the keras classifier, e.g. a classifier_vN.h5 produced by
+#          CNN/train_classifier.py
+#   - classifier_model (optional):
+#        * Default = None
+#        * An already loaded keras classifier to use instead of loading
+#          classifier_file. Lets several agents (one per emulator instance) share
+#          a single model in memory.
+#   - policy_file (optional):
+#        * Default = None
+#        * If given, only the frozen policy in this file is loaded (no Q-Table) and
+#          the agent starts in demo mode
+#   - crop_regions (optional):
+#        * Default = None (classify the whole frame)
+#        * list of (name, top, bottom) regions to classify as a lookahead state,
+#          e.g. frame_processing.LOOKAHEAD_CROPS
+#   - use_edge_cascade (optional):
+#        * Default = False
+#        * Boolean flag. True = put an EdgeCascade in front of the classifier
+#   - state_features (optional):
+#        * Default = None (the state is the classification alone)
+#        * list of state-feature providers, see the state_features attribute
+#   - state_encoder (optional):
+#        * Default = None (dictionary Q-Table)
+#        * StateEncoder hashing the states into a fixed-size Q-Table
+#   - linear_q (optional):
+#        * Default = None (tabular Q)
+#        * 'rls' or 'sgd' to learn a linear Q-function over the classifier's
+#          features instead
+#   - model_cache (optional):
+#        * Default = None (load classifier_file with keras)
+#        * ModelCache.ModelCache to take a TensorFlow Lite conversion of
+#          classifier_file from (converted and stored on the first use)
+#   - shadow_classifier_file (optional):
+#        * Default = None
+#        * candidate keras classifier to evaluate in shadow mode: it runs in the
+#          same fused call as the primary but never drives actions. The primary
+#          is then loaded with keras, not from model_cache.
+#   - telemetry (optional):
+#        * Default = None
+#        * TelemetryRecorder to record every tick to
+#   - seed (optional):
+#        * Default = None (a random seed, kept in self.seed)
+#        * seed of the agent's exploration random number generator
 #
 # Output:
 #   - N/A
 #
 # Task:
 #   - Initialize all attributes appropriately
+#   - Warm up the classifier (see RLAgent.warm_up)
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.warm_up( )
+# ================================================================================
+#
+# Task:
+#   - run classifier_predict once on a zero input of the real batch shape, so the
+#     tf.function is traced (and the kernels initialized) before the first real
+#     frame arrives. Called at the end of the constructor.
+#   - returns the result of that call
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.wrap_classifier( classifier_model )
+# ================================================================================
+#
+# Output:
+#   - (classifier_predict, primary_predict): tf.functions of the classifier (or of
+#     its embedding model with linear_q). In shadow mode classifier_predict runs
+#     the fused primary + candidate model; otherwise both are the same function.
 #
 # ================================================================================
 # MEMBER FUNCTION: RLAgent.frame_to_state( frame )
@@ -138,11 +317,16 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #
 # Input:
 #   - frame:
-#        * image representation of the current game's frame
+#        * image representation of the current game's frame, either a PIL image
+#          or a BGR/BGRA numpy array (such as a slice of a multi-viewport capture)
 #
 # Output:
 #   - string representing one of the 8 classes defined in self.frame_classes, representing
 #     the model's classification of the input frame
+#   - with crop_regions, a tuple of such strings, one per region
+#   - with state_features, a tuple of the class string(s) followed by the value of
+#     each feature
+#   - with linear_q, a tuple ending with the classifier's feature vector
 #
 # Task:
 #   - Convert the given frame to grayscale
@@ -153,6 +337,68 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #   - return the name of the class with the greatest prediction value
 #
 # ================================================================================
+# MEMBER FUNCTION: RLAgent.feature_values( frame )
+# ================================================================================
+#
+# Output:
+#   - tuple holding the value of every provider in self.state_features for the frame
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.classify_frame( frame )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * image representation of the current game's frame (see frame_to_state)
+#
+# Output:
+#   - index into self.frame_classes of the class with the greatest prediction value
+#   - with crop_regions, a tuple of such indices, one per region
+#
+# Task:
+#   - with an edge_cascade, let it decide from the frame's edges whether the CNN
+#     (classify_frame_cnn) needs to run at all
+#   - otherwise classify the frame with classify_frame_cnn
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.classify_frame_cnn( frame )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * image representation of the current game's frame (see frame_to_state)
+#
+# Output:
+#   - same as classify_frame
+#
+# Task:
+#   - Preprocess the frame (or each of its crops) into the preallocated classifier
+#     input buffer
+#   - run the classifier on it through classifier_predict, which avoids the per-call
+#     setup cost of predict() for a single frame. All crops go through one
+#     batched call, so the lookahead state costs about as much as a single frame.
+#   - in shadow mode, record the primary and candidate classes and the latency
+#     of the call in self.shadow
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.split_prediction( result )
+# ================================================================================
+#
+# Output:
+#   - the class probabilities of a classifier_predict result. With linear_q the
+#     result also holds the features, which are kept in self.embedding (all crops'
+#     features concatenated with crop_regions). In shadow mode the candidate's
+#     probabilities come last and are kept in self.shadow_probs.
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.shadow_report( fileName )
+# ================================================================================
+#
+# Output:
+#   - the shadow-mode agreement matrix and latency comparison as text (see
+#     ShadowStats.dump), also saved to fileName when given
+#
+# ================================================================================
 # MEMBER FUNCTION: RLAgent.update_explore_chance( )
 # ================================================================================
 #
@@ -262,6 +508,7 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #
 # Task:
 #   - lookup the base-reward table to determine reward values
+#     (tuple states are rewarded by their first, near-field, class)
 #   - Return the reward value
 #
 # ================================================================================
@@ -282,12 +529,17 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #     since it we don't apply reward to it)
 #
 # ================================================================================
-# MEMBER FUNCTION: RLAgent.load_model( use_existing_model )
+# MEMBER FUNCTION: RLAgent.load_model( use_existing_model , fileName , strict )
 # ================================================================================
 #
 # Input:
 #   - use_existing_model:
 #        * flag specifying whether to load an existing model or create a new one
+#   - fileName (optional):
+#        * Default = None (use self.model_file)
+#   - strict (optional):
+#        * Default = False
+#        * True: raise the loading error instead of starting from an empty model
 #
 # Output:
 #   - dictionary representing the model
@@ -302,6 +554,8 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #     data types, and interpret values to form a QTable dictionary of the appropriate
 #     structure
 #   - if the given flag is false or the attemtp to load failed, return an empty dictionary
+#   - with a state_encoder, the same for a HashedQTable saved in self.model_file
+#   - with linear_q, the same for a LinearQ saved in self.model_file
 #
 # ================================================================================
 # MEMBER FUNCTION: RLAgent.save_model( )
@@ -319,6 +573,39 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #   - Iterate through the key-value pairs in the QTable
 #   - save each key value pair as a line in the file with the form:
 #        * "key:value"
+#   - a HashedQTable or LinearQ saves its arrays instead (see HashedQTable.save)
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.export_policy( fileName )
+# ================================================================================
+#
+# Input:
+#   - fileName (optional):
+#        * Default = None (use self.policy_file)
+#
+# Output:
+#   - the frozen policy array (also saved to the file with numpy.save)
+#   - None with linear_q, whose values depend on more than the class
+#
+# Task:
+#   - for every class in self.frame_classes (every combination of classes when
+#     crop_regions is set), pick the action with the highest learned value exactly
+#     as select_action would when exploiting
+#   - store the chosen action indices as a small int8 array indexed by class index
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.load_policy( fileName )
+# ================================================================================
+#
+# Input:
+#   - fileName (optional):
+#        * Default = None (use self.policy_file)
+#
+# Output:
+#   - No return
+#
+# Task:
+#   - load a frozen policy exported by export_policy into self.frozen_policy
 #
 # ================================================================================
 # MEMBER FUNCTION: RLAgent.act( frame )
@@ -339,6 +626,78 @@ tf.config.experimental.set_memory_growth(gpus[0], True)
 #   - if training, update the history with the state-action p air
 #   - if history is long enough for training episode to end, propagate reward
 #   - return the selected action
+#   - in demo mode with a frozen policy loaded, defer to act_frozen instead
+#   - before anything else, apply any hot swap that finished loading since the last
+#     frame (see apply_pending_swaps)
+#   - with telemetry, time the classify/select/learn stages and record the tick
+#     (see record_tick)
+#   - with a session_recorder, let it downscale and record the frame, and act on
+#     the recorded frame
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.record_tick( state , action_idx , start , classified , selected )
+# ================================================================================
+#
+# Task:
+#   - write the tick's class, probabilities, action, reward, explore flag, the
+#     state's Q-values (after this tick's update) and stage latencies to
+#     self.telemetry
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.hot_swap_classifier( classifier_file , on_done )
+# ================================================================================
+#
+# Input:
+#   - classifier_file:
+#        * keras classifier to switch to while the agent keeps running
+#   - on_done (optional):
+#        * Default = None
+#        * function(success, message) called from the loading thread when done
+#
+# Output:
+#   - the started loading thread
+#
+# Task:
+#   - on a background thread, load the classifier (from model_cache if set), wrap
+#     it like the constructor does and warm it up on the real input shape
+#   - refuse classifiers whose number of classes differs from frame_classes, or,
+#     with linear_q, whose embedding size differs from the Q-function's
+#   - queue the new classifier in pending_swaps; the frame loop swaps it in between
+#     two frames, so no frame is ever classified by a half-loaded model
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.hot_swap_q_table( fileName , on_done )
+# ================================================================================
+#
+# Task:
+#   - same as hot_swap_classifier for a Q-Table checkpoint (any format load_model
+#     reads, loaded strictly so a wrong file never replaces the learned values).
+#     The agent saves to fileName from then on.
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.apply_pending_swaps( )
+# ================================================================================
+#
+# Task:
+#   - assign the attributes of every finished hot swap on the calling (frame loop)
+#     thread. A swap is a single dictionary update, so a frame sees either the old
+#     or the new model, never a mix.
+#
+# ================================================================================
+# MEMBER FUNCTION: RLAgent.act_frozen( frame )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * image representation/screenshot from the game's current display
+#
+# Output:
+#   - the action from self.action_space that the frozen policy gives for the
+#     frame's class
+#
+# Task:
+#   - classify the frame and index the frozen policy with the class index. No
+#     Q-Table lookups, history or logging.
 #
 # ================================================================================
 class RLAgent:
@@ -350,7 +709,19 @@ class RLAgent:
                  use_existing_model=True,
                  is_training=True,
                  episode_length=10,
-                 max_episodes=10000):
+                 max_episodes=10000,
+                 classifier_file='classifier_v4.h5',
+                 classifier_model=None,
+                 policy_file=None,
+                 crop_regions=None,
+                 use_edge_cascade=False,
+                 state_features=None,
+                 state_encoder=None,
+                 linear_q=None,
+                 model_cache=None,
+                 shadow_classifier_file=None,
+                 telemetry=None,
+                 seed=None):
 
         # === Save/Load Housekeeping === #
         self.model_file = 'model.txt'
@@ -360,24 +731,56 @@ class RLAgent:
         self.action_space = [ 'left' , 'right' , 'throttle' ]
         
         # === State Space Classification Housekeeping === #
-        self.classifier_file        = 'classifier_v4.h5'
-        self.classifier_model       = tf.keras.models.load_model( self.classifier_file )
-        self.classifier_image_shape = ( 80 , 64 )
+        self.classifier_file        = classifier_file
+        self.linear_q               = linear_q
+        self.model_cache            = model_cache
+        self.pending_swaps          = list( )
+        self.shadow                 = None
+        self.shadow_probs           = None
+        self.last_probs             = None
+        if shadow_classifier_file is not None:
+            self.shadow = ShadowStats( shadow_classifier_file , dict( FRAME_CLASSES ) )
+        if classifier_model is None and model_cache is not None and self.shadow is None:
+            # === Converted Classifier from the Cache (No Keras Graph to Build) === #
+            self.classifier_model   = None
+            self.classifier_predict = model_cache.load( self.classifier_file , 'tflite' if linear_q is None else 'tflite+embedding' )
+            self.primary_predict    = self.classifier_predict
+        else:
+            tf = load_tensorflow()
+            if classifier_model is None:
+                classifier_model = tf.keras.models.load_model( self.classifier_file )
+            self.classifier_model   = classifier_model
+            self.classifier_predict , self.primary_predict = self.wrap_classifier( classifier_model )
+        self.classifier_image_shape = CLASSIFIER_IMAGE_SIZE
         self.classifier_input_shape = (  1 , 80 , 64 , 1 )
-        self.frame_classes          = {
-            0:'center',
-            1:'near_left',
-            2:'near_right',
-            3:'off_left',
-            4:'off_right',
-            5:'wall_left',
-            6:'wall_right',
-            7:'tunnel_left',
-            8:'tunnel_right'
-        }
+        self.frame_classes          = dict( FRAME_CLASSES )
+        self.crop_regions           = crop_regions
+        n_inputs                    = 1 if crop_regions is None else len( crop_regions )
+        self.classifier_input       = np.zeros( ( n_inputs , self.classifier_image_shape[1] , self.classifier_image_shape[0] , 1 ) , dtype=np.float32 )
+        self.edge_cascade           = None
+        if use_edge_cascade and crop_regions is None and linear_q is None:
+            self.edge_cascade = EdgeCascade( n_classes=len( self.frame_classes ) )
+        self.state_features         = list( state_features ) if state_features is not None else list( )
+        self.state_encoder          = state_encoder
+        if state_encoder is not None:
+            self.model_file = 'model_hashed.npz'
+        self.embedding              = None
+        self.split_prediction( self.warm_up() )
+        if linear_q is not None:
+            self.model_file = 'model_linear.npz'
+            self.embedding_size = self.embedding.size
 
         # === Initialize Model === #
-        self.q_table = self.load_model(use_existing_model)
+        self.policy_file = 'policy.npy'
+        self.frozen_policy = None
+        if policy_file is not None:
+            # === Frozen Policy Only: No Q-Table, Demo Mode === #
+            self.policy_file = policy_file
+            self.load_policy()
+            self.q_table = dict()
+            is_training = False
+        else:
+            self.q_table = self.load_model(use_existing_model)
 
         # === Training Housekeeping === #
         self.is_training = is_training
@@ -389,6 +792,8 @@ class RLAgent:
         self.explore_chance = 0.50#0.99
         self.explore_decay = 0.90#0.99
         self.explore_min = 0.01
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % 2 ** 32)
+        self.rng = np.random.RandomState(self.seed) # Per-agent stream, replayable from the seed
 
         # === History Housekeeping === #
         self.history = list()  # maybe give default if we want |history| > 1
@@ -397,26 +802,138 @@ class RLAgent:
         # === Image data === #
         self.processedImage = None
 
+        # === Per-Tick Telemetry and Session Recording === #
+        self.telemetry = telemetry
+        self.explored = False
+        self.session_recorder = None
+
         return  # __init__
 
+    # ============================================================================
+    # RLAgent.warm_up
+    # ============================================================================
+    def warm_up( self ):
+
+        # === Trace classifier_predict Once on a Dummy Input of the Real Shape === #
+        zeros = np.zeros_like( self.classifier_input )
+        if self.shadow is not None:
+            self.primary_predict( zeros , training=False ) # Timed alone in shadow mode
+            self.shadow.candidate_predict( zeros , training=False )
+        return self.classifier_predict( zeros , training=False )
+
+    # ============================================================================
+    # RLAgent.wrap_classifier
+    # ============================================================================
+    def wrap_classifier( self , classifier_model ):
+        tf = load_tensorflow()
+        predict_model   = classifier_model if self.linear_q is None else embedding_model( classifier_model ) # Class and features from the same call
+        primary_predict = tf.function( predict_model , reduce_retracing=True )
+        if self.shadow is None:
+            return primary_predict , primary_predict
+
+        # === Shadow Mode: Primary and Candidate Share One Input and One Call === #
+        return tf.function( fused_model( predict_model , self.shadow.candidate_model ) , reduce_retracing=True ) , primary_predict
+
     # ============================================================================
     # RLAgent.frame_to_state
     # ============================================================================
     def frame_to_state( self , frame ):
 
-        # === Necessary Imports === #
-        import numpy as np
-        
-        # === Process the Frame === #
-        processed = frame.convert( 'L' ).resize( ( 80 , 64 ) )
-        img_arr   = np.asarray( processed )
-        self.processedImage = img_arr
-        img_arr   = img_arr.reshape( ( 1 , img_arr.shape[0] , img_arr.shape[1] , 1) )
-        result    = self.classifier_model.predict( img_arr )
-        state     = np.argmax( result )
+        # === Classify the Frame === #
+        state = self.classify_frame( frame )
         
+        # === Lookahead: One Class per Crop === #
+        if self.crop_regions is not None:
+            state = tuple( self.frame_classes[idx] for idx in state )
+        else:
+            state = self.frame_classes[state]
+
+        # === Compose Extra Features into the State Key === #
+        if self.state_features:
+            state = ( state if isinstance( state , tuple ) else ( state , ) ) + self.feature_values( frame )
+
+        # === Linear Q: the Classifier's Features Come Last === #
+        if self.linear_q is not None:
+            state = ( state if isinstance( state , tuple ) else ( state , ) ) + ( self.embedding , )
+
         # === Return the Frame's Class as the State === #
-        return self.frame_classes[state]
+        return state
+
+    # ============================================================================
+    # RLAgent.feature_values
+    # ============================================================================
+    def feature_values( self , frame ):
+        return tuple( int( feature( frame ) ) for feature in self.state_features )
+
+    # ============================================================================
+    # RLAgent.classify_frame
+    # ============================================================================
+    def classify_frame( self , frame ):
+        self.last_probs = None
+
+        # === Cheap Edge Stage First, CNN Only When Needed === #
+        if self.edge_cascade is not None:
+            return self.edge_cascade.classify( frame , self.classify_frame_cnn )
+
+        return self.classify_frame_cnn( frame )
+
+    # ============================================================================
+    # RLAgent.classify_frame_cnn
+    # ============================================================================
+    def classify_frame_cnn( self , frame ):
+
+        # === Lookahead: Classify Every Crop in One Batched Call === #
+        if self.crop_regions is not None:
+            preprocess_crops( frame , self.crop_regions , self.classifier_input , self.classifier_image_shape )
+            self.processedImage = self.classifier_input[ : , : , : , 0 ].reshape( -1 , self.classifier_input.shape[2] ).astype( np.uint8 )
+            result = self.predict_classes( )
+            return tuple( np.argmax( result , axis=1 ).tolist() )
+
+        # === Process the Frame into the Input Buffer === #
+        img_arr   = preprocess_frame( frame , self.classifier_image_shape )
+        self.processedImage = img_arr
+        self.classifier_input[ 0 , : , : , 0 ] = img_arr
+
+        # === Return the Index of the Most Likely Class === #
+        result    = self.predict_classes( )
+        return int( np.argmax( result ) )
+
+    # ============================================================================
+    # RLAgent.predict_classes -- run classifier_predict on the input buffer
+    # ============================================================================
+    def predict_classes( self ):
+        if self.shadow is None:
+            self.last_probs = np.asarray( self.split_prediction( self.classifier_predict( self.classifier_input , training=False ) ) )
+            return self.last_probs
+
+        # === Shadow Mode: Time the Fused Call and Compare the Two Classifiers === #
+        start  = time.perf_counter()
+        result = np.asarray( self.split_prediction( self.classifier_predict( self.classifier_input , training=False ) ) )
+        self.shadow.record( np.argmax( result , axis=-1 ) , np.argmax( self.shadow_probs , axis=-1 ) , time.perf_counter() - start ,
+                            self.classifier_input , self.primary_predict )
+        self.last_probs = result
+        return result
+
+    # ============================================================================
+    # RLAgent.split_prediction -- keep the features of a two-output classifier
+    # ============================================================================
+    def split_prediction( self , result ):
+        if self.shadow is not None:
+            result , self.shadow_probs = list( result[:-1] ) , np.asarray( result[-1] )
+            result = result[0] if len( result ) == 1 else result
+        if self.linear_q is None:
+            return result
+        probs , features = result
+        self.embedding = np.asarray( features ).reshape( -1 )
+        return probs
+
+    # ============================================================================
+    # RLAgent.shadow_report
+    # ============================================================================
+    def shadow_report( self , fileName = None ):
+        if self.shadow is None:
+            return 'Shadow mode is off (no candidate classifier)'
+        return self.shadow.dump( fileName )
 
     # ============================================================================
     # RLAgent.update_explore_chance
@@ -461,8 +978,9 @@ class RLAgent:
             explore_chance = 0
 
         # === If Explore, Choose Random Action === #
-        if np.random.rand() < explore_chance:
-            action_idx = np.random.choice(range(len(self.action_space)))
+        self.explored = self.rng.rand() < explore_chance
+        if self.explored:
+            action_idx = self.rng.choice(range(len(self.action_space)))
 
         # === If Exploit, Use Learned Action with Highest Reward === #
         else:
@@ -514,62 +1032,66 @@ class RLAgent:
         return  # apply_reward
         
         
+    # === Lookup Table for Base Reward Values (Built Once, Not per Call) === #
+    reward_table = {
+        'center':{
+            'left':0,
+            'right':0,
+            'throttle':100
+        },
+        'near_left':{
+            'left':-100,
+            'right':100,
+            'throttle':100
+        },
+        'near_right':{
+            'left':100,
+            'right':-100,
+            'throttle':100
+        },
+        'off_left':{
+            'left':-100,
+            'right':100,
+            'throttle':100
+        },
+        'off_right':{
+            'left':100,
+            'right':-100,
+            'throttle':100
+        },
+        'wall_left':{
+            'left':-100,
+            'right':100,
+            'throttle':0
+        },
+        'wall_right':{
+            'left':100,
+            'right':-100,
+            'throttle':0
+        },
+        'tunnel_left':{
+            'left':100,
+            'right':-100,
+            'throttle':100
+        },
+        'tunnel_right':{
+            'left':-100,
+            'right':100,
+            'throttle':100
+        }
+    }
+
     # ============================================================================
     # RLAgent.new_reward
     # ============================================================================
     def new_reward( self , state , action ):
-    
-        # === Lookup Table for Base Reward Values === #
-        reward_table = {
-            'center':{
-                'left':0,
-                'right':0,
-                'throttle':100
-            },
-            'near_left':{
-                'left':-100,
-                'right':100,
-                'throttle':100
-            },
-            'near_right':{
-                'left':100,
-                'right':-100,
-                'throttle':100
-            },
-            'off_left':{
-                'left':-100,
-                'right':100,
-                'throttle':100
-            },
-            'off_right':{
-                'left':100,
-                'right':-100,
-                'throttle':100
-            },
-            'wall_left':{
-                'left':-100,
-                'right':100,
-                'throttle':0
-            },
-            'wall_right':{
-                'left':100,
-                'right':-100,
-                'throttle':0
-            },
-            'tunnel_left':{
-                'left':100,
-                'right':-100,
-                'throttle':100
-            },
-            'tunnel_right':{
-                'left':-100,
-                'right':100,
-                'throttle':100
-            }
-        }
         
+        # === Tuple (Lookahead) States are Rewarded by the Near Field === #
+        if isinstance( state , tuple ):
+            state = state[0]
+
         # === Return the Reward === #
-        return reward_table[state][self.action_space[action]]
+        return self.reward_table[state][self.action_space[action]]
 
     # ============================================================================
     # RLAgent.propagate_reward
@@ -592,10 +1114,23 @@ class RLAgent:
     # ============================================================================
     # RLAgent.load_model
     # ============================================================================
-    def load_model(self, use_existing_model):
+    def load_model(self, use_existing_model, fileName = None, strict = False):
 
         # === Necessary Imports === #
         from ast import literal_eval
+        model_file = self.model_file if fileName is None else fileName
+
+        # === Linear Q-Function === #
+        if self.linear_q is not None:
+            if use_existing_model:
+                return LinearQ.load(model_file, self.embedding_size, len(self.action_space), self.linear_q, strict)
+            return LinearQ(self.embedding_size, len(self.action_space), self.linear_q)
+
+        # === Fixed-Size Hashed Q-Table === #
+        if self.state_encoder is not None:
+            if use_existing_model:
+                return HashedQTable.load(model_file, self.state_encoder, len(self.action_space), strict)
+            return HashedQTable(self.state_encoder, len(self.action_space))
 
         # === If Told to Use Saved Model === #
         if use_existing_model:
@@ -605,14 +1140,17 @@ class RLAgent:
 
                 # === Load Model === #
                 model = dict()
-                with open(self.model_file, 'r') as infile:
+                with open(model_file, 'r') as infile:
                     model_text = infile.read().split('\n')
 
                 # === Interpret Model Line-by-Line === #
                 for line in model_text:
                     if line:
                         key, value = line.split(':')
-                        key = literal_eval(key)
+                        try:
+                            key = literal_eval(key)
+                        except (ValueError, SyntaxError):
+                            pass  # save_model writes class names without quotes
                         value = literal_eval(value)
                         model[key] = value
 
@@ -621,6 +1159,8 @@ class RLAgent:
 
             # === If Loading Fails, Return Empty Model Instead === #
             except:
+                if strict:
+                    raise
                 return dict()
 
         # === If Told Not to Use Saved Model === #
@@ -633,6 +1173,11 @@ class RLAgent:
     #       Added optional fileName for a save-as feature
     # ============================================================================
     def save_model(self, fileName = None):
+        # === Hashed Q-Tables and Linear Q-Functions Save Their Arrays === #
+        if isinstance(self.q_table, (HashedQTable, LinearQ)):
+            self.q_table.save(self.model_file if fileName is None else fileName)
+            return  # save_model
+
         # === Open Model File to Save === #
         if fileName is None:
             with open(self.model_file, 'w') as outfile:
@@ -647,16 +1192,66 @@ class RLAgent:
 
         return  # save_model
 
+    # ============================================================================
+    # RLAgent.export_policy
+    # ============================================================================
+    def export_policy(self, fileName = None):
+
+        # === A Linear Q-Function has No Per-Class Policy === #
+        if self.linear_q is not None:
+            print("Cannot export a frozen policy from a linear Q-function")
+            return None
+
+        # === One Axis per Classified Input, Then One per State Feature === #
+        n_axes = 1 if self.crop_regions is None else len(self.crop_regions)
+        shape = (len(self.frame_classes),) * n_axes + tuple(feature.n_bins for feature in self.state_features)
+        policy = np.zeros(shape, dtype=np.int8)
+
+        # === Greedy Action for Every State (Same Tie-Break as select_action) === #
+        for idx in np.ndindex(policy.shape):
+            classes = tuple(self.frame_classes[i] for i in idx[:n_axes])
+            state = classes if self.crop_regions is not None else classes[0]
+            if self.state_features:
+                state = (state if isinstance(state, tuple) else (state,)) + tuple(idx[n_axes:])
+            values = [V for V, N in self.get_q_value(state)]
+            policy[idx] = values.index(max(values))
+
+        # === Save the Compact Policy === #
+        np.save(self.policy_file if fileName is None else fileName, policy)
+        return policy  # export_policy
+
+    # ============================================================================
+    # RLAgent.load_policy
+    # ============================================================================
+    def load_policy(self, fileName = None):
+        self.frozen_policy = np.load(self.policy_file if fileName is None else fileName)
+        return  # load_policy
+
     # ============================================================================
     # RLAgent.act
     # ============================================================================
     def act(self, frame):
 
+        # === Recording a Session: the Recorder Downscales the Frame and Calls Back === #
+        if self.session_recorder is not None and not self.session_recorder.in_tick:
+            return self.session_recorder.act(self, frame)
+
+        # === Between Frames: Swap In Models that Finished Loading === #
+        if self.pending_swaps:
+            self.apply_pending_swaps()
+
+        # === Demo Mode with a Frozen Policy Takes the Fast Path === #
+        if not self.is_training and self.frozen_policy is not None:
+            return self.act_frozen(frame)
+
         # === Convert Frame to State (VFA with State Aggregation) === #
+        start = time.perf_counter()
         state = self.frame_to_state(frame)
+        classified = time.perf_counter()
 
         # === Select Action Given the State === #
         action_idx = self.select_action(state)
+        selected = time.perf_counter()
 
         # === If Training, Update History === #
         if self.is_training:
@@ -666,8 +1261,124 @@ class RLAgent:
         if len(self.history) > self.episode_length:
             self.propagate_reward()
 
+        # === Record the Tick === #
+        if self.telemetry is not None:
+            self.record_tick(state, action_idx, start, classified, selected)
+
         print('DEBUG: Action = {}'.format(self.action_space[action_idx]))
         #print('DEBUG: Reward = {}\n'.format(self.reward(self.get_q_value(state,action)))
 
         # === Return Action Taken === #
         return self.action_space[action_idx]
+
+    # ============================================================================
+    # RLAgent.record_tick
+    # ============================================================================
+    def record_tick(self, state, action_idx, start, classified, selected):
+        now = time.perf_counter()
+        probs = np.nan if self.last_probs is None else self.last_probs[0] # Near crop with lookahead
+        label = state[0] if isinstance(state, tuple) else state
+        self.telemetry.record(time.time(), CLASS_INDICES[label], probs, action_idx, self.new_reward(state, action_idx),
+                              self.explored, [V for V, _ in self.get_q_value(state)],
+                              ((classified - start) * 1e6, (selected - classified) * 1e6, (now - selected) * 1e6, (now - start) * 1e6))
+        return  # record_tick
+
+    # ============================================================================
+    # RLAgent.hot_swap_classifier
+    # ============================================================================
+    def hot_swap_classifier(self, classifier_file, on_done = None):
+
+        # === Necessary Imports === #
+        import threading
+
+        def load():
+            try:
+                # === Load and Wrap the Classifier Like the Constructor === #
+                if self.model_cache is not None and self.shadow is None:
+                    classifier_model = None
+                    classifier_predict = self.model_cache.load(classifier_file, 'tflite' if self.linear_q is None else 'tflite+embedding')
+                    primary_predict = classifier_predict
+                else:
+                    tf = load_tensorflow()
+                    classifier_model = tf.keras.models.load_model(classifier_file)
+                    classifier_predict, primary_predict = self.wrap_classifier(classifier_model)
+
+                # === Warm Up on the Real Input Shape and Check the Classes === #
+                zeros = np.zeros_like(self.classifier_input)
+                if primary_predict is not classifier_predict:
+                    primary_predict(zeros, training=False)
+                result = classifier_predict(zeros, training=False)
+                probs = result[0] if isinstance(result, (list, tuple)) else result
+                if np.shape(probs)[-1] != len(self.frame_classes):
+                    raise ValueError('{} has {} classes, the agent uses {}'.format(classifier_file, np.shape(probs)[-1], len(self.frame_classes)))
+                if self.linear_q is not None and np.size(result[1]) != self.embedding_size:
+                    raise ValueError('{} has {} features, the linear Q-function uses {}'.format(classifier_file, np.size(result[1]), self.embedding_size))
+
+                # === Queue the Swap; a Fresh Edge Cascade Learns the New Classifier === #
+                swap = {'classifier_file': classifier_file, 'classifier_model': classifier_model,
+                        'classifier_predict': classifier_predict, 'primary_predict': primary_predict}
+                if self.edge_cascade is not None:
+                    swap['edge_cascade'] = EdgeCascade(n_classes=len(self.frame_classes))
+                self.pending_swaps.append(swap)
+                message = 'Classifier {} loaded, swapping in on the next frame'.format(classifier_file)
+                success = True
+            except Exception as error:
+                message = 'Could not load classifier {}: {}'.format(classifier_file, error)
+                success = False
+            print(message)
+            if on_done is not None:
+                on_done(success, message)
+
+        loader = threading.Thread(target=load, daemon=True)
+        loader.start()
+        return loader  # hot_swap_classifier
+
+    # ============================================================================
+    # RLAgent.hot_swap_q_table
+    # ============================================================================
+    def hot_swap_q_table(self, fileName, on_done = None):
+
+        # === Necessary Imports === #
+        import os
+        import threading
+
+        def load():
+            # === load_model Falls Back to an Empty Table, so Check the File First === #
+            if not os.path.isfile(fileName):
+                success, message = False, 'Could not load Q-Table {}: no such file'.format(fileName)
+            else:
+                try:
+                    q_table = self.load_model(True, fileName, strict=True)
+                    self.pending_swaps.append({'q_table': q_table, 'model_file': fileName})
+                    success, message = True, 'Q-Table {} loaded, swapping in on the next frame'.format(fileName)
+                except Exception as error:
+                    success, message = False, 'Could not load Q-Table {}: {}'.format(fileName, error)
+            print(message)
+            if on_done is not None:
+                on_done(success, message)
+
+        loader = threading.Thread(target=load, daemon=True)
+        loader.start()
+        return loader  # hot_swap_q_table
+
+    # ============================================================================
+    # RLAgent.apply_pending_swaps
+    # ============================================================================
+    def apply_pending_swaps(self):
+        while self.pending_swaps:
+            swap = self.pending_swaps.pop(0)
+            self.__dict__.update(swap)
+            if 'classifier_predict' in swap and self.shadow is not None:
+                self.shadow.reset() # The comparison is against the new primary from here on
+        return  # apply_pending_swaps
+
+    # ============================================================================
+    # RLAgent.act_frozen
+    # ============================================================================
+    def act_frozen(self, frame):
+
+        # === Classify -> Array Index -> Action === #
+        idx = self.classify_frame(frame)
+        if self.state_features:
+            idx = (idx if isinstance(idx, tuple) else (idx,)) + self.feature_values(frame)
+        return self.action_space[self.frozen_policy[idx]]
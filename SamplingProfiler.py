@@ -0,0 +1,200 @@
+# ================================================================================
+# FILE: SamplingProfiler.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Low-overhead sampling profiler for the control loop, which can be started and
+# stopped while the program runs (Options > Toggle Profiler, ctrl+r), from the
+# command line (python main.py --profile [SECONDS]) or from the environment
+# (MARIOKART_PROFILE=1 or =SECONDS).
+#
+# A background thread wakes every `interval` seconds and records the call stack
+# of the profiled thread (the GUI thread, where the QTimer runs the control
+# loop) from sys._current_frames. The loop itself is never instrumented, so the
+# cost is one stack walk per sample, a fraction of a percent at the default
+# 200 Hz, and every caller (holdKey, the classifier's predict, setCaptureFrame,
+# PIL conversions, ...) shows up with its share of the samples.
+#
+# When stopped, two files are written to `directory`:
+#   * profile_<time>.collapsed: one "frame;frame;...;frame count" line per
+#     distinct stack, the collapsed format read by flamegraph.pl, speedscope and
+#     inferno
+#   * profile_<time>.txt: the top_n functions by self samples (the function was
+#     running) and by total samples (the function was on the stack)
+#
+# ================================================================================
+# CLASS: SamplingProfiler
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - interval (optional):
+#        * Default = 0.005 seconds between samples
+#   - thread_id (optional):
+#        * Default = None (the main thread)
+#   - directory (optional):
+#        * Default = 'profiles'
+#   - top_n (optional):
+#        * Default = 25
+#
+# ================================================================================
+# MEMBER FUNCTION: SamplingProfiler.start( ) / stop( ) / toggle( )
+# ================================================================================
+#
+# Task:
+#   - start clears the samples and starts the sampling thread
+#   - stop stops it and writes the collapsed stacks and the summary; it returns
+#     the two file names (None if no sample was taken)
+#   - toggle does whichever applies and returns a message for the user
+#
+# ================================================================================
+# MEMBER FUNCTION: SamplingProfiler.summary( )
+# ================================================================================
+#
+# Output:
+#   - text table of the top_n functions by self and by total samples
+#
+# ================================================================================
+# Function: profile_request( seconds )
+# ================================================================================
+#
+# Input:
+#   - seconds:
+#        * value of the --profile flag (None when the flag is absent)
+#
+# Output:
+#   - None if profiling was not asked for, else how many seconds to profile for
+#     (0 = until stopped). The flag wins over MARIOKART_PROFILE.
+#
+# ================================================================================
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+PROFILE_ENVIRONMENT_VARIABLE = 'MARIOKART_PROFILE'
+
+
+# ================================================================================
+# profile_request
+# ================================================================================
+def profile_request(seconds=None):
+    if seconds is not None:
+        return seconds
+    value = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, '').strip()
+    if value in ('', '0'):
+        return None
+    try:
+        return float(value) if value.lower() not in ('1', 'true', 'yes', 'on') else 0
+    except ValueError:
+        return 0
+
+
+class SamplingProfiler:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, interval=0.005, thread_id=None, directory='profiles', top_n=25):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.directory = directory
+        self.top_n = top_n
+        self.samples = Counter()
+        self.started = None
+        self.stopEvent = threading.Event()
+        self.sampler = None
+        return
+
+    @property
+    def running(self):
+        return self.sampler is not None and self.sampler.is_alive()
+
+    # ============================================================================
+    # SamplingProfiler.start( )
+    # ============================================================================
+    def start(self):
+        if self.running:
+            return
+        self.samples = Counter()
+        self.started = time.time()
+        self.stopEvent.clear()
+        self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+        self.sampler.start()
+        return
+
+    # ============================================================================
+    # SamplingProfiler.sample_loop( ) -- one stack walk per interval
+    # ============================================================================
+    def sample_loop(self):
+        while not self.stopEvent.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = list()
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1 # Root first
+        return
+
+    # ============================================================================
+    # SamplingProfiler.stop( )
+    # ============================================================================
+    def stop(self):
+        if not self.running:
+            return None, None
+        self.stopEvent.set()
+        self.sampler.join()
+        if not self.samples:
+            return None, None
+
+        # === Collapsed Stacks and Summary, Named After the Start Time === #
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, 'profile_{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))))
+        with open(base + '.collapsed', 'w') as outfile:
+            for stack, count in self.samples.most_common():
+                outfile.write('{} {}\n'.format(';'.join(self.frame_name(code) for code in stack), count))
+        with open(base + '.txt', 'w') as outfile:
+            outfile.write(self.summary())
+        return base + '.collapsed', base + '.txt'
+
+    # ============================================================================
+    # SamplingProfiler.toggle( )
+    # ============================================================================
+    def toggle(self):
+        if not self.running:
+            self.start()
+            return 'Profiler started ({:.0f} Hz)'.format(1 / self.interval)
+        collapsed, summary = self.stop()
+        if collapsed is None:
+            return 'Profiler stopped, no samples taken'
+        return 'Profiler stopped: {} samples in {} and {}'.format(sum(self.samples.values()), collapsed, summary)
+
+    # ============================================================================
+    # SamplingProfiler.frame_name( code ) -- "function (file:line)"
+    # ============================================================================
+    def frame_name(self, code):
+        return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    # ============================================================================
+    # SamplingProfiler.summary( )
+    # ============================================================================
+    def summary(self):
+        total = sum(self.samples.values())
+        selfCounts = Counter()
+        totalCounts = Counter()
+        for stack, count in self.samples.items():
+            selfCounts[stack[-1]] += count
+            for code in set(stack):
+                totalCounts[code] += count
+
+        lines = ['{} samples every {:.1f} ms ({:.1f} s)'.format(total, self.interval * 1000, total * self.interval)]
+        for title, counts in (('Self (running)', selfCounts), ('Total (on the stack)', totalCounts)):
+            lines.append('')
+            lines.append('{:>8} {:>7}  {}'.format('samples', 'share', title))
+            for code, count in counts.most_common(self.top_n):
+                lines.append('{:>8} {:>6.1%}  {}'.format(count, count / max(1, total), self.frame_name(code)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,359 @@
+# ================================================================================
+# FILE: SessionReplay.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Record-and-replay of live runs, so a slowdown or a change in behaviour seen on
+# the rig can be reproduced (and bisected) on any machine, without the emulator.
+#
+# A SessionRecorder attached to an agent (RLAgent.session_recorder) downscales
+# every frame before the agent sees it, so the frames the agent acts on live
+# are exactly the frames stored. By default only the classifier-sized grayscale
+# frame is kept, which changes nothing for whole-frame classification. Agents
+# with lookahead crops, extra state features or an edge cascade keep the full
+# frame in colour instead, since the hitbox template, the crops and the edge
+# thresholds are tuned for full-resolution captures; recording must not change
+# the policy it records. Frames are stored in chunks in a
+# compressed zip archive by a background thread. The archive also holds the
+# agent's configuration and random seed, the Q-Table before the first tick and
+# after the last one, and per tick the wall-clock time, decision latency,
+# training flag and action.
+#
+# replay_session builds an agent with the same configuration, seed and starting
+# Q-Table, feeds the frames back through RLAgent.act and checks that every action
+# and the final Q-Table match the recording. It also compares the decision
+# latencies with the recorded ones. Run as a script, it exits with status 1 on a
+# mismatch, for use with git bisect run:
+#
+#     python SessionReplay.py session.zip
+#
+# Sessions are recorded from the start of a run. Hot swaps of the classifier or
+# Q-Table during a recorded run are not replayed.
+#
+# ================================================================================
+# CLASS: SessionRecorder
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - fileName:
+#        * path of the zip archive to write
+#   - agent:
+#        * the RLAgent to record, before its first tick
+#   - downscale (optional):
+#        * Default = None (classifier-sized grayscale frames, or the full frame
+#          in colour when the agent needs more than the classifier input)
+#        * an integer keeps every downscale-th pixel of the frame in colour
+#   - chunk_frames (optional):
+#        * Default = None (as many frames as fit in chunk_bytes)
+#   - chunk_bytes (optional):
+#        * Default = 64 MB, size of a chunk of frames when chunk_frames is None
+#
+# ================================================================================
+# MEMBER FUNCTION: SessionRecorder.act( agent , frame )
+# ================================================================================
+#
+# Output:
+#   - the agent's action for the downscaled frame, which is recorded with the
+#     tick's time, latency and training flag
+#
+# ================================================================================
+# MEMBER FUNCTION: SessionRecorder.close( )
+# ================================================================================
+#
+# Task:
+#   - write the last frames, the tick arrays and the final Q-Table, and close the
+#     archive
+#
+# ================================================================================
+# Function: q_table_digest( q_table )
+# ================================================================================
+#
+# Output:
+#   - SHA-256 of the contents of a dictionary Q-Table, HashedQTable or LinearQ,
+#     independent of the order the states were added in
+#
+# ================================================================================
+# Function: replay_session( fileName , verbose )
+# ================================================================================
+#
+# Output:
+#   - dictionary with the number of ticks, the action mismatches (and the first
+#     one), whether the final Q-Table matches, and the median/95th percentile of
+#     the recorded and replayed decision latencies
+#
+# ================================================================================
+import io
+import os
+import json
+import time
+import pickle
+import queue
+import hashlib
+import zipfile
+import threading
+import numpy as np
+from frame_processing import CLASSIFIER_IMAGE_SIZE, preprocess_frame
+
+TICK_DTYPE = np.dtype([('time', '<f8'), ('latency', '<f4'), ('action', '<i1'), ('training', 'u1')])
+
+
+# ================================================================================
+# q_table_digest
+# ================================================================================
+def q_table_digest(q_table):
+    digest = hashlib.sha256()
+    if isinstance(q_table, dict):
+        for state, q_value in sorted(q_table.items(), key=lambda item: repr(item[0])):
+            digest.update(repr((state, q_value)).encode())
+    else:
+        for name in ('values', 'counts', 'owners', 'weights'):
+            if hasattr(q_table, name):
+                digest.update(np.ascontiguousarray(getattr(q_table, name)).tobytes())
+    return digest.hexdigest()
+
+
+# ================================================================================
+# agent_config -- what replay_session needs to rebuild the agent
+# ================================================================================
+def agent_config(agent):
+    encoder = agent.state_encoder
+    return {
+        'classifier_file': agent.classifier_file,
+        'crop_regions': agent.crop_regions,
+        'use_edge_cascade': agent.edge_cascade is not None,
+        'state_features': [type(feature).__name__ for feature in agent.state_features],
+        'state_encoder': None if encoder is None else [encoder.n_buckets, encoder.n_tilings, encoder.tile_width],
+        'linear_q': agent.linear_q,
+        'model_cache': agent.model_cache is not None and agent.classifier_model is None, # TFLite rather than keras
+        'seed': agent.seed,
+        'action_space': agent.action_space,
+        'episode_length': agent.episode_length,
+        'max_episodes': agent.max_episodes,
+        'explore': [agent.explore_chance, agent.explore_decay, agent.explore_min]
+    }
+
+
+class SessionRecorder:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, fileName, agent, downscale=None, chunk_frames=None, chunk_bytes=64 * 2 ** 20):
+        if downscale is None and (agent.crop_regions is not None or agent.state_features or agent.edge_cascade is not None):
+            downscale = 1 # These need the full frame, as the live agent sees it
+        self.downscale = downscale
+        self.chunk_frames = chunk_frames
+        self.chunk_bytes = chunk_bytes
+        self.frames = None
+        self.filled = 0
+        self.chunks = 0
+        self.ticks = list()
+        self.in_tick = False
+        self.agent = agent
+
+        # === Configuration and Starting Point of the Run === #
+        self.archive = zipfile.ZipFile(fileName, 'w', compression=zipfile.ZIP_DEFLATED)
+        config = agent_config(agent)
+        config['downscale'] = downscale
+        self.archive.writestr('config.json', json.dumps(config))
+        self.archive.writestr('q_table_initial.pkl', pickle.dumps(agent.q_table))
+        if agent.frozen_policy is not None:
+            self.write_array('frozen_policy.npy', agent.frozen_policy)
+
+        # === Chunks are Compressed on a Background Thread === #
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        return
+
+    # ============================================================================
+    # SessionRecorder.downscale_frame( frame )
+    # ============================================================================
+    def downscale_frame(self, frame):
+        if self.downscale is None:
+            return preprocess_frame(frame, CLASSIFIER_IMAGE_SIZE)
+        frame = np.asarray(frame)
+        return np.ascontiguousarray(frame[::self.downscale, ::self.downscale, :3])
+
+    # ============================================================================
+    # SessionRecorder.act( agent , frame )
+    # ============================================================================
+    def act(self, agent, frame):
+        frame = self.downscale_frame(frame)
+        training = agent.is_training
+
+        # === The Agent Acts on the Frame Exactly as Stored === #
+        self.in_tick = True
+        start = time.perf_counter()
+        try:
+            action = agent.act(frame)
+        finally:
+            self.in_tick = False
+        latency = time.perf_counter() - start
+
+        # === Keep the Frame and the Tick === #
+        if self.frames is None:
+            if self.chunk_frames is None:
+                self.chunk_frames = max(1, self.chunk_bytes // frame.nbytes)
+            self.frames = np.empty((self.chunk_frames,) + frame.shape, dtype=np.uint8)
+        self.frames[self.filled] = frame
+        self.filled += 1
+        self.ticks.append((time.time(), latency, agent.action_space.index(action), training))
+        if self.filled == self.chunk_frames:
+            self.flush()
+        return action
+
+    # ============================================================================
+    # SessionRecorder.flush( ) -- hand the filled frames to the writer
+    # ============================================================================
+    def flush(self):
+        if self.filled == 0:
+            return
+        self.pending.put(('frames_{:05d}.npy'.format(self.chunks), self.frames[:self.filled]))
+        self.frames = np.empty_like(self.frames)
+        self.chunks += 1
+        self.filled = 0
+        return
+
+    # ============================================================================
+    # SessionRecorder.write_array( name , array ) / write_loop( )
+    # ============================================================================
+    def write_array(self, name, array):
+        buffer = io.BytesIO()
+        np.save(buffer, array)
+        self.archive.writestr(name, buffer.getvalue())
+        return
+
+    def write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            self.write_array(*item)
+        return
+
+    # ============================================================================
+    # SessionRecorder.close( )
+    # ============================================================================
+    def close(self):
+        if self.archive is None:
+            return
+        self.flush()
+        self.pending.put(None)
+        self.writer.join()
+
+        # === Ticks and the Final Q-Table to Check the Replay Against === #
+        self.write_array('ticks.npy', np.array(self.ticks, dtype=TICK_DTYPE))
+        self.archive.writestr('q_table_final.pkl', pickle.dumps(self.agent.q_table))
+        self.archive.writestr('summary.json', json.dumps({'ticks': len(self.ticks), 'chunks': self.chunks,
+                                                          'q_table_digest': q_table_digest(self.agent.q_table)}))
+        self.archive.close()
+        self.archive = None
+        return
+
+    # ============================================================================
+    # SessionRecorder.report( )
+    # ============================================================================
+    def report(self):
+        return 'Session recorder: {} ticks in {} chunk(s)'.format(len(self.ticks), self.chunks + (self.filled > 0))
+
+
+# ================================================================================
+# replay_session
+# ================================================================================
+def replay_session(fileName, verbose=True):
+
+    # === Necessary Imports === #
+    import tempfile
+    import contextlib
+    from RLAgent import RLAgent
+    from StateEncoder import StateEncoder
+
+    with zipfile.ZipFile(fileName, 'r') as archive:
+        config = json.loads(archive.read('config.json'))
+        summary = json.loads(archive.read('summary.json'))
+        ticks = np.load(io.BytesIO(archive.read('ticks.npy')))
+        names = set(archive.namelist())
+
+        # === Rebuild the Agent as It Was Before the First Tick === #
+        features = list()
+        for name in config['state_features']:
+            if name != 'LateralOffsetFeature':
+                raise ValueError('Cannot rebuild state feature {}'.format(name))
+            from HitboxFinder import LateralOffsetFeature
+            features.append(LateralOffsetFeature())
+        encoder = None if config['state_encoder'] is None else StateEncoder(*config['state_encoder'])
+        cache = None
+        if config.get('model_cache'):
+            from ModelCache import ModelCache
+            cache = ModelCache() # Same TFLite backend as the live run
+        np.random.seed(config['seed'])
+        agent = RLAgent(use_existing_model=False, episode_length=config['episode_length'], max_episodes=config['max_episodes'],
+                        classifier_file=config['classifier_file'],
+                        crop_regions=None if config['crop_regions'] is None else [tuple(c) for c in config['crop_regions']],
+                        use_edge_cascade=config['use_edge_cascade'], state_features=features or None,
+                        state_encoder=encoder, linear_q=config['linear_q'], model_cache=cache, seed=config['seed'])
+        agent.q_table = pickle.loads(archive.read('q_table_initial.pkl'))
+        agent.explore_chance, agent.explore_decay, agent.explore_min = config['explore']
+        if 'frozen_policy.npy' in names:
+            agent.frozen_policy = np.load(io.BytesIO(archive.read('frozen_policy.npy')))
+        scratch = tempfile.mkdtemp()
+        agent.model_file = os.path.join(scratch, os.path.basename(agent.model_file)) # End-of-training saves stay out of the way
+
+        # === Feed the Frames Back Through act() === #
+        actions = np.empty(len(ticks), dtype=np.int8)
+        latencies = np.empty(len(ticks), dtype=np.float32)
+        tick = 0
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for chunk in range(summary['chunks']):
+                for frame in np.load(io.BytesIO(archive.read('frames_{:05d}.npy'.format(chunk)))):
+                    agent.is_training = bool(ticks['training'][tick])
+                    start = time.perf_counter()
+                    action = agent.act(frame)
+                    latencies[tick] = time.perf_counter() - start
+                    actions[tick] = config['action_space'].index(action)
+                    tick += 1
+
+    # === Compare with the Recording === #
+    if tick == 0:
+        raise ValueError('{} holds no ticks'.format(fileName))
+    mismatches = np.nonzero(actions[:tick] != ticks['action'][:tick])[0]
+    result = {
+        'ticks': tick,
+        'action_mismatches': len(mismatches),
+        'first_mismatch': int(mismatches[0]) if len(mismatches) > 0 else None,
+        'q_table_match': q_table_digest(agent.q_table) == summary['q_table_digest'],
+        'recorded_latency_ms': (float(np.median(ticks['latency']) * 1000), float(np.percentile(ticks['latency'], 95) * 1000)),
+        'replayed_latency_ms': (float(np.median(latencies[:tick]) * 1000), float(np.percentile(latencies[:tick], 95) * 1000))
+    }
+    if verbose:
+        print('Replayed {} ticks of {}: {} action mismatch(es){}, final Q-Table {}'.format(
+            tick, fileName, result['action_mismatches'],
+            '' if result['first_mismatch'] is None else ' (first at tick {})'.format(result['first_mismatch']),
+            'matches' if result['q_table_match'] else 'DIFFERS'))
+        print('Decision latency median/p95: recorded {:.2f}/{:.2f} ms, replayed {:.2f}/{:.2f} ms'.format(
+            *result['recorded_latency_ms'], *result['replayed_latency_ms']))
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    from SamplingProfiler import SamplingProfiler, profile_request
+    parser = argparse.ArgumentParser(description="Replay a recorded session through the agent")
+    parser.add_argument("session", help="zip archive written by python main.py --record-session")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the replay with the sampling profiler (also MARIOKART_PROFILE=1)")
+    args = parser.parse_args()
+
+    # === Headless Profiling of the Replayed Control Loop === #
+    profiler = SamplingProfiler() if args.profile or profile_request() is not None else None
+    if profiler is not None:
+        profiler.start()
+    outcome = replay_session(args.session)
+    if profiler is not None:
+        print(profiler.toggle())
+    sys.exit(0 if outcome['action_mismatches'] == 0 and outcome['q_table_match'] else 1)
@@ -0,0 +1,225 @@
+# ================================================================================
+# FILE: ShadowMode.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Shadow-mode A/B qualification of a candidate classifier against the primary one
+# on live frames. fused_model joins both classifiers into a single call on one
+# input; traced with tf.function, both models end up in one graph and TensorFlow
+# runs the two independent branches concurrently. The models are called rather
+# than nested in a new keras model, since two Sequential models saved without a
+# name are both called "sequential" and keras refuses duplicate layer names.
+# Only the primary's output drives the
+# agent. ShadowStats accumulates the agreement matrix of the two classifiers over
+# frame_classes and their latencies, and dump() reports them on demand.
+#
+# Latency is measured for the fused call on every frame. Every sample_every-th
+# frame the primary and the candidate are also timed on their own with the same
+# input, which gives the cost of each alone and the overhead of the fused call.
+#
+# ================================================================================
+# Function: fused_model( primary_model , candidate_model )
+# ================================================================================
+#
+# Input:
+#   - primary_model:
+#        * the model the agent calls (a classifier, or LinearQ.embedding_model of one)
+#   - candidate_model:
+#        * the candidate classifier, with the same input shape
+#
+# Output:
+#   - function( inputs , training ) returning the list of the primary's output(s)
+#     followed by the candidate's class probabilities, to be traced with
+#     tf.function
+#
+# ================================================================================
+# CLASS: ShadowStats
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - candidate_file:
+#        * keras classifier to qualify
+#   - frame_classes:
+#        * the agent's dictionary of class indices to names
+#   - sample_every (optional):
+#        * Default = 100
+#   - max_samples (optional):
+#        * Default = 10000, latencies kept per series (the oldest are dropped)
+#
+# ================================================================================
+# MEMBER FUNCTION: ShadowStats.record( primary_labels , candidate_labels , seconds , inputs , primary_predict )
+# ================================================================================
+#
+# Task:
+#   - add the frame's (primary, candidate) class pairs to the agreement matrix and
+#     the fused call's latency to its series
+#   - on sampled frames, time primary_predict and the candidate alone on inputs
+#
+# ================================================================================
+# MEMBER FUNCTION: ShadowStats.reset( )
+# ================================================================================
+#
+# Task:
+#   - clear the matrix and latencies, e.g. after a new primary is swapped in
+#
+# ================================================================================
+# MEMBER FUNCTION: ShadowStats.dump( fileName )
+# ================================================================================
+#
+# Input:
+#   - fileName (optional):
+#        * Default = None, otherwise the matrix and latencies are also saved there
+#          with numpy.savez
+#
+# Output:
+#   - text report: overall and per-class agreement, the agreement matrix (rows =
+#     primary, columns = candidate) and median/95th percentile latencies
+#
+# ================================================================================
+# Command line check
+# ================================================================================
+#
+#     python ShadowMode.py classifier_v4.h5 new_classifier.h5 [--linear-q rls]
+#
+# builds an agent in shadow mode with the two classifiers, runs a few frames and
+# a hot swap of the primary through it, and prints the report. It exits with
+# status 1 if any step fails, e.g. before trying a freshly trained model with
+# python main.py --shadow.
+#
+# ================================================================================
+import time
+from collections import deque
+import numpy as np
+
+
+# ================================================================================
+# fused_model
+# ================================================================================
+def fused_model(primary_model, candidate_model):
+
+    def fused(inputs, training=False):
+        primary_outputs = primary_model(inputs, training=training)
+        if not isinstance(primary_outputs, (list, tuple)):
+            primary_outputs = [primary_outputs]
+        return list(primary_outputs) + [candidate_model(inputs, training=training)]
+    return fused
+
+
+class ShadowStats:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, candidate_file, frame_classes, sample_every=100, max_samples=10000):
+
+        # === Necessary Imports === #
+        from RLAgent import load_tensorflow
+        tf = load_tensorflow() # Enables GPU memory growth before the first model is loaded
+
+        self.candidate_file = candidate_file
+        self.candidate_model = tf.keras.models.load_model(candidate_file)
+        if self.candidate_model.output_shape[-1] != len(frame_classes):
+            raise ValueError('{} has {} classes, the agent uses {}'.format(
+                candidate_file, self.candidate_model.output_shape[-1], len(frame_classes)))
+        self.candidate_predict = tf.function(self.candidate_model, reduce_retracing=True)
+
+        self.frame_classes = frame_classes
+        self.sample_every = sample_every
+        self.max_samples = max_samples
+        self.reset()
+        return
+
+    # ============================================================================
+    # ShadowStats.reset( )
+    # ============================================================================
+    def reset(self):
+        self.matrix = np.zeros((len(self.frame_classes), len(self.frame_classes)), dtype=np.int64)
+        self.frames = 0
+        self.latency = {name: deque(maxlen=self.max_samples) for name in ('fused', 'primary', 'candidate')}
+        return
+
+    # ============================================================================
+    # ShadowStats.record( ... )
+    # ============================================================================
+    def record(self, primary_labels, candidate_labels, seconds, inputs, primary_predict):
+        np.add.at(self.matrix, (np.ravel(primary_labels), np.ravel(candidate_labels)), 1)
+        self.latency['fused'].append(seconds)
+        self.frames += 1
+
+        # === Occasionally Time Each Classifier Alone on the Same Input === #
+        if self.frames % self.sample_every == 0:
+            for name, predict in (('primary', primary_predict), ('candidate', self.candidate_predict)):
+                start = time.perf_counter()
+                outputs = predict(inputs, training=False)
+                for output in (outputs if isinstance(outputs, (list, tuple)) else [outputs]):
+                    np.asarray(output)
+                self.latency[name].append(time.perf_counter() - start)
+        return
+
+    # ============================================================================
+    # ShadowStats.dump( fileName=None )
+    # ============================================================================
+    def dump(self, fileName=None):
+        total = self.matrix.sum()
+        lines = ['Shadow mode: primary vs {} over {} classifications'.format(self.candidate_file, total)]
+        if total > 0:
+            lines.append('Agreement: {:.2%}'.format(np.trace(self.matrix) / total))
+
+        # === Agreement Matrix (Rows = Primary, Columns = Candidate) === #
+        names = [self.frame_classes[i] for i in range(len(self.frame_classes))]
+        lines.append('{:>16} '.format('') + ' '.join('{:>6}'.format(i) for i in range(len(names))) + '   agree')
+        for i, name in enumerate(names):
+            row = self.matrix[i]
+            agree = '{:>7.1%}'.format(row[i] / row.sum()) if row.sum() > 0 else '{:>7}'.format('-')
+            lines.append('{:>13} {:>2} '.format(name, i) + ' '.join('{:>6}'.format(v) for v in row) + ' ' + agree)
+
+        # === Latencies === #
+        for name, series in self.latency.items():
+            if series:
+                values = np.array(series) * 1000
+                lines.append('{:>9} latency: median {:.3f} ms, p95 {:.3f} ms ({} samples)'.format(
+                    name, np.median(values), np.percentile(values, 95), len(values)))
+
+        if fileName is not None:
+            np.savez(fileName, matrix=self.matrix, classes=np.array(names),
+                     **{'latency_' + name: np.array(series) for name, series in self.latency.items()})
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import io
+    import sys
+    import argparse
+    import contextlib
+    parser = argparse.ArgumentParser(description="Check that two classifiers run together in shadow mode")
+    parser.add_argument("primary", help="classifier driving the agent, e.g. classifier_v4.h5")
+    parser.add_argument("candidate", help="classifier to qualify, e.g. one from CNN/train_classifier.py")
+    parser.add_argument("--linear-q", choices=["rls", "sgd"], default=None)
+    parser.add_argument("--frames", type=int, default=20)
+    args = parser.parse_args()
+
+    # === Necessary Imports === #
+    from RLAgent import RLAgent
+
+    try:
+        # === Same Agent as python main.py --shadow, Fed Random Frames === #
+        agent = RLAgent(use_existing_model=False, classifier_file=args.primary, linear_q=args.linear_q,
+                        shadow_classifier_file=args.candidate)
+        frames = np.random.RandomState(0).randint(0, 256, (4, 480, 640, 4)).astype(np.uint8)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(args.frames):
+                agent.act(frames[i % len(frames)])
+            swap = list()
+            agent.hot_swap_classifier(args.candidate, lambda success, message: swap.append(message)).join() # Fused with the candidate too
+            for i in range(args.frames):
+                agent.act(frames[i % len(frames)])
+    except Exception as error:
+        print('Shadow mode check failed: {}: {}'.format(type(error).__name__, error))
+        sys.exit(1)
+    print(agent.shadow_report())
+    if agent.classifier_file != args.candidate:
+        print('Shadow mode check failed: {}'.format(swap[0] if swap else 'the hot swap was not applied'))
+        sys.exit(1)
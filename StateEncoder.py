@@ -0,0 +1,278 @@
+# ================================================================================
+# FILE: StateEncoder.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Fixed-size Q-Table for states made of arbitrary feature tuples (the lookahead
+# crops, the lateral-offset bin, Canny edge tuples, ...), whose number of
+# combinations would otherwise grow the dictionary-keyed Q-Table without bound.
+#
+# A StateEncoder maps a state to one bucket in each of n_tilings tilings of a
+# table of n_buckets rows by hashing it (feature hashing). Numeric components are
+# first quantized into tiles of tile_width, each tiling shifted by
+# tile_width / n_tilings (tile coding), so states with nearby numeric features
+# share some of their buckets and generalize to each other. Strings are kept as
+# they are. The hash is CRC-32, which is stable from run to run (unlike Python's
+# hash() of strings), so saved tables stay valid.
+#
+# A HashedQTable stores a (value, count) pair per action in each bucket, in two
+# preallocated numpy arrays, so its memory and the cost of a lookup do not depend
+# on how many features a state has or how many distinct states are seen. It has
+# the parts of the dictionary interface RLAgent uses, so it can replace q_table
+# directly.
+#
+# ================================================================================
+# CLASS: StateEncoder
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - n_buckets (optional):
+#        * Default = 4096
+#        * rows of the table the states are hashed into
+#   - n_tilings (optional):
+#        * Default = 1
+#        * number of buckets (one per tiling) each state is spread over
+#   - tile_width (optional):
+#        * Default = 1.0
+#        * width of a tile for numeric state components
+#
+# ================================================================================
+# MEMBER FUNCTION: StateEncoder.encode( state )
+# ================================================================================
+#
+# Input:
+#   - state:
+#        * a class name, or a tuple of class names and numbers
+#
+# Output:
+#   - tuple of n_tilings bucket indices
+#
+# Note:
+#   - results are memoized in a cache of at most cache_size states
+#
+# ================================================================================
+# MEMBER FUNCTION: StateEncoder.fingerprint( state )
+# ================================================================================
+#
+# Output:
+#   - a second, independent 32-bit hash of the state, used to detect collisions
+#
+# ================================================================================
+# CLASS: HashedQTable
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - encoder:
+#        * the StateEncoder mapping states to buckets
+#   - n_actions:
+#        * number of actions in the agent's action space
+#
+# ================================================================================
+# MEMBER FUNCTION: HashedQTable.get( state , default )
+# ================================================================================
+#
+# Output:
+#   - list of (value, count) pairs per action, as stored in a dictionary Q-Table.
+#     The value is the mean over the state's tilings and the count their minimum.
+#   - default if none of the state's buckets has been written yet
+#
+# ================================================================================
+# MEMBER FUNCTION: HashedQTable.__setitem__( state , q_value )
+# ================================================================================
+#
+# Input:
+#   - q_value:
+#        * list of (value, count) pairs per action
+#
+# Task:
+#   - move every tiling's value by the change from the current estimate, so the
+#     state's estimate becomes the given value (exactly, with a single tiling)
+#   - record a collision when a bucket last written by a different state is written
+#
+# ================================================================================
+# MEMBER FUNCTION: HashedQTable.collision_stats( )
+# ================================================================================
+#
+# Output:
+#   - dictionary with the number of occupied buckets, the load factor, the number
+#     of writes and how many of them landed in a bucket owned by another state
+#
+# ================================================================================
+# MEMBER FUNCTION: HashedQTable.save( fileName ) / HashedQTable.load( fileName , encoder , n_actions )
+# ================================================================================
+#
+# Task:
+#   - save the table arrays and encoder settings with numpy.savez_compressed
+#   - load them back; load returns a new HashedQTable (an empty one if the file
+#     cannot be read, or raises the error with strict=True)
+#
+# ================================================================================
+import zlib
+import numpy as np
+from collections import OrderedDict
+
+
+class StateEncoder:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, n_buckets=4096, n_tilings=1, tile_width=1.0, cache_size=4096):
+        self.n_buckets = n_buckets
+        self.n_tilings = n_tilings
+        self.tile_width = tile_width
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        return
+
+    # ============================================================================
+    # StateEncoder.encode( state )
+    # ============================================================================
+    def encode(self, state):
+        buckets = self.cache.get(state)
+        if buckets is not None:
+            self.cache.move_to_end(state)
+            return buckets
+
+        # === Quantize Numeric Components, Shifted per Tiling, and Hash === #
+        components = state if isinstance(state, tuple) else (state,)
+        buckets = list()
+        for tiling in range(self.n_tilings):
+            shift = self.tile_width * tiling / self.n_tilings
+            tiles = tuple(int(np.floor((c + shift) / self.tile_width)) if isinstance(c, (int, float, np.number)) else c
+                          for c in components)
+            buckets.append(zlib.crc32(repr((tiling,) + tiles).encode()) % self.n_buckets)
+        buckets = tuple(buckets)
+
+        # === Bounded Memo of Recent States === #
+        self.cache[state] = buckets
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return buckets
+
+    # ============================================================================
+    # StateEncoder.fingerprint( state )
+    # ============================================================================
+    def fingerprint(self, state):
+        return zlib.adler32(repr(state).encode())
+
+
+class HashedQTable:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, encoder, n_actions):
+        self.encoder = encoder
+        self.n_actions = n_actions
+        self.values = np.zeros((encoder.n_buckets, n_actions), dtype=np.float64)
+        self.counts = np.zeros((encoder.n_buckets, n_actions), dtype=np.int64)
+        self.owners = np.full(encoder.n_buckets, -1, dtype=np.int64)
+        self.writes = 0
+        self.collisions = 0
+        return
+
+    # ============================================================================
+    # HashedQTable.get( state , default=None )
+    # ============================================================================
+    def get(self, state, default=None):
+        buckets = list(self.encoder.encode(state))
+        if (self.owners[buckets] < 0).all():
+            return default
+        values = self.values[buckets].mean(axis=0)
+        counts = self.counts[buckets].min(axis=0)
+        return [(float(V), int(N)) for V, N in zip(values, counts)]
+
+    # ============================================================================
+    # HashedQTable[state]
+    # ============================================================================
+    def __getitem__(self, state):
+        q_value = self.get(state)
+        if q_value is None:
+            raise KeyError(state)
+        return q_value
+
+    def __setitem__(self, state, q_value):
+        buckets = list(self.encoder.encode(state))
+        current = self.get(state, [(0, 0)] * self.n_actions)
+
+        # === Shift Each Tiling by the Change in the Estimate === #
+        # np.add.at shifts a bucket once per tiling that hashed to it. A bucket
+        # shared by m tilings then moves the mean m * m times as much, so the
+        # shift is scaled by n / sum(m * m) to make get() return q_value exactly
+        # (the scale is 1 without shared buckets).
+        unique, multiplicity = np.unique(buckets, return_counts=True)
+        scale = len(buckets) / float(np.sum(multiplicity * multiplicity))
+        change = np.array([V - old_V for (V, _), (old_V, _) in zip(q_value, current)])
+        np.add.at(self.values, buckets, change * scale)
+        self.counts[unique] += np.array([N - old_N for (_, N), (_, old_N) in zip(q_value, current)]) # One visit per bucket
+
+        # === Collision Bookkeeping === #
+        owner = self.encoder.fingerprint(state)
+        for bucket in buckets:
+            self.writes += 1
+            if self.owners[bucket] >= 0 and self.owners[bucket] != owner:
+                self.collisions += 1
+            self.owners[bucket] = owner
+        return
+
+    def __contains__(self, state):
+        return self.get(state) is not None
+
+    def __len__(self):
+        return int((self.owners >= 0).sum())
+
+    # ============================================================================
+    # HashedQTable.items( ) -- occupied buckets, for display
+    # ============================================================================
+    def items(self):
+        for bucket in np.nonzero(self.owners >= 0)[0]:
+            yield ('bucket', int(bucket)), [(float(V), int(N)) for V, N in zip(self.values[bucket], self.counts[bucket])]
+
+    # ============================================================================
+    # HashedQTable.collision_stats( )
+    # ============================================================================
+    def collision_stats(self):
+        occupied = len(self)
+        return {
+            'buckets': self.encoder.n_buckets,
+            'occupied': occupied,
+            'load_factor': occupied / self.encoder.n_buckets,
+            'writes': self.writes,
+            'collisions': self.collisions,
+            'collision_rate': self.collisions / max(1, self.writes)
+        }
+
+    # ============================================================================
+    # HashedQTable.save( fileName )
+    # ============================================================================
+    def save(self, fileName):
+        with open(fileName, 'wb') as outfile:
+            np.savez_compressed(outfile, values=self.values, counts=self.counts, owners=self.owners,
+                                settings=np.array([self.encoder.n_buckets, self.encoder.n_tilings, self.encoder.tile_width]))
+        return
+
+    # ============================================================================
+    # HashedQTable.load( fileName , encoder , n_actions , strict )
+    # ============================================================================
+    @staticmethod
+    def load(fileName, encoder, n_actions, strict=False):
+        table = HashedQTable(encoder, n_actions)
+        try:
+            with np.load(fileName) as data:
+                n_buckets, n_tilings, tile_width = data['settings']
+                if (int(n_buckets), int(n_tilings), float(tile_width)) != (encoder.n_buckets, encoder.n_tilings, encoder.tile_width):
+                    raise ValueError('{} was saved with different encoder settings'.format(fileName))
+                table.values[:] = data['values']
+                table.counts[:] = data['counts']
+                table.owners[:] = data['owners']
+        except (OSError, ValueError, KeyError) as error:
+            if strict:
+                raise
+            print('Starting an empty hashed Q-Table: {}'.format(error))
+        return table
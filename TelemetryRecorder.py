@@ -0,0 +1,258 @@
+# ================================================================================
+# FILE: TelemetryRecorder.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Binary per-tick telemetry of the agent, for full-fidelity traces of long runs.
+# Every control tick becomes one fixed-size record of a NumPy structured dtype
+# (see record_dtype): wall-clock time, tick number, class, class probabilities,
+# action, reward, explore flag, Q-values and the latency of each stage of the
+# tick. Records are written into preallocated chunk buffers, so recording a tick
+# is a single row assignment (about 3 microseconds) with no allocation and no
+# I/O. Full chunks are handed to a background thread that appends them to the
+# session's files, starting a new file every records_per_file records and,
+# with max_files, deleting the oldest ones.
+#
+# A session is a JSON sidecar <prefix>_<start time>.json describing the dtype,
+# next to its data files <prefix>_<start time>.NNNN.tlm of raw records.
+# load_session reads a session back as one NumPy array per field.
+#
+# ================================================================================
+# Function: record_dtype( n_classes , n_actions )
+# ================================================================================
+#
+# Output:
+#   - the structured dtype of one record:
+#        * time:       wall-clock time of the tick (seconds since the epoch)
+#        * tick:       index of the tick in the session
+#        * label:      class index (of the near crop with lookahead states)
+#        * action:     index of the action taken
+#        * explore:    1 if the action was a random exploration
+#        * reward:     reward of the action for the state (RLAgent.new_reward)
+#        * probs:      class probabilities, NaN when the classifier did not run
+#        * q:          value estimate of every action
+#        * latency_us: microseconds spent in each of STAGES
+#
+# ================================================================================
+# CLASS: TelemetryRecorder
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - directory (optional):
+#        * Default = 'telemetry'
+#   - n_classes (optional):
+#        * Default = 9
+#   - n_actions (optional):
+#        * Default = 3
+#   - prefix (optional):
+#        * Default = 'telemetry', file name prefix of the session
+#   - chunk_records (optional):
+#        * Default = 4096, records per chunk buffer
+#   - records_per_file (optional):
+#        * Default = 2 ** 20, records per file before rotating to the next
+#   - max_files (optional):
+#        * Default = None (keep every file), otherwise the oldest files of the
+#          session are deleted beyond this many
+#   - n_buffers (optional):
+#        * Default = 4, chunk buffers preallocated. If the writer falls behind
+#          further, extra buffers are allocated rather than blocking the agent.
+#
+# ================================================================================
+# MEMBER FUNCTION: TelemetryRecorder.record( timestamp , label , probs , action , reward , explore , q_values , latencies )
+# ================================================================================
+#
+# Task:
+#   - copy one tick into the next row of the current chunk, and hand the chunk
+#     to the writer thread once it is full
+#
+# ================================================================================
+# MEMBER FUNCTION: TelemetryRecorder.flush( ) / TelemetryRecorder.close( )
+# ================================================================================
+#
+# Task:
+#   - flush hands the partly filled chunk to the writer
+#   - close flushes, waits for the writer to finish and closes the file
+#
+# ================================================================================
+# Function: load_session( path )
+# ================================================================================
+#
+# Input:
+#   - path:
+#        * a session's .json file, or a directory (its newest session is loaded)
+#
+# Output:
+#   - dictionary of one array per record field, plus latency_<stage>_us columns
+#     split out of latency_us
+#
+# ================================================================================
+import os
+import glob
+import json
+import time
+import queue
+import threading
+import numpy as np
+
+STAGES = ('classify', 'select', 'learn', 'tick')
+
+
+# ================================================================================
+# record_dtype
+# ================================================================================
+def record_dtype(n_classes=9, n_actions=3):
+    return np.dtype([('time', '<f8'), ('tick', '<u8'), ('label', '<i2'), ('action', '<i1'), ('explore', 'u1'),
+                     ('reward', '<f4'), ('probs', '<f4', (n_classes,)), ('q', '<f4', (n_actions,)),
+                     ('latency_us', '<f4', (len(STAGES),))])
+
+
+class TelemetryRecorder:
+
+    # ============================================================================
+    # Constructor
+    # ============================================================================
+    def __init__(self, directory='telemetry', n_classes=9, n_actions=3, prefix='telemetry', chunk_records=4096,
+                 records_per_file=2 ** 20, max_files=None, n_buffers=4):
+        self.dtype = record_dtype(n_classes, n_actions)
+        self.records_per_file = records_per_file
+        self.max_files = max_files
+        os.makedirs(directory, exist_ok=True)
+        self.session = os.path.join(directory, '{}_{}'.format(prefix, time.strftime('%Y%m%d-%H%M%S')))
+        with open(self.session + '.json', 'w') as outfile:
+            json.dump({'dtype': self.dtype.descr, 'stages': STAGES, 'n_classes': n_classes, 'n_actions': n_actions,
+                       'records_per_file': records_per_file, 'started': time.time()}, outfile)
+
+        # === Preallocated Chunks: One Being Filled, the Rest Free === #
+        self.chunk = np.zeros(chunk_records, dtype=self.dtype)
+        self.filled = 0
+        self.ticks = 0
+        self.free = queue.Queue()
+        for _ in range(n_buffers - 1):
+            self.free.put(np.zeros(chunk_records, dtype=self.dtype))
+        self.extra_buffers = 0
+
+        # === Writer Thread State === #
+        self.pending = queue.Queue()
+        self.outfile = None
+        self.file_index = -1
+        self.file_records = records_per_file
+        self.files = list()
+        self.written = 0
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        return
+
+    # ============================================================================
+    # TelemetryRecorder.record( ... ) -- the per-tick hot path
+    # ============================================================================
+    def record(self, timestamp, label, probs, action, reward, explore, q_values, latencies):
+        self.chunk[self.filled] = (timestamp, self.ticks, label, action, explore, reward, probs, q_values, latencies)
+        self.filled += 1
+        self.ticks += 1
+        if self.filled == len(self.chunk):
+            self.flush()
+        return
+
+    # ============================================================================
+    # TelemetryRecorder.flush( ) -- hand the current chunk to the writer
+    # ============================================================================
+    def flush(self):
+        if self.filled == 0:
+            return
+        self.pending.put((self.chunk, self.filled))
+        try:
+            self.chunk = self.free.get_nowait()
+        except queue.Empty:
+            self.chunk = np.zeros(len(self.chunk), dtype=self.dtype)
+            self.extra_buffers += 1
+        self.filled = 0
+        return
+
+    # ============================================================================
+    # TelemetryRecorder.write_loop( ) -- background writer
+    # ============================================================================
+    def write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            chunk, filled = item
+            records = chunk[:filled]
+
+            # === Split the Chunk Across Files When It Crosses a Rotation === #
+            while len(records) > 0:
+                if self.file_records >= self.records_per_file:
+                    self.rotate()
+                part = records[:self.records_per_file - self.file_records]
+                part.tofile(self.outfile)
+                self.file_records += len(part)
+                self.written += len(part)
+                records = records[len(part):]
+            self.outfile.flush()
+            self.free.put(chunk)
+        return
+
+    # ============================================================================
+    # TelemetryRecorder.rotate( ) -- start the next file of the session
+    # ============================================================================
+    def rotate(self):
+        if self.outfile is not None:
+            self.outfile.close()
+        self.file_index += 1
+        self.files.append('{}.{:04d}.tlm'.format(self.session, self.file_index))
+        self.outfile = open(self.files[-1], 'wb')
+        self.file_records = 0
+
+        # === Drop the Oldest Files Beyond max_files === #
+        while self.max_files is not None and len(self.files) > self.max_files:
+            os.remove(self.files.pop(0))
+        return
+
+    # ============================================================================
+    # TelemetryRecorder.close( )
+    # ============================================================================
+    def close(self):
+        if not self.writer.is_alive():
+            return
+        self.flush()
+        self.pending.put(None)
+        self.writer.join()
+        if self.outfile is not None:
+            self.outfile.close()
+        return
+
+    # ============================================================================
+    # TelemetryRecorder.report( )
+    # ============================================================================
+    def report(self):
+        return 'Telemetry {}: {} ticks recorded, {} written to {} file(s), {} extra chunk buffer(s)'.format(
+            self.session, self.ticks, self.written, len(self.files), self.extra_buffers)
+
+
+# ================================================================================
+# load_session
+# ================================================================================
+def load_session(path):
+
+    # === A Directory Means Its Newest Session === #
+    if os.path.isdir(path):
+        sessions = glob.glob(os.path.join(path, '*.json'))
+        if not sessions:
+            raise FileNotFoundError('No telemetry session in {}'.format(path))
+        path = max(sessions, key=os.path.getmtime)
+
+    with open(path, 'r') as infile:
+        meta = json.load(infile)
+    dtype = np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()) for field in meta['dtype']])
+
+    # === Concatenate the Session's Files in Order === #
+    parts = sorted(glob.glob(glob.escape(path[:-len('.json')]) + '.*.tlm'))
+    records = np.concatenate([np.fromfile(part, dtype=dtype) for part in parts]) if parts else np.zeros(0, dtype=dtype)
+
+    columns = {name: records[name] for name in dtype.names}
+    for i, stage in enumerate(meta['stages']):
+        columns['latency_{}_us'.format(stage)] = records['latency_us'][:, i]
+    return columns
@@ -1,14 +1,25 @@
 from PyQt5.QtWidgets import QLabel, QMainWindow, QScrollArea, QAction, QFileDialog, QMessageBox
 from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QTimer, pyqtSignal
 from RLAgent import RLAgent
+from SamplingProfiler import SamplingProfiler
+from FramePacing import FramePacer
 import cv2
+import time
+import numpy as np
 
 from mss import mss
 from PIL import Image
 
 class Window (QMainWindow):
 
+    '''
+        Emitted by the hot swap loading threads with (success, message,
+        fileName). Qt queues it to the GUI thread, where onHotSwapDone
+        updates the widgets. fileName is empty for classifiers.
+    '''
+    hotSwapDone = pyqtSignal(bool, str, str)
+
     '''
         :param title:
             The title of the window that will be shown in the
@@ -59,6 +70,25 @@ class Window (QMainWindow):
         self.saveModelAs.triggered.connect(self.saveAsFunc)
         self.actionMenu.addAction(self.saveModelAs)
 
+        '''
+            We can export the learned Q-Table as a frozen
+            policy (one action per class) for fast demo runs
+        '''
+        self.exportPolicy = QAction("&Export Frozen Policy")
+        self.exportPolicy.setShortcut("ctrl+e")
+        self.exportPolicy.triggered.connect(self.exportPolicyFunc)
+        self.actionMenu.addAction(self.exportPolicy)
+
+        '''
+            With a shadow classifier (--shadow) we can dump
+            its agreement matrix and latencies against the
+            primary classifier
+        '''
+        self.dumpShadowReport = QAction("&Dump Shadow Report")
+        self.dumpShadowReport.setShortcut("ctrl+d")
+        self.dumpShadowReport.triggered.connect(self.dumpShadowReportFunc)
+        self.actionMenu.addAction(self.dumpShadowReport)
+
         '''
             Adds an option menu to the status bar
         '''
@@ -89,6 +119,22 @@ class Window (QMainWindow):
         self.loadModel.setShortcut("ctrl+k")
         self.loadModel.triggered.connect(self.loadModelFunc)
 
+        '''
+            A new classifier can be swapped in while
+            the agent keeps driving
+        '''
+        self.loadClassifier = QAction("&Load Classifier")
+        self.loadClassifier.setShortcut("ctrl+l")
+        self.loadClassifier.triggered.connect(self.loadClassifierFunc)
+
+        '''
+            The sampling profiler can be started and stopped
+            around the running control loop, see SamplingProfiler.py
+        '''
+        self.toggleProfiler = QAction("&Toggle Profiler")
+        self.toggleProfiler.setShortcut("ctrl+r")
+        self.toggleProfiler.triggered.connect(self.toggleProfilerFunc)
+
         '''
             This is a label to let us know what the current
             state of the AI program is.
@@ -127,6 +173,8 @@ class Window (QMainWindow):
         self.optionsMenu.addAction(self.togglePause)
         self.optionsMenu.addAction(self.toggleTraining)
         self.optionsMenu.addAction(self.loadModel)
+        self.optionsMenu.addAction(self.loadClassifier)
+        self.optionsMenu.addAction(self.toggleProfiler)
 
         self.width = width # Width of the window in pixels
         self.height = height # Height pf the window in pixels
@@ -146,6 +194,9 @@ class Window (QMainWindow):
         self.screenRecorderObj = mss() # A handle to the screen recording object
         self.recordingViewport = None # The viewport that the screen will record from
         self.recordingRate = 60 # The number of times per second that we will grab a new frame from the screen
+        self.recordingViewports = [] # The per-instance viewports used in multi-viewport capture mode
+        self.captureUnion = None # The bounding rectangle of every per-instance viewport
+        self.lastGrabTime = 0.0 # How long (in seconds) the last multi-viewport grab took
 
         self.currentCapture = None # The current frame that was just captured
         self.videoFeed = QLabel(self) # The video feed object drawn to the window
@@ -155,6 +206,11 @@ class Window (QMainWindow):
         self.isTraining = True # Keeps track of if we are in debug mode or not
         self.currentAgent = None # Keeps track of the current agent parameters
         self.currentModelFile = None # Keeps track of the current model we have loaded
+        self.profiler = SamplingProfiler() # Started and stopped with ctrl+r or --profile
+        self.pacer = FramePacer(self.recordingRate) # Measures (and optionally adapts) the real control rate
+        self.swapMessage = None # The outcome of the last hot swap, shown in the status bar for a few seconds
+        self.swapMessageTime = 0.0
+        self.hotSwapDone.connect(self.onHotSwapDone)
 
     '''
         :desc:
@@ -164,7 +220,7 @@ class Window (QMainWindow):
             to the screen.
     '''
     def create(self):
-        self.globalTimer.start(1000 // self.recordingRate)
+        self.globalTimer.start(self.pacer.interval_ms)
         self.videoFeed.show()
         self.show()
 
@@ -288,6 +344,25 @@ class Window (QMainWindow):
     '''
     def setRecordRate(self, timeInFPS):
         self.recordingRate = timeInFPS
+        self.pacer.max_fps = self.pacer.fps = timeInFPS
+
+    '''
+        :desc:
+            Lets the frame pacer lower (and raise again) the
+            rate set with setRecordRate to the highest rate
+            the machine can sustain, see FramePacing.py.
+
+        :param minFPS:
+            The lowest rate the pacer may go down to.
+
+        :param latencyBudgetMs:
+            The frame age at decision time (one period plus
+            one tick) above which the status bar warns.
+    '''
+    def setAdaptiveRate(self, minFPS = 5, latencyBudgetMs = 100):
+        self.pacer.adapt = True
+        self.pacer.min_fps = minFPS
+        self.pacer.latency_budget = latencyBudgetMs / 1000
 
     '''
         :desc:
@@ -300,7 +375,24 @@ class Window (QMainWindow):
             every frame the window updates.
     '''
     def setUpdateFunc(self, func):
-        self.globalTimer.timeout.connect(func)
+        self.globalTimer.timeout.connect(lambda: self.pacedUpdate(func))
+
+    '''
+        :desc:
+            Runs one tick of the update function between the
+            frame pacer's measurements, applies a new rate if
+            the pacer adapted it and adds the pacing figures
+            (achieved fps, jitter, drops) to the status bar.
+    '''
+    def pacedUpdate(self, func):
+        self.pacer.tick_start()
+        func()
+        if self.pacer.tick_end():
+            self.globalTimer.setInterval(self.pacer.interval_ms)
+        status = self.statusBar().currentMessage().split("\tRate: ")[0] + "\t" + self.pacer.status()
+        if self.swapMessage is not None and time.perf_counter() - self.swapMessageTime < 5:
+            status += "\t" + self.swapMessage
+        self.statusBar().showMessage(status)
 
     '''
         :desc:
@@ -339,6 +431,116 @@ class Window (QMainWindow):
         img = Image.frombytes("RGB", sourceImg.size, sourceImg.rgb, "raw", "BGR") # Converts it to a better format
         return img
 
+    '''
+        :desc:
+            Adds the viewport of one more emulator instance for
+            multi-viewport capture mode. Every tick the bounding union of
+            all viewports is grabbed once and each instance gets its own
+            slice of it (see grabScreenshots).
+        
+        :param left:
+            The number of pixels from the left of your
+            screen the instance's viewport starts from.
+            
+        :param top:
+            The number of pixels from the top of your
+            screen the instance's viewport starts from.
+            
+        :param width:
+            The width in pixels of the instance's viewport
+            
+        :param height:
+            The height in pixels of the instance's viewport
+            
+        :returns:
+            The index of the new instance. Frames returned by
+            grabScreenshots are in this order.
+    '''
+    def addRecordingViewport(self, left, top, width, height):
+        self.recordingViewports.append({"left": left, "top": top, "width": width, "height": height})
+        self.captureUnion = self.getViewportUnion(self.recordingViewports)
+        return len(self.recordingViewports) - 1
+
+    '''
+        :desc:
+            Computes the smallest rectangle containing every
+            one of the given viewports.
+            
+        :param viewports:
+            A list of viewport dictionaries of the form
+            used by setRecordingViewport.
+            
+        :returns:
+            A viewport dictionary for the bounding rectangle
+    '''
+    def getViewportUnion(self, viewports):
+        left = min(v["left"] for v in viewports)
+        top = min(v["top"] for v in viewports)
+        right = max(v["left"] + v["width"] for v in viewports)
+        bottom = max(v["top"] + v["height"] for v in viewports)
+        return {"left": left, "top": top, "width": right - left, "height": bottom - top}
+
+    '''
+        :desc:
+            Grabs the bounding union of the given viewports with a single
+            screen capture and slices out each viewport.
+            
+        :param viewports:
+            A list of viewport dictionaries. Defaults to every viewport
+            added with addRecordingViewport.
+            
+        :returns:
+            A list with one BGRA numpy array per viewport. Each one is a
+            view into the same capture buffer, so nothing is copied.
+    '''
+    def grabScreenshots(self, viewports = None):
+        if viewports is None:
+            viewports = self.recordingViewports
+            union = self.captureUnion
+        else:
+            union = self.getViewportUnion(viewports)
+
+        start = time.perf_counter()
+        sourceImg = self.screenRecorderObj.grab(union) # One grab for every instance
+        pixels = np.frombuffer(sourceImg.raw, dtype=np.uint8).reshape(sourceImg.height, sourceImg.width, 4)
+
+        '''
+            Slicing only changes the strides of the array,
+            so every instance's frame shares the grabbed buffer.
+        '''
+        frames = []
+        for v in viewports:
+            top = v["top"] - union["top"]
+            left = v["left"] - union["left"]
+            frames.append(pixels[top:top + v["height"], left:left + v["width"]])
+        self.lastGrabTime = time.perf_counter() - start
+        return frames
+
+    '''
+        :desc:
+            Measures how the cost of a multi-viewport grab grows
+            with the number of instances. For n = 1..N it times grabbing
+            the first n viewports and prints the cost per grab and per instance.
+            
+        :param trials:
+            The number of grabs to average over for each instance count
+            
+        :returns:
+            A list of (instances, secondsPerGrab, secondsPerInstance) tuples
+    '''
+    def measureGrabCost(self, trials = 50):
+        results = []
+        for n in range(1, len(self.recordingViewports) + 1):
+            viewports = self.recordingViewports[:n]
+            self.grabScreenshots(viewports) # Warm up the capture object
+            start = time.perf_counter()
+            for _ in range(trials):
+                self.grabScreenshots(viewports)
+            perGrab = (time.perf_counter() - start) / trials
+            results.append((n, perGrab, perGrab / n))
+            print("Instances: {}\tGrab: {:.2f} ms\tPer Instance: {:.2f} ms".format(n, perGrab * 1000, perGrab * 1000 / n))
+        return results
+
     '''
         :desc:
             This function will toggle the current
@@ -347,6 +549,14 @@ class Window (QMainWindow):
     def pauseFunc(self):
         self.isPaused = not self.isPaused
 
+    '''
+        :desc:
+            This function starts the sampling profiler, or stops it
+            and writes the collapsed stacks and top functions to profiles/.
+    '''
+    def toggleProfilerFunc(self):
+        print(self.profiler.toggle())
+
     '''
         :desc:
             This function will toggle between training mode
@@ -412,18 +622,63 @@ class Window (QMainWindow):
              '''
             self.currentAgent.save_model(self.currentModelFile) # Saves the file with the custom name
 
+    '''
+        :desc:
+            This function asks the user where to save the frozen
+            policy compiled from the current Q-Table.
+    '''
+    def exportPolicyFunc(self):
+        fileName, _ = QFileDialog.getSaveFileName(self, "Export Frozen Policy", "policy.npy")
+        if fileName is not None and len(fileName) > 0:
+            print("Trying to export: {}".format(fileName))
+            self.currentAgent.export_policy(fileName)
+
+    '''
+        :desc:
+            This function prints the shadow-mode comparison of the
+            primary and candidate classifiers and saves it to
+            shadow_report.npz.
+    '''
+    def dumpShadowReportFunc(self):
+        if self.currentAgent is not None:
+            print(self.currentAgent.shadow_report("shadow_report.npz" if self.currentAgent.shadow is not None else None))
+
     '''
         :desc:
             This function will get the user input for a file to load to be
-            used as the model. It will then reflect the changes in the Q-Table scroller
+            used as the model. The model loads on a background thread and
+            the agent swaps it in between two frames, so the agent keeps
+            driving meanwhile. It will then reflect the changes in the Q-Table scroller
     '''
     def loadModelFunc(self):
         fileName, _ = QFileDialog.getOpenFileName(self, "Load Model")
         if fileName is not None and len(fileName) > 0:
             print("Trying to load: {}".format(fileName))
-            self.currentModelFile = fileName
-            self.currentAgent.load_model(fileName)
+            self.currentAgent.hot_swap_q_table(fileName, lambda success, message: self.hotSwapDone.emit(success, message, fileName))
+
+    '''
+        :desc:
+            This function will get the user input for a keras classifier
+            (.h5) file and hot swap it into the running agent the same way.
+    '''
+    def loadClassifierFunc(self):
+        fileName, _ = QFileDialog.getOpenFileName(self, "Load Classifier", "", "Keras classifier (*.h5)")
+        if fileName is not None and len(fileName) > 0:
+            print("Trying to load classifier: {}".format(fileName))
+            self.currentAgent.hot_swap_classifier(fileName, lambda success, message: self.hotSwapDone.emit(success, message, ""))
+
+    '''
+        :desc:
+            Runs on the GUI thread once a hot swap has finished
+            loading. Shows the outcome in the status bar and, for
+            a Q-Table that loaded, the new current model.
+    '''
+    def onHotSwapDone(self, success, message, fileName):
+        if success and len(fileName) > 0:
             self.currentAIModelInUse.setText(self.currentAIModelInUseText + fileName[fileName.rfind("/") + 1:])
+        self.swapMessage = message
+        self.swapMessageTime = time.perf_counter()
+        self.statusBar().showMessage(message)
 
     '''
         :desc:
@@ -434,7 +689,8 @@ class Window (QMainWindow):
     def helpFunc(self):
         msgBox = QMessageBox()
         msgBox.setInformativeText("Shortcuts Help: ctrl + h\nSave: ctrl + s\nSave-As: ctrl + alt + s\n"
-                                  "Load Model: ctrl + k\nPause: ctrl + p\nToggle training/debug: ctrl + t")
+                                  "Export Frozen Policy: ctrl + e\nDump Shadow Report: ctrl + d\n"
+                                  "Load Model: ctrl + k\nLoad Classifier: ctrl + l\nToggle Profiler: ctrl + r\nPause: ctrl + p\nToggle training/debug: ctrl + t")
 
         msgBox.setWindowTitle("Shortcuts Reference Menu")
         msgBox.setStandardButtons(QMessageBox.Ok)
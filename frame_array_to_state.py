@@ -1,10 +1,69 @@
+# ================================================================================
+# FILE: frame_array_to_state.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Cheap Canny-edge description of a frame, used as the first stage of a cascade
+# in front of the CNN frame classifier (see EdgeCascade). The edge tuple costs a
+# strided subsample, a Canny pass on the small image and a few NumPy row sums,
+# a fraction of a classifier call, so on easy straights most frames never reach
+# the CNN.
+#
+# ================================================================================
+# REQUIREMENTS
+# ================================================================================
+#
+#   * numpy:
+#        `pip install numpy`
+#
+#   * cv2 (opencv for python)
+#        `pip install opencv-python`
+#
+# ================================================================================
+import numpy as np
+
+
+# ================================================================================
+# Function: gray_downscale
+# ================================================================================
+#
+# Input:
+#   * frame_img:     BGR/BGRA numpy array (as captured by mss), 2D grayscale array
+#                    or PIL image
+#   * resize_scale:  keep every resize_scale-th row and column
+#
+# Output:
+#   - uint8 grayscale numpy array of the downscaled frame
+#
+# Task:
+#   - Subsample the frame by striding (no copy of the full frame, no PIL round trip)
+#   - Convert the small BGR pixels to luma with integer ITU-R 601-2 weights
+#
+# ================================================================================
+def gray_downscale( frame_img , resize_scale=5 ):
+
+    # === PIL Images are Converted Once === #
+    if not isinstance( frame_img , np.ndarray ):
+        frame_img = np.asarray( frame_img.convert( 'L' ) )
+
+    small = frame_img[ ::resize_scale , ::resize_scale ]
+    if small.ndim == 2:
+        return np.ascontiguousarray( small , dtype=np.uint8 )
+
+    # === B*0.114 + G*0.587 + R*0.299 in Fixed Point === #
+    small = small[ : , : , :3 ].astype( np.uint16 )  # uint8 * uint16 scalar stays uint8 (and overflows) on NumPy 1.x
+    luma = small[ : , : , 0 ] * 29 + small[ : , : , 1 ] * 150 + small[ : , : , 2 ] * 77
+    return ( luma >> 8 ).astype( np.uint8 )
+
+
 # ================================================================================
 # Function: frame_to_state
 # ================================================================================
 #
 # Input:
-#   * frame_img:     numpy array representing the rgb pixel-array of the frame 
-#                    (assumed minimap is toggled off the road)
+#   * frame_img:     numpy array representing the pixel-array of the frame
+#                    (assumed minimap is toggled off the road), see gray_downscale
 #   * n_features:    The desired length of the state vector (size of state space
 #                    = 3^n_features. I would recommend no more than 7)
 #   * center_margin: acceptable margin for the average canny edge to be considered "center"
@@ -19,61 +78,192 @@
 #              the center.
 #
 # Task:
-#   1. Convert the Frame to Grayscale
-#   2. Resize the frame by the given scaling factor
-#   3. Find the canny edges in the transformed image
-#   4. Select a row to represent each feature (number of rows=desired number of 
+#   1. Convert the Frame to Grayscale and downscale it (gray_downscale)
+#   2. Find the canny edges in the transformed image
+#   3. Select a row to represent each feature (number of rows=desired number of
 #      features)
-#   5. Find the average index of the canny edges in each representative row
-#   6. Map the average to a representative feature value
+#   4. Find the average index of the canny edges in each representative row, for
+#      all rows at once
+#   5. Map the average to a representative feature value
 #         * -1: the average is on the left side of the screen
 #         *  0: the average is "close enough" to the center (within center_margin*width)
 #         * +1: the average is on the right side of the screen
-#   7. Return the representative feature values as an ordered tuple
+#   6. Return the representative feature values as an ordered tuple
 #
 # ================================================================================
-def frame_to_state( frame_img , n_features=5 , center_margin=0.05 ):
-    
+def frame_to_state( frame_img , n_features=5 , center_margin=0.05 , resize_scale=5 ):
+
     # === Necessary Imports === #
-    from PIL import Image
     import cv2
-    
-    # === Housekeeping === #
-    resize_scale = 5
-    
+
     # === Image Preprocessing === #
-    img   = Image.fromarray( np.uint8( frame_img ) )
-    gray  = img.convert( 'L' )
-    small = gray.resize( ( gray.size[0]//resize_scale , gray.size[1]//resize_scale ) )
-    edges = cv2.Canny( np.asarray( small ) , 150 , 200 )
-    
+    small = gray_downscale( frame_img , resize_scale )
+    edges = cv2.Canny( small , 150 , 200 )
+
     # === Select Representative Rows === #
-    rows = [ i for i in range( edges.shape[0]//2 , edges.shape[0]-int(edges.shape[0]*0.1) , (edges.shape[0]-int(edges.shape[0]*0.1))//2//n_features ) ]
-    while len( rows ) > n_features:
-        rows = rows[:-1]
-        
+    height = edges.shape[0]
+    step   = max( 1 , ( height - int( height * 0.1 ) ) // 2 // n_features )
+    rows   = np.arange( height // 2 , height - int( height * 0.1 ) , step )[ :n_features ]
+
     # === Determine Threshold for "Center" === #
     center = edges.shape[1]//2
     left   = center - edges.shape[1]*center_margin
     right  = center + edges.shape[1]*center_margin
-    
+
+    # === Edge Centroid of Every Row (the Center When a Row Has No Edges) === #
+    hits   = edges[ rows ] > 0
+    counts = hits.sum( axis=1 )
+    sums   = hits @ np.arange( edges.shape[1] )
+    avg    = np.where( counts > 0 , sums / np.maximum( counts , 1 ) , center )
+
     # === Generate the State "Vector" === #
-    state = tuple( )
-    for rowslice in edges[rows]:
-        locs = np.where(rowslice==255)[0]
-        avg  = locs.mean( ) if len( locs ) > 0 else center
-        
-        # === More Left Edges than Right === #
-        if avg < left:
-            state += (-1,)
-            
-        # === More Right Edges than Left
-        elif avg > right:
-            state += (1,)
-            
-        # === Edges Approximately Even on Left and Right === #
+    state = np.where( avg < left , -1 , np.where( avg > right , 1 , 0 ) )
+    return tuple( state.tolist( ) )
+
+
+# ================================================================================
+# CLASS: EdgeCascade
+# ================================================================================
+# ATTRIBUTES:
+# ================================================================================
+#
+#   - table:
+#        * dictionary mapping each edge tuple seen so far to a numpy array counting
+#          how often the CNN gave each class for it
+#
+#   - min_count / min_purity:
+#        * an edge tuple is trusted once the CNN has labelled it at least min_count
+#          times with its most common class at least min_purity of the time
+#
+#   - recent:
+#        * the last `history` class indices given out by the cascade
+#
+#   - audit_every:
+#        * every audit_every-th frame the cascade would have answered on its own is
+#          classified by the CNN anyway, to measure (and correct) the cascade
+#
+#   - stats:
+#        * dictionary of running counters: frames, cnn_runs, audits, audit_agree
+#
+# ================================================================================
+# CONSTRUCTOR:
+# ================================================================================
+#
+# Input:
+#   - n_classes (optional):     Default = 9
+#   - n_features (optional):    Default = 5, length of the edge tuple
+#   - center_margin (optional): Default = 0.05, see frame_to_state
+#   - min_count (optional):     Default = 20
+#   - min_purity (optional):    Default = 0.95
+#   - history (optional):       Default = 3
+#   - audit_every (optional):   Default = 50
+#
+# ================================================================================
+# Method: classify( frame , classify_cnn )
+# ================================================================================
+#
+# Input:
+#   - frame:        the raw frame
+#   - classify_cnn: function frame -> class index (the CNN stage)
+#
+# Output:
+#   - class index of the frame
+#
+# Task:
+#   - compute the edge tuple of the frame
+#   - if the tuple is trusted and its class agrees with every recent class, return
+#     it without running the CNN (except on audit frames)
+#   - otherwise run the CNN and add its answer to the tuple's counts
+#
+# ================================================================================
+# Method: report( )
+# ================================================================================
+#
+# Output:
+#   - string with the fraction of frames that skipped the CNN and the agreement of
+#     the edge stage with the CNN on the audited frames (the accuracy impact)
+#
+# ================================================================================
+class EdgeCascade:
+
+    def __init__( self , n_classes=9 , n_features=5 , center_margin=0.05 , min_count=20 , min_purity=0.95 ,
+                  history=3 , audit_every=50 ):
+
+        self.n_classes     = n_classes
+        self.n_features    = n_features
+        self.center_margin = center_margin
+        self.min_count     = min_count
+        self.min_purity    = min_purity
+        self.history       = history
+        self.audit_every   = audit_every
+        self.table         = dict( )
+        self.recent        = list( )
+        self.stats         = { 'frames':0 , 'cnn_runs':0 , 'audits':0 , 'audit_agree':0 }
+        self.skippable     = 0
+
+
+    # ================================================================================
+    # Trusted Class of an Edge Tuple (None if Ambiguous)
+    # ================================================================================
+    def edge_class( self , edge_state ):
+        counts = self.table.get( edge_state )
+        if counts is None:
+            return None
+        total = counts.sum( )
+        best  = int( np.argmax( counts ) )
+        if total < self.min_count or counts[best] < self.min_purity * total:
+            return None
+        return best
+
+
+    # ================================================================================
+    # Classify
+    # ================================================================================
+    def classify( self , frame , classify_cnn ):
+
+        self.stats['frames'] += 1
+        edge_state = frame_to_state( frame , self.n_features , self.center_margin )
+        guess      = self.edge_class( edge_state )
+
+        # === Easy Frame: Trusted Tuple Consistent with Recent History === #
+        if guess is not None and all( label == guess for label in self.recent ):
+            self.skippable += 1
+            if self.skippable % self.audit_every != 0:
+                return self.remember( guess )
+
+            # === Audit: Run the CNN Anyway to Measure the Edge Stage === #
+            self.stats['audits'] += 1
+            label = classify_cnn( frame )
+            self.stats['audit_agree'] += int( label == guess )
         else:
-            state += (0,)
-    
-    # === Return the State === #
-    return state
+            label = classify_cnn( frame )
+
+        # === Learn the Tuple's Class Distribution from the CNN === #
+        self.stats['cnn_runs'] += 1
+        if edge_state not in self.table:
+            self.table[edge_state] = np.zeros( self.n_classes , dtype=np.int64 )
+        self.table[edge_state][label] += 1
+        return self.remember( label )
+
+
+    # ================================================================================
+    # Keep the Last `history` Classes
+    # ================================================================================
+    def remember( self , label ):
+        self.recent.append( label )
+        if len( self.recent ) > self.history:
+            self.recent.pop( 0 )
+        return label
+
+
+    # ================================================================================
+    # Report
+    # ================================================================================
+    def report( self ):
+        frames  = max( 1 , self.stats['frames'] )
+        skipped = self.stats['frames'] - self.stats['cnn_runs']
+        message = 'Edge cascade: {} of {} frames skipped the CNN ({:.1%})'.format( skipped , self.stats['frames'] , skipped / frames )
+        if self.stats['audits'] > 0:
+            message += ', edge stage agreed with the CNN on {:.1%} of {} audited frames'.format(
+                self.stats['audit_agree'] / self.stats['audits'] , self.stats['audits'] )
+        return message
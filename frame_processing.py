@@ -0,0 +1,168 @@
+# ================================================================================
+# FILE: frame_processing.py
+# ================================================================================
+# DESCRIPTION:
+# ================================================================================
+#
+# Shared frame preprocessing for the CNN state classifier. Every consumer of the
+# classifier (the live agent, the dataset tools under CNN/, offline annotation)
+# must feed it frames prepared exactly the same way, so the conversion lives here
+# instead of being copy/pasted.
+#
+# ================================================================================
+# CONSTANTS
+# ================================================================================
+#
+#   - CLASSIFIER_IMAGE_SIZE:
+#        * (width, height) the classifier was trained on, in the order PIL expects
+#
+#   - FRAME_CLASSES:
+#        * dictionary mapping the indices of the classifier's output layer to class
+#          names. See RLAgent.py for the meaning of each class.
+#
+#   - CLASS_INDICES:
+#        * inverse of FRAME_CLASSES (class name -> output index)
+#
+#   - LOOKAHEAD_CROPS:
+#        * default regions of interest for multi-crop classification, as
+#          (name, top, bottom) fractions of the frame height: the near field just
+#          ahead of the kart, the mid field and the far field towards the horizon
+#        * the shipped classifiers were trained on whole frames, so crops stretched
+#          to the classifier size are out of distribution for them. Lookahead
+#          states need a classifier trained on crops made with preprocess_crops.
+#
+# ================================================================================
+# Function: to_pil_image( frame )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * PIL image, or numpy array in the BGR/BGRA channel order produced by
+#          mss and opencv
+#
+# Output:
+#   - PIL image in RGB (or the input unchanged if it already was a PIL image)
+#
+# ================================================================================
+# Function: preprocess_frame( frame , size )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * PIL image or BGR/BGRA numpy array of a full game frame
+#        * a 2D uint8 array that already has the requested size is assumed to be
+#          preprocessed (for example a slot of the capture process's FrameRing)
+#          and is returned unchanged
+#   - size (optional):
+#        * Default = CLASSIFIER_IMAGE_SIZE
+#        * (width, height) of the resulting image
+#
+# Output:
+#   - uint8 numpy array of shape (height, width) holding the grayscale frame
+#
+# Task:
+#   - Convert the frame to grayscale with PIL (ITU-R 601-2 luma)
+#   - Resize the frame to the given size with PIL's default filter
+#
+# ================================================================================
+# Function: preprocess_crops( frame , regions , out , size )
+# ================================================================================
+#
+# Input:
+#   - frame:
+#        * PIL image or BGR/BGRA numpy array of a full game frame
+#   - regions:
+#        * list of (name, top, bottom) fractions of the frame height to crop
+#   - out:
+#        * array of shape (len(regions), height, width, 1) receiving the crops,
+#          typically the preallocated classifier input batch
+#   - size (optional):
+#        * Default = CLASSIFIER_IMAGE_SIZE
+#
+# Output:
+#   - out, with each row holding one full-width grayscale crop of the classifier
+#     size. The frame is converted to grayscale and strided down once (see
+#     frame_array_to_state.gray_downscale), then all crops are sampled from it
+#     with a single index-array lookup, with no per-crop Python work
+#
+# ================================================================================
+import numpy as np
+from PIL import Image
+
+CLASSIFIER_IMAGE_SIZE = ( 80 , 64 )
+
+FRAME_CLASSES = {
+    0:'center',
+    1:'near_left',
+    2:'near_right',
+    3:'off_left',
+    4:'off_right',
+    5:'wall_left',
+    6:'wall_right',
+    7:'tunnel_left',
+    8:'tunnel_right'
+}
+
+CLASS_INDICES = { name:idx for idx , name in FRAME_CLASSES.items() }
+
+LOOKAHEAD_CROPS = [
+    ( 'near' , 0.50 , 1.00 ),
+    ( 'mid'  , 0.35 , 0.75 ),
+    ( 'far'  , 0.20 , 0.55 )
+]
+
+
+# ================================================================================
+# to_pil_image
+# ================================================================================
+def to_pil_image( frame ):
+
+    # === Already an Image === #
+    if isinstance( frame , Image.Image ):
+        return frame
+
+    # === Let PIL's Raw Decoder Swap BGR(A) to RGB Without a Numpy Copy === #
+    frame = np.ascontiguousarray( frame )  # slices of a multi-viewport grab are strided
+    raw_mode = 'BGRX' if frame.shape[2] == 4 else 'BGR'
+    return Image.frombuffer( 'RGB' , ( frame.shape[1] , frame.shape[0] ) , frame , 'raw' , raw_mode , 0 , 1 )
+
+
+# ================================================================================
+# preprocess_frame
+# ================================================================================
+def preprocess_frame( frame , size=CLASSIFIER_IMAGE_SIZE ):
+
+    # === Frame Was Already Preprocessed Upstream === #
+    if isinstance( frame , np.ndarray ) and frame.shape == ( size[1] , size[0] ):
+        return frame
+
+    # === Grayscale and Downscale Exactly as the Classifier Was Trained === #
+    processed = to_pil_image( frame ).convert( 'L' ).resize( size )
+    return np.asarray( processed )
+
+
+# ================================================================================
+# preprocess_crops
+# ================================================================================
+def preprocess_crops( frame , regions , out , size=CLASSIFIER_IMAGE_SIZE ):
+
+    # === Necessary Imports === #
+    from frame_array_to_state import gray_downscale
+
+    # === Grayscale and Downscale Once, Keeping Every Band at Least Classifier-Sized === #
+    if isinstance( frame , Image.Image ):
+        frame = np.asarray( frame )[ : , : , ::-1 ]  # RGB seen in the BGR order gray_downscale expects
+    height , width = frame.shape[ :2 ]
+    tops = np.array( [ top for _ , top , _ in regions ] )
+    bottoms = np.array( [ bottom for _ , _ , bottom in regions ] )
+    stride = max( 1 , min( width // size[0] , int( ( bottoms - tops ).min() * height ) // size[1] ) )
+    small = gray_downscale( frame , stride )
+
+    # === Every Crop Sampled at Once with One Row Index Array per Band === #
+    small_height , small_width = small.shape
+    first = ( tops * small_height ).astype( np.intp )
+    rows = first[ : , None ] + ( ( np.arange( size[1] ) + 0.5 ) * ( ( bottoms * small_height ).astype( np.intp ) - first )[ : , None ] / size[1] ).astype( np.intp )
+    cols = ( ( np.arange( size[0] ) + 0.5 ) * small_width / size[0] ).astype( np.intp )
+    out[ : len( regions ) , : , : , 0 ] = small[ rows[ : , : , None ] , cols[ None , None , : ] ]
+
+    return out
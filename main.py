@@ -1,16 +1,80 @@
 from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QTimer
 from Window import Window
 from EmulatorInterface import EmulatorInterface
 from RLAgent import RLAgent
+from HitboxFinder import LateralOffsetFeature
+from ModelCache import ModelCache
+from FrameRing import FrameRing, capture_process
+from frame_processing import CLASSIFIER_IMAGE_SIZE, LOOKAHEAD_CROPS
+from StateEncoder import StateEncoder
+from FramePacing import FrameScheduler
+from TelemetryRecorder import TelemetryRecorder
+from SessionReplay import SessionRecorder
+from SamplingProfiler import profile_request
+from KeyCalibration import KeyCalibrator
 
+import argparse
+import multiprocessing
+import os
 import sys
+import threading
+import time
+import traceback
 
 
 '''
-    Creates a global Agent object in order
-    to train the model
+    The global Agent object used to train the model. It is
+    created by loadAgents on a background thread once the
+    window is up (loading TensorFlow and the classifier takes
+    seconds), so it stays None until agentLoaded is set.
 '''
-agent = RLAgent()
+agent = None
+agentLoaded = threading.Event()
+loadStarted = time.perf_counter()
+
+'''
+    The exception that stopped loadAgents, if any. The loading
+    thread cannot report it in the window itself, so modelLoading
+    shows it and quits.
+'''
+agentLoadError = None
+
+
+'''
+    One FrameScheduler per instance with --frame-sync, so
+    the agents only decide on new game frames. Empty otherwise.
+'''
+frameSchedulers = []
+
+
+'''
+    :desc:
+        Lets the instance's agent act on the frame, through its
+        frame scheduler when there is one. Returns None when the
+        capture shows the same game frame as the previous one.
+'''
+def scheduledAct(instanceAgent, frame, instance = 0):
+    if not frameSchedulers:
+        return instanceAgent.act(frame)
+    return frameSchedulers[instance].act(instanceAgent, frame)
+
+
+'''
+    :desc:
+        Shows that the model is still loading in the status bar.
+        Returns True while the update functions should skip the frame.
+'''
+def modelLoading(window):
+    if agentLoaded.is_set():
+        return False
+    if agentLoadError is not None:
+        window.globalTimer.stop() # No more ticks, the agent will never be ready
+        window.statusBar().showMessage("Could not load the model: {} (quitting)".format(agentLoadError))
+        QTimer.singleShot(5000, lambda: QApplication.instance().exit(1))
+        return True
+    window.statusBar().showMessage("Model loading... {:.1f}s".format(time.perf_counter() - loadStarted))
+    return True
 
 
 '''
@@ -22,6 +86,8 @@ agent = RLAgent()
         to the 
 '''
 def onUpdate(window, emulator):
+    if modelLoading(window):
+        return
     src = window.grabScreenshot()
     global agent
 
@@ -43,20 +109,23 @@ def onUpdate(window, emulator):
              frame that it is given as an input. It will then
              return the action that it took (L or R)
          '''
-        actionTaken = agent.act(src)
+        actionTaken = scheduledAct(agent, src)
 
-        '''
-            The emulator will get the action taken, and it will
-            use that action to map a key press to it.
-        '''
-        emulator.emulatePresses([actionTaken])
+        if actionTaken is None: # --frame-sync: the game hasn't drawn a new frame yet
+            actionTaken = "Same frame ---> No action"
+        else:
+            '''
+                The emulator will get the action taken, and it will
+                use that action to map a key press to it.
+            '''
+            emulator.emulatePresses([actionTaken])
 
-        '''
-            After we press them we have to clear the even hooks
-            so that the presses get released between frames.
-    
-        '''
-        emulator.emulateReleasePresses([actionTaken])
+            '''
+                After we press them we have to clear the even hooks
+                so that the presses get released between frames.
+
+            '''
+            emulator.emulateReleasePresses([actionTaken])
 
     '''
         Updates the current window capture frame with the source image,
@@ -73,18 +142,397 @@ def onUpdate(window, emulator):
     '''
 
     window.setCaptureFrame(currentEpisode = agent.episode, currentAction = actionTaken, agent = agent)
+    if frameSchedulers:
+        window.statusBar().showMessage(window.statusBar().currentMessage() + "\t" + frameSchedulers[0].status())
+
+
+'''
+    :desc:
+        The update function used in multi-instance mode. The
+        window grabs every instance's viewport with a single screen
+        capture, and each frame is handed to the agent/emulator pair
+        of the instance it came from.
+
+    :param pairings:
+        A list of (agent, emulator) tuples in the same order
+        as the window's recording viewports.
+'''
+def onMultiUpdate(window, pairings):
+    if modelLoading(window):
+        return
+    frames = window.grabScreenshots()
+    actions = []
+
+    for instance, (frame, (instanceAgent, emulator)) in enumerate(zip(frames, pairings)):
+        actionTaken = "Paused ---> No action"
+        if not window.isPaused:
+            actionTaken = scheduledAct(instanceAgent, frame, instance)
+            if actionTaken is None:
+                actionTaken = "same frame"
+            else:
+                emulator.emulatePresses([actionTaken]) # Each emulator presses its own keys
+                emulator.emulateReleasePresses([actionTaken])
+        actions.append(actionTaken)
+
+    window.setCaptureFrame(currentEpisode = pairings[0][0].episode, currentAction = actions[0], agent = pairings[0][0])
+    window.statusBar().showMessage("Grab: {:.2f} ms ({:.2f} ms/instance)\tActions: {}{}".format(
+        window.lastGrabTime * 1000, window.lastGrabTime * 1000 / len(frames), ", ".join(actions),
+        "\t" + frameSchedulers[0].status() if frameSchedulers else ""))
+
+
+'''
+    Running totals of how old the frame was when the agent
+    made its decision in capture-process mode.
+'''
+ringStats = {"decisions": 0, "ageLast": 0.0, "ageTotal": 0.0, "ageMax": 0.0}
+
+
+'''
+    :desc:
+        The update function used when capture runs in its own
+        process. The newest frame is read straight out of the
+        shared-memory ring (no copy, no pickling) and the age of
+        the frame at decision time is reported in the status bar.
+
+    :param ring:
+        The FrameRing the capture process writes into.
+'''
+def onRingUpdate(window, emulator, ring):
+    if modelLoading(window):
+        return
+    frame, seq, timestamp = ring.read_latest()
+    if frame is None: # The capture process hasn't produced a frame yet
+        return
+
+    actionTaken = "Paused ---> No action"
+    if not window.isPaused:
+        actionTaken = scheduledAct(agent, frame)
+        if actionTaken is None: # --frame-sync: the game hasn't drawn a new frame yet
+            return
+
+        '''
+            The frame's age is measured once the decision is made,
+            before the key press, since that is the input latency
+            of the decision itself.
+        '''
+        age = time.perf_counter() - timestamp
+        ringStats["decisions"] += 1
+        ringStats["ageLast"] = age
+        ringStats["ageTotal"] += age
+        ringStats["ageMax"] = max(ringStats["ageMax"], age)
+
+        emulator.emulatePresses([actionTaken])
+        emulator.emulateReleasePresses([actionTaken])
+
+    window.setCaptureFrame(currentEpisode = agent.episode, currentAction = actionTaken, agent = agent)
+    if ringStats["decisions"] > 0:
+        window.statusBar().showMessage("Current Episode: {}\tCurrent Action: {}\tFrame Age: {:.1f} ms (avg {:.1f}, max {:.1f})".format(
+            agent.episode, actionTaken, ringStats["ageLast"] * 1000,
+            ringStats["ageTotal"] * 1000 / ringStats["decisions"], ringStats["ageMax"] * 1000))
+
+
+'''
+    Viewports and key bindings for each emulator instance in
+    multi-instance mode. The first instance uses the default
+    keys, the others need the emulator bound to the keys listed here.
+'''
+instanceLayouts = [
+    ((0, 110, 900, 683), None),
+    ((900, 110, 900, 683), {"throttle": 'c', "left": 'j', "right": 'k', "up": 'i', "down": 'm'}),
+    ((0, 793, 900, 683), {"throttle": 'v', "left": 'f', "right": 'g', "up": 't', "down": 'b'}),
+    ((900, 793, 900, 683), {"throttle": 'n', "left": 'o', "right": 'p', "up": '9', "down": '0'})
+]
+
+
+'''
+    :desc:
+        Builds the agent described by the command line (and, in
+        multi-instance mode, one agent per instance sharing its
+        classifier), then publishes them. Runs on a background
+        thread so the window shows up while TensorFlow and the
+        classifier load; every agent warms its classifier up with
+        a dummy inference before it is published.
+
+    :param pairings:
+        List filled with an (agent, emulator) tuple for each of
+        the given emulators.
+'''
+def loadAgents(args, emulators, pairings):
+    global agent
+    cache = ModelCache(max_bytes=args.cache_size_mb * 2 ** 20) if args.model_cache else None
+
+    '''
+        Every instance's agent is built from the same settings, so
+        all of them run the configuration given on the command line.
+        The state features and encoder are created per agent.
+    '''
+    def agentSettings():
+        return dict(classifier_file=args.classifier if args.classifier is not None else 'classifier_v4.h5',
+                    policy_file=args.policy,
+                    crop_regions=LOOKAHEAD_CROPS if args.lookahead else None,
+                    linear_q=args.linear_q,
+                    use_edge_cascade=args.edge_cascade, # Ignored with --lookahead/--linear-q
+                    state_features=[LateralOffsetFeature()] if args.lateral_offset else None,
+                    state_encoder=StateEncoder(n_buckets=args.hashed_states, n_tilings=args.tilings, tile_width=args.tilings)
+                                  if args.hashed_states is not None else None,
+                    model_cache=cache,
+                    shadow_classifier_file=args.shadow)
+    newAgent = RLAgent(**agentSettings())
+
+    for i, emulator in enumerate(emulators):
+        '''
+            Later instances share the first one's keras classifier. With
+            --model-cache there is none, and they load the same
+            classifier_file's conversion from the cache instead.
+        '''
+        instanceAgent = newAgent if i == 0 else RLAgent(classifier_model=newAgent.classifier_model, **agentSettings())
+        if i > 0 and args.policy is None:
+            root, extension = os.path.splitext(instanceAgent.model_file)
+            instanceAgent.model_file = "{}_{}{}".format(root, i, extension) # Keep each instance's Q-Table separate
+            instanceAgent.q_table = instanceAgent.load_model(True)
+        if args.telemetry is not None:
+            instanceAgent.telemetry = TelemetryRecorder(args.telemetry, len(instanceAgent.frame_classes), len(instanceAgent.action_space),
+                                                        prefix="telemetry" if i == 0 else "telemetry_{}".format(i))
+        if args.record_session is not None:
+            root, extension = os.path.splitext(args.record_session)
+            instanceAgent.session_recorder = SessionRecorder(args.record_session if i == 0 else "{}_{}{}".format(root, i, extension), instanceAgent)
+        pairings.append((instanceAgent, emulator))
+
+    agent = newAgent
+    agentLoaded.set()
+    print("Model loaded in {:.1f}s".format(time.perf_counter() - loadStarted))
+    if cache is not None:
+        print(cache.report())
+
+
+'''
+    :desc:
+        Runs loadAgents on the loading thread and keeps any
+        exception it raises (a missing --classifier or --policy
+        file, a candidate with the wrong classes, ...) in
+        agentLoadError for the window to report.
+'''
+def loadAgentsOrFail(args, emulators, pairings):
+    global agentLoadError
+    try:
+        loadAgents(args, emulators, pairings)
+    except Exception as error:
+        traceback.print_exc()
+        agentLoadError = error
+
+
+'''
+    :desc:
+        Prints the statistics of the agent's optional
+        components when the program exits.
+'''
+def reportAgentStats():
+    if agent is None:
+        return
+    if agent.edge_cascade is not None:
+        print(agent.edge_cascade.report()) # Skip fraction and accuracy impact
+    if agent.state_encoder is not None:
+        print("Hashed Q-Table: {}".format(agent.q_table.collision_stats()))
+    if agent.shadow is not None:
+        print(agent.shadow_report())
+
+
+'''
+    :desc:
+        Writes out the telemetry and session recordings still
+        buffered by each instance's agent when the program exits.
+'''
+def closeRecorders(pairings):
+    for instanceAgent, _ in pairings:
+        for recorder in (instanceAgent.telemetry, instanceAgent.session_recorder):
+            if recorder is not None:
+                recorder.close()
+                print(recorder.report())
+
+
+'''
+    :desc:
+        Stops the window's sampling profiler, if it is running,
+        and writes its output.
+'''
+def stopProfiler(window):
+    if window.profiler.running:
+        window.toggleProfilerFunc()
+
+
+'''
+    :desc:
+        Calibrates the key holds of every emulator instance
+        against its own viewport and saves them to the hold file.
+        Each emulator must show a screen that reacts to every
+        input, such as a menu (see KeyCalibration.py).
+'''
+def calibrateKeys(window, emulators):
+    viewports = window.recordingViewports if window.recordingViewports else [window.recordingViewport]
+    for instance, (emulator, viewport) in enumerate(zip(emulators, viewports)):
+        print("Calibrating the key holds of instance {} ({} / {})".format(instance, emulator.emulator, emulator.game))
+        calibrator = KeyCalibrator(emulator, lambda viewport = viewport: window.grabScreenshots([viewport])[0])
+        frameInterval = calibrator.measure_frame_interval() # Animated menus show the game's frame rate
+        print("Game frame: {}".format("{:.1f} ms".format(frameInterval * 1000) if frameInterval is not None else "screen is still, assuming 33.3 ms"))
+        calibrator.calibrate()
+        emulator.saveHoldTimes()
+        print("Saved to {} after {} presses".format(emulator.holdFile, calibrator.presses))
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Mario Kart reinforcement learning agent")
+    parser.add_argument("--instances", type=int, default=1,
+                        help="number of tiled emulator instances to drive, at most {} (see instanceLayouts)".format(len(instanceLayouts)))
+    parser.add_argument("--bench-capture", action="store_true",
+                        help="print the grab cost per instance for 1..N instances and exit")
+    parser.add_argument("--classifier", default=None,
+                        help="keras classifier to use instead of classifier_v4.h5 (e.g. one from CNN/train_classifier.py)")
+    parser.add_argument("--lookahead", action="store_true",
+                        help="classify near/mid/far crops of each frame in one batch and use the tuple as the state")
+    parser.add_argument("--edge-cascade", action="store_true",
+                        help="answer easy frames from their Canny edges and only run the classifier on ambiguous ones")
+    parser.add_argument("--lateral-offset", action="store_true",
+                        help="add the kart's lateral-offset bin (template matching on template.png) to the state")
+    parser.add_argument("--hashed-states", type=int, default=None, metavar="BUCKETS",
+                        help="hash the states into a fixed-size Q-Table of this many buckets (model_hashed.npz)")
+    parser.add_argument("--tilings", type=int, default=1,
+                        help="with --hashed-states, number of offset tilings each state is spread over (numeric features get tiles this wide)")
+    parser.add_argument("--linear-q", choices=["rls", "sgd"], default=None,
+                        help="learn a linear Q-function over the classifier's features instead of a Q-Table (model_linear.npz)")
+    parser.add_argument("--model-cache", action="store_true",
+                        help="run the classifier as a TensorFlow Lite conversion kept in an on-disk cache keyed by the file's SHA-256")
+    parser.add_argument("--cache-size-mb", type=int, default=256,
+                        help="with --model-cache, size cap of the cache (least recently used entries are evicted)")
+    parser.add_argument("--shadow", default=None, metavar="CLASSIFIER",
+                        help="evaluate a candidate classifier in shadow mode next to the primary (ctrl+d dumps the comparison)")
+    parser.add_argument("--telemetry", default=None, metavar="DIR",
+                        help="record every control tick to binary telemetry files in this directory (read them with TelemetryRecorder.load_session)")
+    parser.add_argument("--record-session", default=None, metavar="FILE",
+                        help="record the run's downscaled frames, seed and actions to a zip archive for SessionReplay.py")
+    parser.add_argument("--profile", type=float, nargs="?", const=0, default=None, metavar="SECONDS",
+                        help="run the sampling profiler from startup, for SECONDS or until exit (also MARIOKART_PROFILE=1 or =SECONDS)")
+    parser.add_argument("--adaptive-rate", action="store_true",
+                        help="adapt the capture/decision rate (at most 30 fps) to the highest rate this machine sustains")
+    parser.add_argument("--min-fps", type=int, default=5,
+                        help="with --adaptive-rate, the lowest rate to go down to")
+    parser.add_argument("--latency-budget-ms", type=float, default=100,
+                        help="frame age at decision time above which the status bar warns")
+    parser.add_argument("--frame-sync", action="store_true",
+                        help="poll the screen at 60 fps and only decide when the game has drawn a new frame")
+    parser.add_argument("--action-repeat", type=int, default=1, metavar="K",
+                        help="with --frame-sync, decide on every K-th new frame and repeat the action on the others")
+    parser.add_argument("--policy", default=None,
+                        help="run in demo mode from a frozen policy file exported with ctrl+e (no Q-Table is loaded)")
+    parser.add_argument("--capture-process", action="store_true",
+                        help="capture the screen in a separate process through a shared-memory frame ring")
+    parser.add_argument("--ring-full-res", action="store_true",
+                        help="with --capture-process, share full-resolution frames instead of preprocessed 80x64 ones")
+    parser.add_argument("--calibrate-keys", action="store_true",
+                        help="measure the shortest key hold each emulator registers (on a menu screen), save it to key_holds.json and exit")
+    args = parser.parse_args()
+    if args.instances > len(instanceLayouts):
+        parser.error("--instances is at most {}, one per entry of instanceLayouts".format(len(instanceLayouts)))
+
+    '''
+        The default ring holds 80x64 grayscale classifier inputs,
+        which the options working on the full colour capture
+        cannot use (the crops, the hitbox template, the edge maps).
+    '''
+    if args.lookahead and args.classifier is None:
+        print("Warning: --lookahead classifies frame crops with classifier_v4.h5, which was trained on whole frames."
+              " Pass a classifier trained on the crops with --classifier.")
+    if args.capture_process and not args.ring_full_res:
+        fullFrameOptions = [name for name, isSet in (("--lookahead", args.lookahead), ("--lateral-offset", args.lateral_offset),
+                                                     ("--edge-cascade", args.edge_cascade)) if isSet]
+        if fullFrameOptions:
+            parser.error("{} need(s) full-resolution frames: add --ring-full-res to --capture-process".format(", ".join(fullFrameOptions)))
+
     app = QApplication(sys.argv) # Create the application
+    app.aboutToQuit.connect(reportAgentStats)
     window = Window("Mario AI Software", 1000, 50, 900, 1200) # This is the default size of the emulator when it opens
     window.setRecordingViewport(0, 110, 900, 683) # This is the default size of the emulator when it opens
     window.setRecordRate(30) # Tells the window to record at 30fps
+    if args.frame_sync:
+        window.setRecordRate(60) # Poll faster than the game draws so no new frame is missed
+        frameSchedulers.extend(FrameScheduler(repeat=args.action_repeat) for _ in range(max(1, args.instances)))
+        app.aboutToQuit.connect(lambda: print("Frame sync: {}".format(frameSchedulers[0].rates())))
+    window.pacer.latency_budget = args.latency_budget_ms / 1000
+    if args.adaptive_rate:
+        window.setAdaptiveRate(args.min_fps, args.latency_budget_ms)
+    app.aboutToQuit.connect(lambda: print("Frame pacing: {}".format(window.pacer.metrics())))
+    pairings = [] # (agent, emulator) per instance, filled in by loadAgents
+    app.aboutToQuit.connect(lambda: closeRecorders(pairings))
+
+    if args.instances > 1 or args.bench_capture:
+        '''
+            Every instance gets its own viewport, emulator key binding and
+            agent. The agents share the global agent's classifier so the
+            model is only loaded once.
+        '''
+        count = args.instances if args.instances > 1 else len(instanceLayouts)
+        for viewport, _ in instanceLayouts[:count]:
+            window.addRecordingViewport(*viewport)
+
+        if args.bench_capture:
+            window.measureGrabCost()
+            return
+
+        emulators = [EmulatorInterface("Mupen 64", "mario kart", keyMapping) for _, keyMapping in instanceLayouts[:count]]
+        window.setUpdateFunc(lambda: onMultiUpdate(window, pairings))
+    elif args.capture_process and not args.calibrate_keys:
+        '''
+            The capture process writes into a ring of preallocated slots,
+            either preprocessed 80x64 grayscale frames or full BGRA captures.
+            Key calibration grabs the window directly, so it starts neither.
+        '''
+        viewport = window.recordingViewport
+        if args.ring_full_res:
+            frameShape = (viewport["height"], viewport["width"], 4)
+        else:
+            frameShape = (CLASSIFIER_IMAGE_SIZE[1], CLASSIFIER_IMAGE_SIZE[0])
+        ring = FrameRing(frameShape)
+        stopEvent = multiprocessing.Event()
+        capturer = multiprocessing.Process(target=capture_process, daemon=True,
+                                           args=(ring.name, frameShape, ring.n_slots, viewport, window.recordingRate, stopEvent))
+        capturer.start()
+
+        def stopCapture():
+            stopEvent.set()
+            capturer.join()
+            ring.close()
+        app.aboutToQuit.connect(stopCapture)
 
-    emu = EmulatorInterface("Mupen 64", "mario kart") # Creates a Mupen 64 emulator object for mario kart
+        emu = EmulatorInterface("Mupen 64", "mario kart")
+        emulators = [emu]
+        window.setUpdateFunc(lambda: onRingUpdate(window, emu, ring))
+    else:
+        emu = EmulatorInterface("Mupen 64", "mario kart") # Creates a Mupen 64 emulator object for mario kart
+        emulators = [emu]
 
-    window.setUpdateFunc(lambda: onUpdate(window, emu)) # Tells the update function to grab a screenshot 30fps
+        window.setUpdateFunc(lambda: onUpdate(window, emu)) # Tells the update function to grab a screenshot 30fps
+
+    if args.calibrate_keys:
+        time.sleep(3) # Time to bring the emulator windows to the front
+        calibrateKeys(window, emulators)
+        return
     window.create() # Creates the window given the parameters we've already set
+
+    '''
+        The sampling profiler can also run from startup (--profile
+        or MARIOKART_PROFILE), for a number of seconds or until exit.
+    '''
+    profileSeconds = profile_request(args.profile)
+    if profileSeconds is not None:
+        window.profiler.start()
+        if profileSeconds > 0:
+            QTimer.singleShot(int(profileSeconds * 1000), lambda: stopProfiler(window))
+    app.aboutToQuit.connect(lambda: stopProfiler(window))
+
+    '''
+        The agents are built while the window is already on screen;
+        the update functions report "Model loading" until they are ready.
+    '''
+    threading.Thread(target=loadAgentsOrFail, args=(args, emulators, pairings), daemon=True).start()
     sys.exit(app.exec_()) # Tells the program to check for exit
 
 if __name__ == "__main__":